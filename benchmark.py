@@ -0,0 +1,469 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from final import (
+    AdaptiveRateLimiter,
+    TokenBucket,
+    compare_df,
+    deduplicate_columns,
+    generate_query_async,
+    generate_query_for_row,
+    get_all_minimal_queries,
+    normalize_table,
+    subset_df,
+)
+
+
+def make_result_frame(
+    num_rows: int, num_cols: int, seed: int = 0
+) -> pd.DataFrame:
+    """
+    Builds a synthetic query result with a mix of int, float and string columns.
+    """
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(num_cols):
+        if i % 3 == 0:
+            data[f"int_{i}"] = rng.integers(0, num_rows, num_rows)
+        elif i % 3 == 1:
+            data[f"float_{i}"] = rng.random(num_rows).round(2)
+        else:
+            data[f"str_{i}"] = rng.choice(
+                [f"value_{j}" for j in range(1000)], num_rows
+            ).astype(object)
+    return pd.DataFrame(data)
+
+
+def time_function(func, *args, repeat: int = 3, **kwargs) -> float:
+    """
+    Returns the best wall-clock time in seconds of calling func(*args, **kwargs) repeat times.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_compare_df(num_rows: int, num_cols: int, repeat: int = 3):
+    """
+    Compares a frame against a shuffled copy of itself (the common "correct" case)
+    and against a frame with a single changed cell, with and without row hashing.
+    """
+    df_gold = make_result_frame(num_rows, num_cols)
+    df_same = df_gold.sample(frac=1, random_state=1).reset_index(drop=True)
+    df_diff = df_same.copy()
+    df_diff.iloc[0, 0] = -1
+    print(f"compare_df on {num_rows} rows x {num_cols} columns")
+    for label, df_gen in [("same", df_same), ("diff", df_diff)]:
+        for use_hash in [False, True]:
+            seconds = time_function(
+                compare_df,
+                df_gold,
+                df_gen,
+                "benchmark",
+                "benchmark",
+                repeat=repeat,
+                use_hash=use_hash,
+            )
+            print(f"  {label:<5} use_hash={use_hash!s:<5} {seconds:.3f}s")
+
+
+def bench_normalize_table(num_rows: int, num_cols: int, repeat: int = 3):
+    """
+    Normalizes a frame without ORDER BY (sorting on every column), and with ORDER BY on one and
+    on two columns.
+    """
+    df = make_result_frame(num_rows, num_cols)
+    print(f"normalize_table on {num_rows} rows x {num_cols} columns")
+    for label, sql in [
+        ("no order by", None),
+        ("order by 1 column", f"SELECT * FROM t ORDER BY {df.columns[-1]}"),
+        (
+            "order by 2 columns",
+            f"SELECT * FROM t ORDER BY {df.columns[0]} DESC, {df.columns[-1]}",
+        ),
+    ]:
+        seconds = time_function(
+            normalize_table, df, "benchmark", "benchmark", sql, repeat=repeat
+        )
+        print(f"  {label:<20} {seconds:.3f}s")
+
+
+def bench_subset_df(num_rows: int, num_cols: int, repeat: int = 3):
+    """
+    Checks a few columns of a wide frame (as returned by SELECT *) against the full frame.
+    """
+    df_super = make_result_frame(num_rows, num_cols)
+    df_sub = df_super[df_super.columns[-3:]].copy()
+    df_sub.columns = ["a", "b", "c"]
+    print(f"subset_df on {num_rows} rows x {num_cols} columns")
+    seconds = time_function(
+        subset_df, df_sub, df_super, "benchmark", "benchmark", repeat=repeat
+    )
+    print(f"  last 3 columns {seconds:.3f}s")
+
+
+class StubQueryGenerator:
+    """
+    Offline stand-in for OpenAIQueryGenerator. Each request sleeps for latency_seconds, and
+    requests beyond the shared server_bucket's rate get a 429 error, like the API returns.
+    """
+
+    latency_seconds = 0.05
+    tokens_per_request = 500
+    server_bucket = None
+
+    def __init__(self, **kwargs):
+        pass
+
+    def generate_query(self, question: str, **kwargs) -> dict:
+        start = time.time()
+        if self.server_bucket.try_consume(1) > 0:
+            return {
+                "query": "",
+                "reason": "",
+                "err": "GENERATION ERROR: Error code: 429 - Rate limit reached",
+                "table_metadata_string": "",
+            }
+        time.sleep(self.latency_seconds)
+        return {
+            "query": "SELECT 1",
+            "reason": "",
+            "err": "",
+            "table_metadata_string": "",
+            "latency_seconds": time.time() - start,
+            "tokens_used": self.tokens_per_request,
+        }
+
+
+def bench_generation(
+    num_questions: int, num_threads: int, server_requests_per_minute: float
+):
+    """
+    Generates queries with StubQueryGenerator against a simulated rate limit, once with a
+    fixed thread pool and once with the async path and its adaptive rate limiter.
+    """
+    args = types.SimpleNamespace(
+        db_type="postgres",
+        model="stub",
+        timeout_gen=30,
+        use_private_data=False,
+        verbose=False,
+        num_columns=20,
+        shuffle_metadata=False,
+    )
+    rows = [
+        {
+            "db_name": "benchmark",
+            "db_type": "postgres",
+            "question": f"question {i}",
+            "instructions": "",
+            "k_shot_prompt": "",
+            "glossary": "",
+            "table_metadata_string": "",
+            "prev_invalid_sql": "",
+            "prev_error_msg": "",
+            "cot_instructions": "",
+        }
+        for i in range(num_questions)
+    ]
+    print(
+        f"generation of {num_questions} queries, server limit {server_requests_per_minute} requests/minute"
+    )
+
+    # allow a burst of one second's worth of requests
+    StubQueryGenerator.server_bucket = TokenBucket(
+        server_requests_per_minute, server_requests_per_minute / 60
+    )
+    start = time.time()
+    with ThreadPoolExecutor(num_threads) as executor:
+        results = list(
+            executor.map(
+                lambda row: generate_query_for_row(
+                    row, args, "", StubQueryGenerator
+                ),
+                rows,
+            )
+        )
+    num_errors = sum(1 for result in results if result["err"])
+    print(
+        f"  threads={num_threads:<4} {time.time() - start:.2f}s, {num_errors} rate limited"
+    )
+
+    StubQueryGenerator.server_bucket = TokenBucket(
+        server_requests_per_minute, server_requests_per_minute / 60
+    )
+    # stay a little under the server's limit
+    limiter = AdaptiveRateLimiter(
+        4 * num_threads,
+        requests_per_minute=0.9 * server_requests_per_minute,
+        burst_seconds=1,
+    )
+
+    async def generate_all():
+        return await asyncio.gather(
+            *[
+                generate_query_async(
+                    row, args, "", limiter, generator_cls=StubQueryGenerator
+                )
+                for row in rows
+            ]
+        )
+
+    start = time.time()
+    results = asyncio.run(generate_all())
+    num_errors = sum(1 for result in results if result["err"])
+    print(f"  async       {time.time() - start:.2f}s, {num_errors} rate limited")
+    print(f"  {limiter.stats()}")
+
+
+def make_suite_frame(
+    num_rows: int,
+    num_cols: int,
+    duplicate_ratio: float,
+    nan_density: float,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    make_result_frame with duplicate_ratio of its rows replaced by copies of other rows, and
+    nan_density of its cells set to NULL.
+    """
+    rng = np.random.default_rng(seed)
+    df = make_result_frame(num_rows, num_cols, seed)
+    num_duplicates = int(num_rows * duplicate_ratio)
+    if num_duplicates:
+        targets = rng.choice(num_rows, num_duplicates, replace=False)
+        sources = rng.choice(num_rows, num_duplicates)
+        df.iloc[targets] = df.iloc[sources].to_numpy()
+    if nan_density:
+        df = df.mask(rng.random(df.shape) < nan_density)
+    # the generated queries return rows in this order, so that they're shuffled relative to the
+    # gold queries
+    df["shuffle_key"] = rng.permutation(num_rows)
+    return df
+
+
+def connect_embedded_db(engine: str):
+    """
+    Returns a connection to an in-memory database, either sqlite3 or duckdb.
+    """
+    if engine == "sqlite":
+        return sqlite3.connect(":memory:")
+    if engine == "duckdb":
+        import duckdb
+
+        return duckdb.connect(":memory:")
+    raise ValueError(f"Invalid engine: {engine}")
+
+
+def run_embedded_query(con, engine: str, sql: str) -> pd.DataFrame:
+    if engine == "duckdb":
+        return con.execute(sql).df()
+    return pd.read_sql_query(sql, con)
+
+
+def make_query_pairs(columns: "list[str]") -> dict:
+    """
+    Builds synthetic gold / generated query pairs over table t, with the columns of a
+    make_suite_frame frame:
+    - exact: the gold query has a { } column choice, and the generated query picks all of it,
+      with columns and rows in a different order
+    - subset: the generated query selects every column
+    - duplicate_columns: the generated query selects its first column twice
+    """
+    first, second, *rest = columns
+    reordered = ", ".join([*reversed(rest), second, first])
+    return {
+        "exact": (
+            f"SELECT {{{first}, {second}}}, {', '.join(rest)} FROM t",
+            f"SELECT {reordered} FROM t ORDER BY shuffle_key",
+        ),
+        "subset": (
+            f"SELECT {first}, {second} FROM t",
+            f"SELECT {', '.join(columns)} FROM t ORDER BY shuffle_key",
+        ),
+        "duplicate_columns": (
+            f"SELECT {first}, {second} FROM t",
+            f"SELECT {first}, {first}, {second} FROM t ORDER BY shuffle_key",
+        ),
+    }
+
+
+def measure(func, min_seconds: float = 0.2) -> dict:
+    """
+    Calls func repeatedly for at least min_seconds and returns its ops/sec, and the peak memory
+    allocated by a separate call traced with tracemalloc.
+    """
+    num_calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        num_calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "ops_per_sec": num_calls / elapsed,
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+def run_suite(
+    heights: "list[int]",
+    widths: "list[int]",
+    duplicate_ratios: "list[float]",
+    nan_densities: "list[float]",
+    engine: str = "sqlite",
+    min_seconds: float = 0.2,
+) -> "list[dict]":
+    """
+    Benchmarks deduplicate_columns, normalize_table, compare_df, subset_df and
+    get_all_minimal_queries on the results of synthetic query pairs, executed against an
+    embedded database, for every combination of frame height, width, duplicate ratio and
+    NaN density. Returns one result per function and combination.
+    """
+    results = []
+    for num_rows, num_cols, duplicate_ratio, nan_density in itertools.product(
+        heights, widths, duplicate_ratios, nan_densities
+    ):
+        params = {
+            "num_rows": num_rows,
+            "num_cols": num_cols,
+            "duplicate_ratio": duplicate_ratio,
+            "nan_density": nan_density,
+        }
+        print(f"suite {params}")
+        df = make_suite_frame(num_rows, num_cols, duplicate_ratio, nan_density)
+        con = connect_embedded_db(engine)
+        try:
+            if engine == "duckdb":
+                con.register("df", df)
+                con.execute("CREATE TABLE t AS SELECT * FROM df")
+            else:
+                df.to_sql("t", con, index=False)
+            query_pairs = make_query_pairs(df.columns[:-1].tolist())
+            frames = {}
+            for case, (query_gold, query_gen) in query_pairs.items():
+                # the gold query with every { } option, ie the one compare_query_results runs last
+                frames[case] = (
+                    run_embedded_query(
+                        con, engine, get_all_minimal_queries(query_gold)[-1]
+                    ),
+                    run_embedded_query(con, engine, query_gen),
+                )
+        finally:
+            con.close()
+
+        query_gold, query_gen = query_pairs["exact"]
+        df_gold, df_gen = frames["exact"]
+        df_sub, df_super = frames["subset"]
+        df_duplicates = frames["duplicate_columns"][1]
+        benchmarks = {
+            "deduplicate_columns": lambda: deduplicate_columns(
+                df_duplicates.copy(deep=False)
+            ),
+            "normalize_table": lambda: normalize_table(
+                df_gen, "benchmark", "benchmark", query_gen
+            ),
+            "compare_df": lambda: compare_df(
+                df_gold, df_gen, "benchmark", "benchmark", query_gold, query_gen
+            ),
+            "subset_df": lambda: subset_df(
+                df_sub, df_super, "benchmark", "benchmark"
+            ),
+            "get_all_minimal_queries": lambda: get_all_minimal_queries(query_gold),
+        }
+        for name, func in benchmarks.items():
+            result = {"function": name, **params, **measure(func, min_seconds)}
+            print(
+                f"  {name:<24} {result['ops_per_sec']:>12.1f} ops/s {result['peak_memory_mb']:>9.1f} MB"
+            )
+            results.append(result)
+    return results
+
+
+def get_git_commit() -> "str | None":
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_rows", type=int, default=500_000)
+    parser.add_argument("--num_cols", type=int, default=6)
+    parser.add_argument("--num_wide_cols", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num_questions", type=int, default=200)
+    parser.add_argument("--parallel_threads", type=int, default=16)
+    parser.add_argument("--requests_per_minute", type=float, default=3000)
+    # offline suite, written to json to compare versions
+    parser.add_argument("--suite", action="store_true")
+    parser.add_argument("--suite_output", type=str, default="benchmark_results.json")
+    parser.add_argument("--engine", choices=["sqlite", "duckdb"], default="sqlite")
+    parser.add_argument("--heights", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument("--widths", type=int, nargs="+", default=[4, 32])
+    parser.add_argument(
+        "--duplicate_ratios", type=float, nargs="+", default=[0.0, 0.5]
+    )
+    parser.add_argument("--nan_densities", type=float, nargs="+", default=[0.0, 0.2])
+    parser.add_argument("--min_seconds", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.suite:
+        results = run_suite(
+            args.heights,
+            args.widths,
+            args.duplicate_ratios,
+            args.nan_densities,
+            args.engine,
+            args.min_seconds,
+        )
+        with open(args.suite_output, "w") as f:
+            json.dump(
+                {
+                    "git_commit": get_git_commit(),
+                    "python": platform.python_version(),
+                    "pandas": pd.__version__,
+                    "numpy": np.__version__,
+                    "engine": args.engine,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"Wrote {len(results)} results to {args.suite_output}")
+        raise SystemExit
+    bench_compare_df(args.num_rows, args.num_cols, args.repeat)
+    bench_normalize_table(args.num_rows, args.num_cols, args.repeat)
+    bench_subset_df(args.num_rows // 10, args.num_wide_cols, args.repeat)
+    bench_generation(
+        args.num_questions, args.parallel_threads, args.requests_per_minute
+    )
@@ -55,35 +55,272 @@ ORDER BY item_count DESC;
 
 ------------
 
+import numpy as np
 import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
+
+# Hierarchy levels from the top down, with their display names
+HIERARCHY_LEVELS = [
+    ('customer_group_name', 'Customer Groups'),
+    ('division_name', 'Divisions'),
+    ('section_name', 'Sections'),
+    ('index_group_name', 'Index Groups'),
+    ('index_description', 'Index Descriptions'),
+    ('product_group_name', 'Product Groups'),
+    ('garment_group_name', 'Garment Groups'),
+]
+HIERARCHY_COLUMNS = [col for col, _ in HIERARCHY_LEVELS]
+
+
+def factorize_levels(df, columns):
+    """
+    Sorted integer codes of each column (-1 for missing values) as a rows x columns matrix,
+    and the values of each column in code order
+    """
+    factorized = [pd.factorize(df[col], sort=True) for col in columns]
+    return np.column_stack([codes for codes, _ in factorized]), [uniques for _, uniques in factorized]
+
+
+class HierarchyProfile:
+    """
+    Profile of the category hierarchy of an article table, computed from integer codes:
+    each column is factorized once and every statistic is counted over the code matrix.
+
+    - codes: rows x levels matrix of sorted codes, -1 for missing values
+    - uniques: the values of each level, in code order
+    - cardinalities: number of distinct values per level
+    - fan_outs: per parent -> child level pair, the mean and max number of distinct children
+      of a parent, and the number of children that appear under more than one parent
+    - combinations: every complete path through the levels with its number of rows,
+      most common first
+    """
+    def __init__(self, df, columns=HIERARCHY_COLUMNS):
+        self.columns = list(columns)
+        self.codes, self.uniques = factorize_levels(df, self.columns)
+        self.cardinalities = pd.Series([len(uniques) for uniques in self.uniques],
+                                       index=self.columns, name='unique_values')
+        self.fan_outs = self._fan_outs()
+        self.combinations = self._combinations()
+
+    def _fan_outs(self):
+        rows = []
+        for level in range(len(self.columns) - 1):
+            parents, children = self.codes[:, level], self.codes[:, level + 1]
+            num_parents = self.cardinalities.iloc[level]
+            num_children = self.cardinalities.iloc[level + 1]
+            present = (parents >= 0) & (children >= 0)
+            # Distinct parent/child pairs as single integers
+            pairs = pd.unique(parents[present] * num_children + children[present])
+            children_per_parent = np.bincount(pairs // num_children, minlength=num_parents)
+            parents_per_child = np.bincount(pairs % num_children, minlength=num_children)
+            rows.append({
+                'parent': self.columns[level],
+                'child': self.columns[level + 1],
+                'mean_children': children_per_parent.mean() if num_parents else np.nan,
+                'max_children': children_per_parent.max() if num_parents else 0,
+                'children_with_many_parents': int((parents_per_child > 1).sum()),
+            })
+        return pd.DataFrame(rows)
+
+    def _combinations(self):
+        complete = (self.codes >= 0).all(axis=1)
+        codes = self.codes[complete]
+        # Combine the levels one at a time, renumbering after each step so the codes stay
+        # small. Sorted factorizing keeps the combinations in the order of their values
+        combination = np.zeros(len(codes), dtype=np.int64)
+        for level, num_values in enumerate(self.cardinalities):
+            combination, _ = pd.factorize(combination * num_values + codes[:, level], sort=True)
+        counts = np.bincount(combination)
+        # Codes of each combination, taken from its first row
+        first_rows = np.empty(len(counts), dtype=np.int64)
+        first_rows[combination[::-1]] = np.arange(len(combination))[::-1]
+        result = pd.DataFrame({
+            col: uniques.take(codes[first_rows, level])
+            for level, (col, uniques) in enumerate(zip(self.columns, self.uniques))})
+        result['count'] = counts
+        return result.sort_values('count', ascending=False, kind='stable', ignore_index=True)
+
+
+class HierarchyIndex:
+    """
+    The hierarchy as a tree of arrays, built once from the article table and saved to disk.
+    There is a node for every distinct path prefix, numbered level by level in sorted path
+    order, so a node's children and the leaves under it are contiguous ranges:
+
+    - parent: parent node of each node, -1 for the top level
+    - child_offsets: children of node i are children[child_offsets[i]:child_offsets[i + 1]]
+    - leaf_start, leaf_stop: range of leaves (bottom-level nodes, numbered from 0) under a node
+    - leaf_counts: number of rows of each leaf, row_leaf: leaf of each row (-1 if a level is
+      missing)
+
+    Subtree counts and rollups to any level are differences of prefix sums over the leaves,
+    so metrics are only aggregated per leaf once
+    """
+    def __init__(self, columns, uniques, level_offsets, values, parent, leaf_start, leaf_stop,
+                 leaf_counts, row_leaf):
+        self.columns = list(columns)
+        self.uniques = [np.asarray(level_uniques) for level_uniques in uniques]
+        self.level_offsets = level_offsets
+        self.values = values
+        self.parent = parent
+        self.leaf_start = leaf_start
+        self.leaf_stop = leaf_stop
+        self.leaf_counts = leaf_counts
+        self.row_leaf = row_leaf
+        # Nodes are sorted by parent, so every node below the top level is in children
+        self.children = np.arange(level_offsets[1], len(parent))
+        self.child_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(parent[level_offsets[1]:], minlength=len(parent)))])
+        self._leaf_count_sums = np.concatenate([[0], np.cumsum(leaf_counts)])
+
+    @classmethod
+    def build(cls, df, columns=HIERARCHY_COLUMNS):
+        codes, uniques = factorize_levels(df, columns)
+        complete = (codes >= 0).all(axis=1)
+        complete_codes = codes[complete]
+        # Number the path prefixes of each level in sorted order, like HierarchyProfile
+        level_offsets = [0]
+        values, parents = [], []
+        prefix = np.zeros(len(complete_codes), dtype=np.int64)
+        for level, level_uniques in enumerate(uniques):
+            parent_prefix = prefix
+            prefix, _ = pd.factorize(prefix * len(level_uniques) + complete_codes[:, level],
+                                     sort=True)
+            num_nodes = prefix.max() + 1 if len(prefix) else 0
+            level_values = np.empty(num_nodes, dtype=np.int64)
+            level_values[prefix] = complete_codes[:, level]
+            level_parents = np.full(num_nodes, -1, dtype=np.int64)
+            if level:
+                level_parents[prefix] = parent_prefix + level_offsets[-2]
+            values.append(level_values)
+            parents.append(level_parents)
+            level_offsets.append(level_offsets[-1] + num_nodes)
+        level_offsets = np.array(level_offsets)
+        num_leaves = level_offsets[-1] - level_offsets[-2]
+        row_leaf = np.full(len(codes), -1, dtype=np.int64)
+        row_leaf[complete] = prefix
+        parent = np.concatenate(parents)
+        # Leaf ranges from the bottom up: a node spans its first child's start to its last
+        # child's stop
+        leaf_start = np.empty(len(parent), dtype=np.int64)
+        leaf_stop = np.empty(len(parent), dtype=np.int64)
+        leaf_start[level_offsets[-2]:] = np.arange(num_leaves)
+        leaf_stop[level_offsets[-2]:] = np.arange(1, num_leaves + 1)
+        child_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(parent[level_offsets[1]:], minlength=len(parent)))])
+        for level in reversed(range(len(uniques) - 1)):
+            nodes = np.arange(level_offsets[level], level_offsets[level + 1])
+            first_child = level_offsets[1] + child_offsets[nodes]
+            last_child = level_offsets[1] + child_offsets[nodes + 1] - 1
+            leaf_start[nodes] = leaf_start[first_child]
+            leaf_stop[nodes] = leaf_stop[last_child]
+        return cls(columns, uniques, level_offsets, np.concatenate(values), parent,
+                   leaf_start, leaf_stop, np.bincount(prefix, minlength=num_leaves), row_leaf)
+
+    def save(self, path):
+        np.savez(path, columns=np.array(self.columns), level_offsets=self.level_offsets,
+                 values=self.values, parent=self.parent, leaf_start=self.leaf_start,
+                 leaf_stop=self.leaf_stop, leaf_counts=self.leaf_counts, row_leaf=self.row_leaf,
+                 **{f'uniques_{level}': np.asarray(level_uniques, dtype=str)
+                    for level, level_uniques in enumerate(self.uniques)})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            columns = arrays['columns'].tolist()
+            uniques = [arrays[f'uniques_{level}'] for level in range(len(columns))]
+            return cls(columns, uniques, arrays['level_offsets'], arrays['values'],
+                       arrays['parent'], arrays['leaf_start'], arrays['leaf_stop'],
+                       arrays['leaf_counts'], arrays['row_leaf'])
+
+    def level_of(self, node):
+        return int(np.searchsorted(self.level_offsets, node, side='right') - 1)
+
+    def name(self, node):
+        # str rather than the numpy scalar of the uniques array
+        return str(self.uniques[self.level_of(node)][self.values[node]])
+
+    def node(self, path):
+        """
+        Node of a path of names from the top level down, eg ('Ladieswear', 'Womens Everyday')
+        """
+        candidates = np.arange(self.level_offsets[0], self.level_offsets[1])
+        node = -1
+        for level, name in enumerate(path):
+            if level:
+                candidates = self.children_of(node)
+            level_uniques = self.uniques[level]
+            code = np.searchsorted(level_uniques, name)
+            matches = candidates[self.values[candidates] == code]
+            if code == len(level_uniques) or level_uniques[code] != name or not len(matches):
+                raise KeyError(path)
+            node = matches[0]
+        return int(node)
+
+    def children_of(self, node):
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def ancestors(self, node):
+        """
+        Nodes on the path from the top level down to node, node included
+        """
+        path = [node]
+        while self.parent[path[-1]] >= 0:
+            path.append(self.parent[path[-1]])
+        return [int(ancestor) for ancestor in reversed(path)]
+
+    def path(self, node):
+        return [self.name(ancestor) for ancestor in self.ancestors(node)]
+
+    def subtree_count(self, node):
+        """
+        Number of rows under node
+        """
+        return int(self._leaf_count_sums[self.leaf_stop[node]]
+                   - self._leaf_count_sums[self.leaf_start[node]])
+
+    def leaf_totals(self, values):
+        """
+        Sum of a metric over the rows of each leaf, values being aligned with the rows the
+        index was built from. Missing values count as 0
+        """
+        has_leaf = self.row_leaf >= 0
+        values = np.nan_to_num(np.asarray(values, dtype=float)[has_leaf])
+        return np.bincount(self.row_leaf[has_leaf], weights=values,
+                           minlength=len(self.leaf_counts))
+
+    def rollup(self, leaf_values, level):
+        """
+        Totals of per-leaf values (eg leaf_totals or leaf_counts) for every node of a level,
+        as a frame with the path of each node and its total
+        """
+        if isinstance(level, str):
+            level = self.columns.index(level)
+        nodes = np.arange(self.level_offsets[level], self.level_offsets[level + 1])
+        sums = np.concatenate([[0], np.cumsum(leaf_values)])
+        result = {}
+        ancestor = nodes
+        for ancestor_level in reversed(range(level + 1)):
+            result[self.columns[ancestor_level]] = self.uniques[ancestor_level][
+                self.values[ancestor]]
+            ancestor = self.parent[ancestor]
+        result = pd.DataFrame({col: result[col] for col in self.columns[:level + 1]})
+        result['total'] = sums[self.leaf_stop[nodes]] - sums[self.leaf_start[nodes]]
+        return result
+
 
 def analyze_product_hierarchy(df):
+    profile = HierarchyProfile(df)
     print("Complete Product Hierarchy Analysis:")
     print("\nUnique values at each level:")
-    print(f"Customer Groups: {df['customer_group_name'].nunique()}")
-    print(f"Divisions: {df['division_name'].nunique()}")
-    print(f"Sections: {df['section_name'].nunique()}")
-    print(f"Index Groups: {df['index_group_name'].nunique()}")
-    print(f"Index Descriptions: {df['index_description'].nunique()}")
-    print(f"Product Groups: {df['product_group_name'].nunique()}")
-    print(f"Garment Groups: {df['garment_group_name'].nunique()}")
+    for col, label in HIERARCHY_LEVELS:
+        print(f"{label}: {profile.cardinalities[col]}")
 
     # Analyze relationships
     print("\nRelationship Analysis:")
-    for col1, col2 in [
-        ('customer_group_name', 'division_name'),
-        ('division_name', 'section_name'),
-        ('section_name', 'index_group_name'),
-        ('index_group_name', 'index_description'),
-        ('index_description', 'product_group_name'),
-        ('product_group_name', 'garment_group_name')
-    ]:
-        relationship = df.groupby(col1)[col2].nunique()
-        print(f"\n{col1} to {col2}:")
-        print(f"Average {col2}s per {col1}: {relationship.mean():.1f}")
-        print(f"Max {col2}s per {col1}: {relationship.max()}")
+    for fan_out in profile.fan_outs.itertuples():
+        print(f"\n{fan_out.parent} to {fan_out.child}:")
+        print(f"Average {fan_out.child}s per {fan_out.parent}: {fan_out.mean_children:.1f}")
+        print(f"Max {fan_out.child}s per {fan_out.parent}: {fan_out.max_children}")
 
     # Show example hierarchy
     print("\nExample Hierarchy Path:")
@@ -96,40 +333,17 @@ def analyze_product_hierarchy(df):
     print(f"            └─ Product Group: {sample['product_group_name']}")
     print(f"               └─ Garment Group: {sample['garment_group_name']}")
 
-    # Create visualization
+    # Create visualization, matplotlib is only needed here so profiling works without it
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(20, 12))
-    
-    # Create hierarchical layout
-    levels = [
-        df['customer_group_name'].unique(),
-        df['division_name'].unique(),
-        df['section_name'].unique(),
-        df['index_group_name'].unique(),
-        df['index_description'].unique(),
-        df['product_group_name'].unique(),
-        df['garment_group_name'].unique()
-    ]
-    
+
     # Plot as vertical bars showing hierarchy levels
-    for i, level in enumerate(levels):
-        y = [i] * len(level)
-        x = range(len(level))
-        plt.scatter(x, y, s=100)
-        if i == 0:
-            plt.text(-0.5, i, 'Customer Groups', ha='right')
-        elif i == 1:
-            plt.text(-0.5, i, 'Divisions', ha='right')
-        elif i == 2:
-            plt.text(-0.5, i, 'Sections', ha='right')
-        elif i == 3:
-            plt.text(-0.5, i, 'Index Groups', ha='right')
-        elif i == 4:
-            plt.text(-0.5, i, 'Index Descriptions', ha='right')
-        elif i == 5:
-            plt.text(-0.5, i, 'Product Groups', ha='right')
-        else:
-            plt.text(-0.5, i, 'Garment Groups', ha='right')
-            
+    for i, (col, label) in enumerate(HIERARCHY_LEVELS):
+        num_values = profile.cardinalities[col]
+        plt.scatter(range(num_values), [i] * num_values, s=100)
+        plt.text(-0.5, i, label, ha='right')
+
     plt.title('Product Category Hierarchy Levels')
     plt.xlabel('Number of Categories')
     plt.ylabel('Hierarchy Level')
@@ -138,17 +352,14 @@ def analyze_product_hierarchy(df):
 
     # Print common combinations
     print("\nMost Common Category Combinations:")
-    combinations = df.groupby([
-        'customer_group_name',
-        'division_name',
-        'section_name',
-        'index_group_name',
-        'index_description',
-        'product_group_name',
-        'garment_group_name'
-    ]).size().reset_index(name='count')
-    
-    print(combinations.nlargest(10, 'count'))
+    print(profile.combinations.head(10))
+    return profile
 
 # Assuming df is your DataFrame with the category data
 # analyze_product_hierarchy(df)
+
+# Build the tree index once and reuse it for rollups
+# index = HierarchyIndex.build(df)
+# index.save('product_hierarchy.npz')
+# index = HierarchyIndex.load('product_hierarchy.npz')
+# index.rollup(index.leaf_counts, 'section_name')
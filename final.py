@@ -1,12 +1,22 @@
+import functools
+import hashlib
 import itertools
+import multiprocessing
+import os
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from func_timeout import func_timeout
+import numpy as np
 import pandas as pd
 from pandas.testing import assert_frame_equal, assert_series_equal
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from utils.creds import db_creds_all
 import time
 import collections
+import contextlib
 LIKE_PATTERN = r"LIKE[\s\S]*'"
 def deduplicate_columns(df: pd.DataFrame) -> pd.DataFrame:
     cols = df.columns.tolist()
@@ -28,6 +38,67 @@ def find_bracket_indices(s: str, start_index: int = 0) -> "tuple[int, int]":
         return (-1, -1)
     return (start, end)
 
+# keywords that change which rows a query returns depending on its selected columns.
+# queries with these can't be answered by projecting the columns of a wider query
+NON_PROJECTABLE_PATTERN = re.compile(
+    r"\b(DISTINCT|LIMIT|TOP|FETCH|OFFSET|UNION|INTERSECT|EXCEPT)\b", re.IGNORECASE
+)
+# the text around { } when the column options are the whole select list
+SELECT_LIST_START_PATTERN = re.compile(r"\bSELECT\s*$", re.IGNORECASE)
+SELECT_LIST_END_PATTERN = re.compile(r"^\s*FROM\b", re.IGNORECASE)
+
+
+def iter_minimal_queries(query: str):
+    """
+    Lazily yields the same queries as get_all_minimal_queries, skipping duplicate expansions.
+    Each item is a tuple (query, base_query, column_indices, num_options):
+    - base_query is the expansion of the same query with all its num_options { } column options,
+      and column_indices are the positions of the selected options within it. If base_query is
+      not None, the result of query is the result of base_query restricted to column_indices, so
+      it only needs to be executed once for all subsets.
+    - base_query is None for queries without braces, when other columns are selected next to the
+      braces (their positions in the result aren't known), or when the column subset may affect
+      which rows are returned (eg DISTINCT, LIMIT, or GROUP BY {}).
+    """
+    seen = set()
+    for query in query.split(";"):
+        query = query.strip()
+        if query == "" or query in seen:
+            continue
+        start, end = find_bracket_indices(query, 0)
+        if (start, end) == (-1, -1):
+            seen.add(query)
+            yield query, None, None, None
+            continue
+        # get all possible column subsets
+        column_options = query[start + 1 : end].split(",")
+        left = query[:start]
+        right = query[end + 1 :]
+        base_query = None
+        if (
+            SELECT_LIST_START_PATTERN.search(left)
+            and SELECT_LIST_END_PATTERN.search(right)
+            and "GROUP BY {}" not in right
+            and not NON_PROJECTABLE_PATTERN.search(left + right)
+        ):
+            base_query = left + ", ".join(column_options) + right
+        for r in range(1, len(column_options) + 1):
+            for column_indices in itertools.combinations(
+                range(len(column_options)), r
+            ):
+                column_str = ", ".join(column_options[i] for i in column_indices)
+                # change group by size dynamically if necessary
+                expanded_query = left + column_str + right.replace(
+                    "GROUP BY {}", f"GROUP BY {column_str}"
+                )
+                if expanded_query in seen:
+                    continue
+                seen.add(expanded_query)
+                yield expanded_query, base_query, list(column_indices), len(
+                    column_options
+                )
+
+
 def get_all_minimal_queries(query: str) -> "list[str]":
     """
     extrapolate all possible queries
@@ -42,35 +113,9 @@ def get_all_minimal_queries(query: str) -> "list[str]":
         SELECT user.name FROM user;
         SELECT user.id, user.name FROM user;
     ```
+    Duplicate expansions are only returned once. Use iter_minimal_queries to expand lazily.
     """
-    queries = query.split(";")
-    result_queries = []
-    for query in queries:
-        query = query.strip()
-        if query == "":
-            continue
-        start, end = find_bracket_indices(query, 0)
-        if (start, end) == (-1, -1):
-            result_queries.append(query)
-            continue
-        else:
-            # get all possible column subsets
-            column_options = query[start + 1 : end].split(",")
-            column_combinations = list(
-                itertools.chain.from_iterable(
-                    itertools.combinations(column_options, r)
-                    for r in range(1, len(column_options) + 1)
-                )
-            )
-            for column_tuple in column_combinations:
-                left = query[:start]
-                column_str = ", ".join(column_tuple)
-                right = query[end + 1 :]
-                # change group by size dynamically if necessary
-                if right.find("GROUP BY {}"):
-                    right = right.replace("GROUP BY {}", f"GROUP BY {column_str}")
-                result_queries.append(left + column_str + right)
-    return result_queries
+    return [expanded_query for expanded_query, *_ in iter_minimal_queries(query)]
 
 # for escaping percent signs in regex matches
 def escape_percent(match):
@@ -81,6 +126,79 @@ def escape_percent(match):
     # Return the escaped group
     return escaped_group
 
+ORDER_BY_PATTERN = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+ORDER_BY_CLAUSE_PATTERN = re.compile(r"ORDER BY[\s\S]*", re.IGNORECASE)
+# text between ORDER BY and the next semicolon or end of line
+ORDER_BY_COLUMNS_PATTERN = re.compile(r"(?<=ORDER BY)(.*?)(?=;|$)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_order_by(sql: str) -> "tuple[bool, tuple[str, ...], tuple[bool, ...]]":
+    """
+    Parses the ORDER BY clause of sql, and returns whether sql has an ORDER BY clause, the
+    names of the columns in it (without table prefixes), and whether each column is ascending.
+    Memoized, since the same gold and generated queries are normalized many times.
+    """
+    if not ORDER_BY_PATTERN.search(sql):
+        return False, (), ()
+    # determine which columns are in the ORDER BY clause of the sql generated, using regex
+    order_by_clause = re.search(ORDER_BY_CLAUSE_PATTERN, sql)
+    if not order_by_clause:
+        return True, (), ()
+    order_by_clause = order_by_clause.group(0)
+    order_by_columns = re.findall(ORDER_BY_COLUMNS_PATTERN, order_by_clause)
+    order_by_columns = order_by_columns[0].split(",") if order_by_columns else []
+    order_by_columns = [col.strip() for col in order_by_columns]
+
+    # Process each column in the ORDER BY clause
+    processed_columns = []
+    ascending = []
+    for col in order_by_columns:
+        col_parts = col.split()
+        col_name = col_parts[0].strip('`"').rsplit(".", 1)[-1]  # Remove table prefix if present
+        processed_columns.append(col_name)
+        # Check for DESC or ASC
+        if len(col_parts) > 1 and col_parts[1].upper() == "DESC":
+            ascending.append(False)
+        else:
+            ascending.append(True)
+    return True, tuple(processed_columns), tuple(ascending)
+
+
+def encode_column(col: pd.Series, ordered: bool) -> "tuple[np.ndarray, int]":
+    """
+    Encodes a column as integer codes, with NaNs as their own code after all other values.
+    Returns (codes, number of codes). If ordered is True, codes follow the sort order of the
+    values, like those of pd.Categorical(col, ordered=True), which pandas sorts by.
+    """
+    if ordered:
+        cat = pd.Categorical(col, ordered=True)
+        codes, n = cat.codes, len(cat.categories)
+    else:
+        codes, uniques = pd.factorize(col)
+        n = len(uniques)
+    return np.where(codes == -1, n, codes).astype("int64"), n + 1
+
+
+def combine_codes(codes_list: "list[tuple[np.ndarray, int]]") -> np.ndarray:
+    """
+    Combines codes from several columns into a single int64 key per row, which orders rows the
+    same way as sorting by each column in turn.
+    """
+    key = np.zeros(len(codes_list[0][0]) if codes_list else 0, dtype="int64")
+    size = 1
+    for codes, n in codes_list:
+        if size * n >= 2**62:
+            # replace the key so far by its rank among the unique keys, which keeps its order
+            # and makes it small enough to keep combining
+            key, uniques = pd.factorize(key, sort=True)
+            key = key.astype("int64")
+            size = len(uniques)
+        key = key * n + codes
+        size *= n
+    return key
+
+
 def normalize_table(
     df: pd.DataFrame, query_category: str, question: str, sql: str = None
 ) -> pd.DataFrame:
@@ -90,66 +208,268 @@ def normalize_table(
     2. sorting columns in alphabetical order
     3. sorting rows based on ORDER BY clause if present in SQL, otherwise using values from first column to last
     4. resetting index
+    Each column is encoded as integer codes once, and both deduplication and sorting work on
+    those codes (combined into a single int64 key per row where it fits), the same way pandas
+    sorts by multiple columns. The row and column orders are applied with a single take.
     """
-    # remove duplicate rows, if any
-    df = df.drop_duplicates()
+    if not df.columns.is_unique:
+        # same error as reindexing the columns by name would raise
+        raise ValueError("cannot reindex on an axis with duplicate labels")
 
     # sort columns in alphabetical order of column names
-    sorted_df = df.reindex(sorted(df.columns), axis=1)
+    columns = sorted(df.columns)
 
     # check if SQL contains ORDER BY clause
-    has_order_by = False
-    if sql:
-        order_by_pattern = re.compile(r'\bORDER\s+BY\b', re.IGNORECASE)
-        has_order_by = bool(order_by_pattern.search(sql))
-
+    has_order_by, order_by_columns, order_by_ascending = (
+        parse_order_by(sql) if sql else (False, (), ())
+    )
     if has_order_by:
-        # determine which columns are in the ORDER BY clause of the sql generated, using regex
-        pattern = re.compile(r"ORDER BY[\s\S]*", re.IGNORECASE)
-        order_by_clause = re.search(pattern, sql)
-        if order_by_clause:
-            order_by_clause = order_by_clause.group(0)
-            # get all columns in the ORDER BY clause, by looking at the text between ORDER BY and the next semicolon, comma, or parentheses
-            pattern = re.compile(r"(?<=ORDER BY)(.*?)(?=;|$)", re.IGNORECASE)
-            order_by_columns = re.findall(pattern, order_by_clause)
-            order_by_columns = order_by_columns[0].split(',') if order_by_columns else []
-            order_by_columns = [col.strip() for col in order_by_columns]
-
-            # Process each column in the ORDER BY clause
-            processed_columns = []
-            ascending = []
-            for col in order_by_columns:
-                col_parts = col.split()
-                col_name = col_parts[0].strip('`"').rsplit('.', 1)[-1]  # Remove table prefix if present
-                processed_columns.append(col_name)
-                # Check for DESC or ASC
-                if len(col_parts) > 1 and col_parts[1].upper() == 'DESC':
-                    ascending.append(False)
-                else:
-                    ascending.append(True)
-
-            # Filter out columns that don't exist in the dataframe
-            existing_columns = [col for col in processed_columns if col in sorted_df.columns]
-            existing_ascending = [asc for col, asc in zip(processed_columns, ascending) if col in sorted_df.columns]
-
-            # If we have valid columns to sort by
-            if existing_columns:
-                sorted_df = sorted_df.sort_values(by=existing_columns, ascending=existing_ascending)
-
-                # Reorder columns to put ORDER BY columns last
-                other_columns = [col for col in sorted_df.columns if col not in existing_columns]
-                sorted_df = sorted_df[other_columns + existing_columns]
-
+        # Filter out columns that don't exist in the dataframe
+        sort_by = [col for col in order_by_columns if col in columns]
+        ascending = [
+            asc for col, asc in zip(order_by_columns, order_by_ascending) if col in columns
+        ]
+        if sort_by:
+            # Reorder columns to put ORDER BY columns last
+            columns = [col for col in columns if col not in sort_by] + sort_by
     else:
         # If no ORDER BY, sort rows using values from first column to last
-        sorted_df = sorted_df.sort_values(by=list(sorted_df.columns))
+        sort_by = columns
+        ascending = [True] * len(columns)
 
-    # reset index
+    # only the columns we sort by need ordered codes
+    codes = {
+        col: encode_column(df[col], ordered=col in sort_by) for col in df.columns
+    }
+    sort_codes = []
+    for col, asc in zip(sort_by, ascending):
+        col_codes, n = codes[col]
+        if not asc:
+            # reverse the order of values, but keep NaNs last
+            col_codes = np.where(col_codes == n - 1, col_codes, n - 2 - col_codes)
+        sort_codes.append((col_codes, n))
+
+    if not has_order_by and len(sort_codes) > 1:
+        sort_key = combine_codes(sort_codes)
+        # all columns are in the key, so rows with the same key are duplicates, and a stable
+        # sort keeps the first of them first
+        order = np.argsort(sort_key, kind="stable")
+        sorted_key = sort_key[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = sorted_key[1:] != sorted_key[:-1]
+        rows = order[is_first]
+    else:
+        rows = sort_positions(df, codes, sort_codes, sort_by, ascending)
+
+    sorted_df = df.iloc[rows, [df.columns.get_loc(col) for col in columns]]
+    # a column listed twice in ORDER BY is selected twice, rename the copies by position
     sorted_df = deduplicate_columns(sorted_df)
+    # reset index
     sorted_df = sorted_df.reset_index(drop=True)
     return sorted_df
 
 
+def sort_positions(
+    df: pd.DataFrame,
+    codes: dict,
+    sort_codes: "list[tuple[np.ndarray, int]]",
+    sort_by: "list[str]",
+    ascending: "list[bool]",
+) -> np.ndarray:
+    """
+    Returns the positions of the rows of df, without duplicates, in sorted order.
+    codes are the encoded columns of df, and sort_codes the (direction-adjusted) codes of the
+    columns to sort by.
+    """
+    # remove duplicate rows, keeping the first of each
+    if df.shape[1] == 1:
+        # drop_duplicates on a single column goes through Series.duplicated, which keeps None
+        # and NaN apart, unlike the codes of factorize
+        keep = np.flatnonzero(~df.iloc[:, 0].duplicated().to_numpy())
+    else:
+        row_key = combine_codes(list(codes.values()))
+        keep = np.flatnonzero(~pd.Index(row_key).duplicated())
+
+    if len(sort_codes) == 1:
+        # sorts on a single column aren't stable in pandas, so leave them to sort_values
+        col = df[sort_by[0]].iloc[keep].reset_index(drop=True)
+        return keep[col.sort_values(ascending=ascending[0]).index.to_numpy()]
+    if not sort_codes:
+        return keep
+    sort_key = combine_codes([(col_codes[keep], n) for col_codes, n in sort_codes])
+    return keep[np.argsort(sort_key, kind="stable")]
+
+
+
+# multiplier used to fold per-column hashes into a single row hash
+ROW_HASH_PRIME = np.uint64(0x100000001B3)
+# hash assigned to null cells in string columns, so that they never collide with ""
+NULL_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+def hash_column(col: pd.Series):
+    """
+    Returns (kind, values, hashes) for a column, where values is a numpy array that can be
+    compared elementwise and hashes is a uint64 array with one hash per row.
+    Values are normalized the same way compare_df does (NaNs filled with -99999) so that two
+    cells that compare equal as python objects always get the same hash.
+    Returns None if the column's dtype can't be hashed safely, eg mixed object columns.
+    """
+    if pd.api.types.is_bool_dtype(col) or pd.api.types.is_integer_dtype(col):
+        # ints and bools compare equal in python (1 == True), so both are hashed as int64,
+        # which unlike float64 is exact for ids above 2**53
+        filled = col.fillna(-99999)
+        if (
+            pd.api.types.is_unsigned_integer_dtype(filled)
+            and len(filled)
+            and filled.max() > np.iinfo("int64").max
+        ):
+            return None
+        values = filled.to_numpy(dtype="int64")
+        return "integer", values, pd.util.hash_array(values)
+    if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_complex_dtype(col):
+        # integer and float columns get different kinds, so 1 vs 1.0 is left to compare_df
+        # adding 0.0 turns -0.0 into 0.0, which compare equal but have different bits
+        values = col.fillna(-99999).to_numpy(dtype="float64") + 0.0
+        return "float", values, pd.util.hash_array(values)
+    if isinstance(col.dtype, pd.DatetimeTZDtype) or pd.api.types.is_datetime64_dtype(
+        col
+    ):
+        # naive and tz-aware timestamps never compare equal, so keep the tz in the kind.
+        # values are hashed in their own unit, which can't overflow like a conversion to ns
+        # can for dates such as 9999-12-31, so keep the unit in the kind too
+        values = col.array.asi8
+        return (
+            f"datetime[{col.array.unit}, {getattr(col.dtype, 'tz', None)}]",
+            values,
+            pd.util.hash_array(values),
+        )
+    if pd.api.types.infer_dtype(col, skipna=True) in ("string", "empty"):
+        is_null = col.isna().to_numpy()
+        values = col.to_numpy(dtype=object, na_value="")
+        hashes = pd.util.hash_array(values)
+        hashes[is_null] = NULL_HASH
+        values[is_null] = None
+        return "string", values, hashes
+    return None
+
+
+def hash_rows(df: pd.DataFrame):
+    """
+    Hashes every row of df columnwise, visiting columns in alphabetical order.
+    Returns (kinds, values, row_hashes), or None if any column can't be hashed.
+    """
+    kinds = {}
+    values = {}
+    row_hashes = np.zeros(len(df), dtype="uint64")
+    for col_name in sorted(df.columns):
+        hashed = hash_column(df[col_name])
+        if hashed is None:
+            return None
+        kinds[col_name], values[col_name], col_hashes = hashed
+        row_hashes = row_hashes * ROW_HASH_PRIME ^ col_hashes
+    return kinds, values, row_hashes
+
+
+def hash_compare_df(df_gold: pd.DataFrame, df_gen: pd.DataFrame) -> "bool | None":
+    """
+    Compares two dataframes as sets of rows using row hashes, without sorting either frame.
+    Duplicate rows are compared as one, like the sets of tuples in compare_df.
+    Returns True/False when the hashes can decide the comparison, and None when the caller
+    should fall back to the exact comparison (duplicate column names, unhashable dtypes or a
+    hash collision).
+    A difference in hashes always means a difference in rows, while a match in hashes is
+    confirmed with an exact elementwise check before returning True.
+    """
+    for df in (df_gold, df_gen):
+        if not df.columns.is_unique:
+            # duplicated column names can't be matched by name, leave them to compare_df
+            return None
+    if set(df_gold.columns) != set(df_gen.columns):
+        return False
+    hashed_gold = hash_rows(df_gold)
+    hashed_gen = hash_rows(df_gen)
+    if hashed_gold is None or hashed_gen is None:
+        return None
+    kinds_gold, values_gold, hashes_gold = hashed_gold
+    kinds_gen, values_gen, hashes_gen = hashed_gen
+    if kinds_gold != kinds_gen:
+        # eg int vs decimal.Decimal columns, which may still compare equal as python objects
+        return None
+
+    # the distinct hashes, the first row with each of them and the hash of every row
+    unique_gold, first_gold, inverse_gold = np.unique(
+        hashes_gold, return_index=True, return_inverse=True
+    )
+    unique_gen, first_gen, inverse_gen = np.unique(
+        hashes_gen, return_index=True, return_inverse=True
+    )
+    if not np.array_equal(unique_gold, unique_gen):
+        return False
+
+    # confirm the match cell by cell: the first rows of each hash must be equal, and every
+    # other row must be a duplicate of the first row with its hash, or it is a collision
+    for col_name, col_gold in values_gold.items():
+        col_gen = values_gen[col_name]
+        if not (
+            np.array_equal(col_gold[first_gold], col_gen[first_gen])
+            and np.array_equal(col_gold, col_gold[first_gold][inverse_gold])
+            and np.array_equal(col_gen, col_gen[first_gen][inverse_gen])
+        ):
+            return None
+    return True
+
+
+# phases of evaluating a question, timed per row by the runner
+PHASES = (
+    "prompt_build",
+    "llm_call",
+    "gen_exec",
+    "gold_exec",
+    "normalize",
+    "compare",
+)
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall-clock time spent in each phase of evaluating a question.
+    Phases can be nested, in which case the time of the inner phase is not counted towards
+    the outer one, eg normalization inside a comparison.
+    A timer is not thread safe, and is meant to be used for a single row.
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        # [name, start, seconds spent in nested phases]
+        frame = [name, time.perf_counter(), 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            self.seconds[name] += elapsed - frame[2]
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def add(self, seconds: dict):
+        """
+        Adds the phase times of another timer, eg one that ran in a worker process.
+        They are counted as nested in the current phase, if any.
+        """
+        for name, value in seconds.items():
+            self.seconds[name] += value
+            if self.stack:
+                self.stack[-1][2] += value
+
+    def as_dict(self) -> dict:
+        return dict(self.seconds)
+
 
 def compare_df(
     df_gold: pd.DataFrame,
@@ -158,14 +478,25 @@ def compare_df(
     question: str,
     query_gold: str = None,
     query_gen: str = None,
+    use_hash: bool = True,
+    timer: PhaseTimer = None,
 ) -> bool:
     """
     Compares two dataframes and returns True if they contain the same data, regardless of row order or duplicates.
     query_gold and query_gen are the original queries that generated the respective dataframes.
+    If use_hash is True, we first try comparing row hashes (see hash_compare_df) and only
+    normalize and compare sets of tuples if the hashes can't decide.
+    If timer is given, the time spent in normalize_table is recorded in its "normalize" phase.
     """
+    if use_hash:
+        is_equal = hash_compare_df(df_gold, df_gen)
+        if is_equal is not None:
+            return is_equal
+
     # Normalize the dataframes
-    df_gold = normalize_table(df_gold, query_category, question, query_gold)
-    df_gen = normalize_table(df_gen, query_category, question, query_gen)
+    with timer.phase("normalize") if timer else contextlib.nullcontext():
+        df_gold = normalize_table(df_gold, query_category, question, query_gold)
+        df_gen = normalize_table(df_gen, query_category, question, query_gen)
 
     # Check if the dataframes have the same columns
     if set(df_gold.columns) != set(df_gen.columns):
@@ -187,6 +518,110 @@ def compare_df(
     return set_gold == set_gen
 
 
+DATETIME_UNITS_PER_SECOND = {"s": 1, "ms": 10**3, "us": 10**6, "ns": 10**9}
+
+# tolerances for ruling out numeric column matches. these are much looser than the default
+# rtol/atol of assert_series_equal, so a column we rule out could never have passed it
+LOOSE_RTOL = 1e-3
+LOOSE_ATOL = 1e-3
+
+
+def summarize_column(col_sorted: pd.Series) -> dict:
+    """
+    Summarizes a sorted column so we can rule out matches without running assert_series_equal:
+    - group: "numeric", "datetime", "string" or "other". assert_series_equal(check_dtype=False)
+      never matches columns from two different groups, except for "other".
+    - fingerprint: (length, kind, hash of the sorted values) for integer/bool, string and naive
+      timestamp columns, which assert_series_equal compares exactly. None for columns that are
+      compared approximately or loosely (floats, nullable ints, tz-aware timestamps, mixed objects)
+    - nulls, low, high: null count and min/max (sorted values put nulls last) for numeric columns
+    - all_null: whether every value is null. All-null columns can match across groups, so
+      they never get a fingerprint
+    """
+    summary = {
+        "length": len(col_sorted),
+        "fingerprint": None,
+        "all_null": bool(col_sorted.isna().all()),
+    }
+    if pd.api.types.is_bool_dtype(col_sorted) or (
+        pd.api.types.is_numeric_dtype(col_sorted)
+        and not pd.api.types.is_complex_dtype(col_sorted)
+    ):
+        summary["group"] = "numeric"
+        values = col_sorted.dropna().to_numpy(dtype="float64")
+        summary["nulls"] = len(col_sorted) - len(values)
+        summary["low"] = values[0] if len(values) else None
+        summary["high"] = values[-1] if len(values) else None
+        if summary["nulls"] == 0 and (
+            pd.api.types.is_integer_dtype(col_sorted)
+            or pd.api.types.is_bool_dtype(col_sorted)
+        ):
+            summary["fingerprint"] = "integer"
+    elif isinstance(
+        col_sorted.dtype, pd.DatetimeTZDtype
+    ) or pd.api.types.is_datetime64_dtype(col_sorted):
+        summary["group"] = "datetime"
+        if pd.api.types.is_datetime64_dtype(col_sorted):
+            summary["fingerprint"] = "datetime"
+    elif pd.api.types.infer_dtype(col_sorted, skipna=True) == "string":
+        summary["group"] = "string"
+        summary["fingerprint"] = "string"
+    else:
+        summary["group"] = "other"
+
+    if summary["all_null"]:
+        summary["fingerprint"] = None
+    if summary["fingerprint"] == "datetime":
+        # assert_series_equal matches equal timestamps in different units, so hash them in
+        # whole seconds, which every unit can represent without overflowing
+        is_null = col_sorted.isna().to_numpy()
+        values = col_sorted.array.asi8 // DATETIME_UNITS_PER_SECOND[col_sorted.array.unit]
+        values[is_null] = np.iinfo("int64").min
+        hashes = pd.util.hash_array(values)
+    elif summary["fingerprint"] is not None:
+        hashed = hash_column(col_sorted)
+        if hashed is None:
+            # eg uint64 values beyond the int64 range
+            summary["fingerprint"] = None
+        else:
+            hashes = hashed[2]
+    if summary["fingerprint"] is not None:
+        summary["fingerprint"] = (
+            len(col_sorted),
+            summary["fingerprint"],
+            hash(hashes.tobytes()),
+        )
+    return summary
+
+
+def could_match(summary_sub: dict, summary_super: dict) -> bool:
+    """
+    Returns False if two sorted columns can't pass assert_series_equal(check_dtype=False),
+    judging only from their summaries. True means a full comparison is needed.
+    """
+    if summary_sub["length"] != summary_super["length"]:
+        return False
+    if summary_sub["all_null"] or summary_super["all_null"]:
+        # eg all-NaN strings can match all-NaN floats, but never a column with values
+        return summary_sub["all_null"] and summary_super["all_null"]
+    if summary_sub["fingerprint"] is not None and summary_super["fingerprint"] is not None:
+        return summary_sub["fingerprint"] == summary_super["fingerprint"]
+    if "other" in (summary_sub["group"], summary_super["group"]):
+        return True
+    if summary_sub["group"] != summary_super["group"]:
+        return False
+    if summary_sub["group"] == "numeric":
+        if summary_sub["nulls"] != summary_super["nulls"]:
+            return False
+        for key in ("low", "high"):
+            a, b = summary_sub[key], summary_super[key]
+            if a is None or b is None:
+                continue
+            if abs(a - b) > LOOSE_RTOL * max(abs(a), abs(b)) + LOOSE_ATOL:
+                return False
+    return True
+
+
 def subset_df(
     df_sub: pd.DataFrame,
     df_super: pd.DataFrame,
@@ -198,31 +633,64 @@ def subset_df(
 ) -> bool:
     """
     Checks if df_sub is a subset of df_super.
+    Each column is sorted and summarized once. Super columns are indexed by fingerprint so
+    that each sub column is only compared in full against plausible candidates.
     """
     if df_sub.empty:
         return False  # handle cases for empty dataframes
 
-    # make a copy of df_super so we don't modify the original while keeping track of matches
-    df_super_temp = df_super.copy(deep=True)
+    # shallow copy of df_super so we can rename duplicate columns without modifying the original
+    df_super_temp = deduplicate_columns(df_super.copy(deep=False))
     matched_columns = []
     df_sub = deduplicate_columns(df_sub)
-    df_super_temp = deduplicate_columns(df_super_temp)
+
+    # sort and summarize each super column once
+    super_sorted = {}
+    super_summaries = {}
+    super_by_fingerprint = collections.defaultdict(list)
+    super_loose = []  # (position, name) of columns without a fingerprint
+    for position, col_super_name in enumerate(df_super_temp.columns):
+        col_super = df_super_temp[col_super_name].sort_values().reset_index(drop=True)
+        summary = summarize_column(col_super)
+        super_sorted[col_super_name] = col_super
+        super_summaries[col_super_name] = summary
+        if summary["fingerprint"] is None:
+            super_loose.append((position, col_super_name))
+        else:
+            super_by_fingerprint[summary["fingerprint"]].append(
+                (position, col_super_name)
+            )
+
     for col_sub_name in df_sub.columns:
-        col_match = False
-        for col_super_name in df_super_temp.columns:
-            col_sub = df_sub[col_sub_name].sort_values().reset_index(drop=True)
-            col_super = (
-                df_super_temp[col_super_name].sort_values().reset_index(drop=True)
+        col_sub = df_sub[col_sub_name].sort_values().reset_index(drop=True)
+        summary_sub = summarize_column(col_sub)
+        if summary_sub["fingerprint"] is None:
+            candidates = list(enumerate(df_super_temp.columns))
+        else:
+            candidates = sorted(
+                super_by_fingerprint.get(summary_sub["fingerprint"], [])
+                + super_loose
             )
 
+        col_match = False
+        # candidates are visited in df_super's column order, so the first match is the same
+        # column as an exhaustive scan would pick
+        for _, col_super_name in candidates:
+            if col_super_name not in super_sorted:
+                continue  # already matched to a previous sub column
+            if not could_match(summary_sub, super_summaries[col_super_name]):
+                continue
             try:
                 assert_series_equal(
-                    col_sub, col_super, check_dtype=False, check_names=False
+                    col_sub,
+                    super_sorted[col_super_name],
+                    check_dtype=False,
+                    check_names=False,
                 )
                 col_match = True
                 matched_columns.append(col_super_name)
                 # remove col_super_name to prevent us from matching it again
-                df_super_temp = df_super_temp.drop(columns=[col_super_name])
+                del super_sorted[col_super_name]
                 break
             except AssertionError:
                 continue
@@ -247,15 +715,695 @@ def subset_df(
         return True
     except AssertionError:
         return False
-    
-    
-    
-    import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class EnginePool:
+    """
+    Process-wide cache of sqlalchemy engines keyed by (db_type, db_name), so that connections are
+    reused across queries instead of being set up for every query.
+    - pool_size / max_overflow: connections kept open / allowed on top of that, per engine
+    - pool_pre_ping: check connections before using them, eg after a timed out query
+    - statement_timeout: if set, seconds after which the database cancels a statement, applied
+      to every connection when it is opened
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_pre_ping: bool = True,
+        statement_timeout: float = None,
+    ):
+        self.engines = {}
+        self.lock = threading.Lock()
+        self.num_connects = 0
+        self.num_checkouts = 0
+        self.configure(pool_size, max_overflow, pool_pre_ping, statement_timeout)
+
+    def configure(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_pre_ping: bool = True,
+        statement_timeout: float = None,
+    ):
+        """
+        Changes the pool settings. Existing engines are disposed, and recreated with the new
+        settings when they're next used.
+        """
+        self.dispose()
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_pre_ping = pool_pre_ping
+        self.statement_timeout = statement_timeout
+
+    def create_engine(self, db_type: str, db_name: str, db_creds: dict):
+        if db_type != "postgres":
+            raise ValueError(f"Invalid db_type: {db_type}")
+        db_url = f"postgresql://{db_creds['user']}:{db_creds['password']}@{db_creds['host']}:{db_creds['port']}/{db_name}"
+        connect_args = {}
+        if self.statement_timeout:
+            connect_args["options"] = (
+                f"-c statement_timeout={int(self.statement_timeout * 1000)}"
+            )
+        engine = create_engine(
+            db_url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_pre_ping=self.pool_pre_ping,
+            connect_args=connect_args,
+        )
+        event.listen(engine, "connect", self.on_connect)
+        event.listen(engine, "checkout", self.on_checkout)
+        return engine
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.num_connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.num_checkouts += 1
+
+    def get_engine(self, db_type: str, db_name: str, db_creds: dict):
+        with self.lock:
+            engine = self.engines.get((db_type, db_name))
+            if engine is None:
+                engine = self.create_engine(db_type, db_name, db_creds)
+                self.engines[(db_type, db_name)] = engine
+            return engine
+
+    def dispose(self):
+        with self.lock:
+            engines = list(self.engines.values())
+            self.engines = {}
+        for engine in engines:
+            engine.dispose()
+
+    def stats(self) -> dict:
+        """
+        Returns the number of engines, connections opened and connections checked out so far,
+        and the current status of each engine's pool.
+        """
+        with self.lock:
+            return {
+                "num_engines": len(self.engines),
+                "num_connects": self.num_connects,
+                "num_checkouts": self.num_checkouts,
+                "pools": {
+                    f"{db_type}/{db_name}": engine.pool.status()
+                    for (db_type, db_name), engine in self.engines.items()
+                },
+            }
+
+
+ENGINE_POOL = EnginePool()
+
+
+class ResultTooLargeError(Exception):
+    """
+    Raised when a query returns more rows than it is allowed to.
+    """
+
+
+class ColumnMismatchError(Exception):
+    """
+    Raised when a query returns fewer columns than it needs to match the gold result.
+    """
+
+
+def read_sql_chunked(
+    query: str,
+    engine,
+    max_rows: int = None,
+    min_columns: int = None,
+    chunk_size: int = 10000,
+) -> pd.DataFrame:
+    """
+    Fetches the result of query chunk_size rows at a time from a server side cursor, and stops
+    as soon as it has more than max_rows rows or fewer than min_columns columns, so that huge
+    results (eg from an accidental cross join) are never fully materialized.
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        chunks = []
+        num_rows = 0
+        for chunk in pd.read_sql_query(query, conn, chunksize=chunk_size):
+            if min_columns is not None and chunk.shape[1] < min_columns:
+                raise ColumnMismatchError(
+                    f"{chunk.shape[1]} columns, expected at least {min_columns}"
+                )
+            num_rows += len(chunk)
+            if max_rows is not None and num_rows > max_rows:
+                raise ResultTooLargeError(f"more than {max_rows} rows")
+            chunks.append(chunk)
+    if len(chunks) == 1:
+        return chunks[0]
+    # dtypes are inferred per chunk, eg a float column whose first chunk is all NULL is read as
+    # object there, so infer them again over all rows like a single read_sql_query would
+    return pd.concat(chunks, ignore_index=True).infer_objects()
+
+
+def query_postgres_db(
+    query: str,
+    db_name: str,
+    db_creds: dict = None,
+    timeout: float = 10.0,
+    decimal_points: int = None,
+    max_rows: int = None,
+    min_columns: int = None,
+) -> pd.DataFrame:
+    """
+    Runs query on postgres db and returns results as a dataframe.
+    Connections come from the shared ENGINE_POOL.
+    timeout: time in seconds to wait for query to finish before timing out
+    decimal_points: number of decimal points to round floats to
+    max_rows / min_columns: if set, the result is streamed in chunks (see read_sql_chunked),
+    raising ResultTooLargeError / ColumnMismatchError as soon as it goes over / under them
+    """
+    if db_creds is None:
+        db_creds = db_creds_all["postgres"]
+    engine = ENGINE_POOL.get_engine("postgres", db_name, db_creds)
+    escaped_query = re.sub(
+        LIKE_PATTERN, escape_percent, query, flags=re.IGNORECASE
+    )  # ignore case of LIKE
+    if max_rows is None and min_columns is None:
+        results_df = func_timeout(
+            timeout, pd.read_sql_query, args=(escaped_query, engine)
+        )
+    else:
+        results_df = func_timeout(
+            timeout,
+            read_sql_chunked,
+            args=(escaped_query, engine, max_rows, min_columns),
+        )
+    # round floats to decimal_points
+    if decimal_points:
+        results_df = results_df.round(decimal_points)
+    return results_df
+
+
+# splits a query into quoted literals/identifiers and the text between them
+QUOTED_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Normalizes a query for use as a cache key by collapsing whitespace, lowercasing everything
+    outside of quoted literals and identifiers (which are case sensitive), and dropping
+    trailing semicolons.
+    """
+    parts = QUOTED_PATTERN.split(query.strip().rstrip(";").strip())
+    # odd indices are the quoted parts captured by the split
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part).lower()
+        for i, part in enumerate(parts)
+    )
+
+
+def get_postgres_schema_fingerprint(db_name: str, db_creds: dict = None) -> str:
+    """
+    Returns a hash of the tables, columns and column types of a postgres database.
+    """
+    schema_df = query_postgres_db(
+        """
+        SELECT table_schema, table_name, column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema NOT IN ('pg_catalog', 'information_schema')
+        ORDER BY table_schema, table_name, ordinal_position
+        """,
+        db_name,
+        db_creds,
+    )
+    return hashlib.sha1(schema_df.to_csv(index=False).encode()).hexdigest()[:16]
+
+
+class GoldResultCache:
+    """
+    Persistent on-disk cache of executed gold query results, stored as one parquet file per
+    query and memory-mapped when loaded.
+    Results are keyed by (db_type, db_name, normalized sql, decimal_points), and stored under a
+    directory named after the database's schema fingerprint, so that changing the schema of a
+    database invalidates its cached results.
+    schema_fingerprint_fn(db_name, db_type, db_creds) -> str can be overridden, eg to pin the
+    fingerprint to a dump's version instead of querying the database's schema.
+    """
+
+    def __init__(self, cache_dir: str, schema_fingerprint_fn=None):
+        self.cache_dir = cache_dir
+        self.schema_fingerprint_fn = (
+            schema_fingerprint_fn or self.default_schema_fingerprint
+        )
+        self.schema_fingerprints = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def default_schema_fingerprint(db_name: str, db_type: str, db_creds: dict) -> str:
+        if db_type == "postgres":
+            return get_postgres_schema_fingerprint(db_name, db_creds)
+        raise ValueError(f"Invalid db_type: {db_type}")
+
+    def get_db_dir(self, db_name: str, db_type: str, db_creds: dict) -> str:
+        with self.lock:
+            fingerprint = self.schema_fingerprints.get((db_type, db_name))
+        if fingerprint is None:
+            fingerprint = self.schema_fingerprint_fn(db_name, db_type, db_creds)
+            with self.lock:
+                self.schema_fingerprints[(db_type, db_name)] = fingerprint
+        return os.path.join(self.cache_dir, db_type, db_name, fingerprint)
+
+    def get_path(
+        self,
+        query: str,
+        db_name: str,
+        db_type: str,
+        db_creds: dict,
+        decimal_points: int = None,
+    ) -> str:
+        key = f"{normalize_sql(query)}\n{decimal_points}"
+        filename = hashlib.sha1(key.encode()).hexdigest() + ".parquet"
+        return os.path.join(self.get_db_dir(db_name, db_type, db_creds), filename)
+
+    def invalidate(self, db_name: str, db_type: str, db_creds: dict = None):
+        """
+        Recomputes the schema fingerprint of a database and deletes cached results stored under
+        any other fingerprint.
+        """
+        with self.lock:
+            self.schema_fingerprints.pop((db_type, db_name), None)
+        db_dir = self.get_db_dir(db_name, db_type, db_creds)
+        parent_dir = os.path.dirname(db_dir)
+        for fingerprint_dir in os.listdir(parent_dir) if os.path.isdir(parent_dir) else []:
+            stale_dir = os.path.join(parent_dir, fingerprint_dir)
+            if stale_dir == db_dir:
+                continue
+            for filename in os.listdir(stale_dir):
+                os.remove(os.path.join(stale_dir, filename))
+            os.rmdir(stale_dir)
+
+    def query(
+        self,
+        query: str,
+        db_name: str,
+        db_type: str,
+        db_creds: dict,
+        timeout: float = 10.0,
+        decimal_points: int = None,
+    ) -> pd.DataFrame:
+        """
+        Returns the cached result of query, executing and caching it on a miss.
+        """
+        path = self.get_path(query, db_name, db_type, db_creds, decimal_points)
+        if os.path.exists(path):
+            with self.lock:
+                self.hits += 1
+            return pd.read_parquet(path, memory_map=True)
+        with self.lock:
+            self.misses += 1
+        if db_type != "postgres":
+            raise ValueError(f"Invalid db_type: {db_type}")
+        results_df = query_postgres_db(query, db_name, db_creds, timeout, decimal_points)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that concurrent readers never see a partial file
+        # the pid keeps processes that share the cache directory from writing the same file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            results_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            # eg duplicate column names or mixed types, which parquet can't store
+            print(f"Not caching gold result for {db_name}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return results_df
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def compare_results(
+    results_gold: pd.DataFrame,
+    results_gen: pd.DataFrame,
+    query_category: str,
+    question: str,
+    query_gold: str = None,
+    query_gen: str = None,
+    timer: PhaseTimer = None,
+) -> "tuple[bool, bool]":
+    """
+    Returns (exact match, gold is a subset of gen) for two query results.
+    subset_df is only run if the results don't match exactly.
+    If timer is given, the comparison is timed in its "compare" phase.
+    """
+    timer = timer or PhaseTimer()
+    with timer.phase("compare"):
+        if compare_df(
+            results_gold,
+            results_gen,
+            query_category,
+            question,
+            query_gold,
+            query_gen,
+            timer=timer,
+        ):
+            return True, True
+        return False, subset_df(
+            results_gold, results_gen, query_category, question, query_gen, query_gold
+        )
+
+
+def read_shared_frame(view: memoryview) -> pd.DataFrame:
+    """
+    Reads a dataframe written to shared memory by ComparisonPool.share as an Arrow IPC stream.
+    The returned dataframe points into view, so it must be dropped before view is released.
+    """
+    import pyarrow as pa
+
+    return pa.ipc.open_stream(pa.py_buffer(view)).read_all().to_pandas()
+
+
+def compare_shared_frames(
+    handle_gold: dict,
+    handle_gen: dict,
+    query_category: str,
+    question: str,
+    query_gold: str = None,
+    query_gen: str = None,
+) -> "tuple[bool, bool, dict]":
+    """
+    compare_results for frames in shared memory. Runs in ComparisonPool's worker processes.
+    Also returns the phase times of the comparison, which the caller adds to its own timer.
+    """
+    # workers share the resource tracker of the process that created the pool, which also
+    # unlinks the blocks, so attaching to them here doesn't leak them
+    handles = [handle_gold, handle_gen]
+    blocks = [shared_memory.SharedMemory(name=handle["name"]) for handle in handles]
+    views = [shm.buf[: handle["size"]] for shm, handle in zip(blocks, handles)]
+    timer = PhaseTimer()
+    try:
+        results_gold, results_gen = [read_shared_frame(view) for view in views]
+        exact_match, subset = compare_results(
+            results_gold,
+            results_gen,
+            query_category,
+            question,
+            query_gold,
+            query_gen,
+            timer,
+        )
+        # drop the frames before closing the blocks they point into
+        del results_gold, results_gen
+        return exact_match, subset, timer.as_dict()
+    finally:
+        for view, shm in zip(views, blocks):
+            try:
+                view.release()
+                shm.close()
+            except BufferError:
+                # still referenced from a traceback, closed once that is collected
+                pass
+
+
+def limit_worker_memory(max_memory_mb: int):
+    """
+    Initializer for ComparisonPool's worker processes. Caps the address space of the process,
+    so that a comparison that needs too much memory fails with a MemoryError in that worker
+    instead of getting the whole eval run OOM-killed.
+    """
+    if max_memory_mb:
+        import resource
+
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+class ComparisonPool:
+    """
+    Runs compare_results in a pool of worker processes, so that comparisons (pure pandas CPU
+    work) aren't serialized by the GIL of the eval process.
+    Frames are passed to the workers as Arrow IPC streams in shared memory blocks rather than
+    pickled. Frames that Arrow can't represent (eg duplicate column names or mixed object
+    columns) are compared in the calling process instead.
+    max_worker_memory_mb caps the memory of each worker process.
+    """
+
+    def __init__(self, max_workers: int = None, max_worker_memory_mb: int = None):
+        self.max_workers = max_workers
+        self.max_worker_memory_mb = max_worker_memory_mb
+        self.lock = threading.Lock()
+        self.executor = self.create_executor()
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # the eval harness is multithreaded, which doesn't mix well with fork
+        return ProcessPoolExecutor(
+            self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=limit_worker_memory,
+            initargs=(self.max_worker_memory_mb,),
+        )
+
+    def share(self, df: pd.DataFrame) -> "tuple[shared_memory.SharedMemory, dict] | None":
+        """
+        Writes df to a new shared memory block. Returns the block and a picklable handle to it,
+        or None if df can't be converted to Arrow.
+        """
+        import pyarrow as pa
+
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowException, ValueError, TypeError):
+            return None
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        buf = sink.getvalue()
+        shm = shared_memory.SharedMemory(create=True, size=max(buf.size, 1))
+        shm.buf[: buf.size] = memoryview(buf).cast("B")
+        return shm, {"name": shm.name, "size": buf.size}
+
+    @staticmethod
+    def release(shared: "tuple[shared_memory.SharedMemory, dict]"):
+        shm, _ = shared
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            # a worker that failed to map the block unlinks it on the way out
+            pass
+
+    def compare(
+        self,
+        results_gold: pd.DataFrame,
+        shared_gen: "tuple[shared_memory.SharedMemory, dict] | None",
+        results_gen: pd.DataFrame,
+        query_category: str,
+        question: str,
+        query_gold: str = None,
+        query_gen: str = None,
+        timer: PhaseTimer = None,
+    ) -> "tuple[bool, bool]":
+        """
+        compare_results in a worker process. shared_gen is results_gen as returned by share(),
+        so that it can be shared once for all the gold queries it's compared with.
+        The "compare" phase of timer includes the time spent waiting for a worker.
+        """
+        timer = timer or PhaseTimer()
+        shared_gold = self.share(results_gold) if shared_gen is not None else None
+        if shared_gold is None:
+            return compare_results(
+                results_gold,
+                results_gen,
+                query_category,
+                question,
+                query_gold,
+                query_gen,
+                timer,
+            )
+        try:
+            with self.lock:
+                executor = self.executor
+            try:
+                future = executor.submit(
+                    compare_shared_frames,
+                    shared_gold[1],
+                    shared_gen[1],
+                    query_category,
+                    question,
+                    query_gold,
+                    query_gen,
+                )
+                with timer.phase("compare"):
+                    exact_match, subset, seconds = future.result()
+                    seconds.pop("compare", None)
+                    timer.add(seconds)
+                return exact_match, subset
+            except BrokenProcessPool:
+                # a worker died, eg killed for using too much memory. replace the pool so that
+                # other comparisons can carry on, and fail this one
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = self.create_executor()
+                raise
+        finally:
+            self.release(shared_gold)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def compare_query_results(
+    query_gold: str,
+    query_gen: str,
+    db_name: str,
+    db_type: str,
+    db_creds: dict,
+    question: str,
+    query_category: str,
+    table_metadata_string: str = "",
+    timeout: float = 10.0,
+    decimal_points: int = None,
+    project_columns: bool = True,
+    gold_cache: GoldResultCache = None,
+    comparison_pool: ComparisonPool = None,
+    timer: PhaseTimer = None,
+    result_row_multiple: float = None,
+    min_result_rows: int = 10000,
+) -> "tuple[bool, bool]":
+    """
+    Compares the results of two queries and returns a tuple of booleans, where the first element is
+    whether the queries produce exactly the same result, and the second element is whether the
+    result of the gold query is a subset of the result of the generated query (still correct).
+    Gold queries are expanded lazily and executed one at a time, and we stop at the first exact match.
+    If project_columns is True, gold queries that only differ in their { } column subset are
+    executed once with all columns, and each subset is taken from that result in memory.
+    If gold_cache is given, gold results are read from / written to it instead of always being
+    executed against the database.
+    If comparison_pool is given, results are compared in its worker processes.
+    If timer is given, the time spent executing queries and comparing results is recorded in it.
+    If result_row_multiple is given, the first gold query is executed before the generated
+    query, and the generated result is streamed and aborted with ResultTooLargeError once it
+    has more than result_row_multiple times as many rows as the gold result (and at least
+    min_result_rows). Duplicate rows are ignored when comparing, so the multiple should leave
+    room for them. If the gold query has no ; alternatives, a generated result with fewer
+    columns than the first (narrowest) gold result is also aborted, as it can't match.
+    We bubble up exceptions (mostly from query_postgres_db) to be handled in the runner.
+    """
+    if db_type != "postgres":
+        raise ValueError(f"Invalid db_type: {db_type}")
+    timer = timer or PhaseTimer()
+
+    def query_gold_db(query: str) -> pd.DataFrame:
+        with timer.phase("gold_exec"):
+            if gold_cache is not None:
+                return gold_cache.query(
+                    query, db_name, db_type, db_creds, timeout, decimal_points
+                )
+            return query_postgres_db(query, db_name, db_creds, timeout, decimal_points)
+
+    base_results = {}
+
+    def get_results_gold(
+        q: str, base_query: str, column_indices: "list[int]", num_options: int
+    ) -> pd.DataFrame:
+        if project_columns and base_query is not None:
+            if base_query not in base_results:
+                base_results[base_query] = query_gold_db(base_query)
+            results_base = base_results[base_query]
+            # each option must map to exactly one column, eg not t.*
+            if results_base.shape[1] == num_options:
+                return results_base.iloc[:, column_indices]
+        return query_gold_db(q)
+
+    expansions = iter_minimal_queries(query_gold)
+    first_expansion = first_results_gold = None
+    max_rows = min_columns = None
+    if result_row_multiple is not None:
+        first_expansion = next(expansions, None)
+        if first_expansion is not None:
+            first_results_gold = get_results_gold(*first_expansion)
+            expansions = itertools.chain([first_expansion], expansions)
+            max_rows = max(
+                int(result_row_multiple * len(first_results_gold)), min_result_rows
+            )
+            gold_parts = {part.strip() for part in query_gold.split(";")} - {""}
+            if len(gold_parts) == 1:
+                min_columns = first_results_gold.shape[1]
+
+    with timer.phase("gen_exec"):
+        try:
+            results_gen = query_postgres_db(
+                query_gen,
+                db_name,
+                db_creds,
+                timeout,
+                decimal_points,
+                max_rows=max_rows,
+                min_columns=min_columns,
+            )
+        except ColumnMismatchError:
+            return (False, False)
+
+    # the generated result is compared with every gold query, so share it once
+    with timer.phase("compare"):
+        shared_gen = comparison_pool.share(results_gen) if comparison_pool else None
+    correct = False
+    try:
+        for expansion in expansions:
+            q = expansion[0]
+            if expansion is first_expansion:
+                results_gold = first_results_gold
+            else:
+                results_gold = get_results_gold(*expansion)
+            if comparison_pool is not None:
+                exact_match, subset = comparison_pool.compare(
+                    results_gold,
+                    shared_gen,
+                    results_gen,
+                    query_category,
+                    question,
+                    q,
+                    query_gen,
+                    timer,
+                )
+            else:
+                exact_match, subset = compare_results(
+                    results_gold,
+                    results_gen,
+                    query_category,
+                    question,
+                    q,
+                    query_gen,
+                    timer,
+                )
+            if exact_match:
+                return (True, True)
+            elif subset:
+                correct = True
+    finally:
+        if shared_gen is not None:
+            comparison_pool.release(shared_gen)
+    return (False, correct)
+
+
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import hashlib
 import os
+import queue
+import random
+import threading
+import time
 
-from eval.eval import compare_query_results
 import pandas as pd
 from psycopg2.extensions import QueryCanceledError
 from query_generators.openai import OpenAIQueryGenerator
@@ -265,6 +1413,667 @@ from utils.creds import db_creds_all
 from utils.reporting import upload_results
 
 
+class PipelineStage:
+    """
+    A pool of worker threads that applies func to items taken from input_queue and puts
+    (result, error) pairs on output_queue. A bounded output_queue blocks the workers when the
+    next stage falls behind, which provides backpressure between stages.
+    Items that arrive with an error from a previous stage are passed through untouched.
+    """
+
+    STOP = object()
+
+    def __init__(self, name, func, num_workers, input_queue, output_queue):
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.threads = []
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.num_items = 0
+        self.busy_seconds = 0.0
+        self.start_time = None
+        self.end_time = None
+        self.max_queue_depth = 0
+        self.total_queue_depth = 0
+
+    def start(self):
+        self.start_time = time.time()
+        for _ in range(self.num_workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for _ in self.threads:
+            self.input_queue.put(self.STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def cancel(self):
+        """
+        Makes the workers exit without processing the remaining items, eg after an error.
+        """
+        self.cancelled.set()
+
+    def work(self):
+        while not self.cancelled.is_set():
+            try:
+                item = self.input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self.STOP:
+                return
+            value, error = item
+            start = time.time()
+            if error is None:
+                try:
+                    value = self.func(value)
+                except Exception as e:
+                    error = e
+            self.put_result((value, error), start, time.time())
+
+    def put_result(self, item, start: float, end: float):
+        # don't block forever on a full queue if the stage gets cancelled
+        while not self.cancelled.is_set():
+            try:
+                self.output_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        # sample the depth of the queue we feed right after adding to it
+        queue_depth = self.output_queue.qsize()
+        with self.lock:
+            self.num_items += 1
+            self.busy_seconds += end - start
+            self.end_time = end
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            self.total_queue_depth += queue_depth
+
+    def stats(self) -> str:
+        with self.lock:
+            wall_seconds = (self.end_time or time.time()) - self.start_time
+            throughput = self.num_items / wall_seconds if wall_seconds > 0 else 0.0
+            mean_queue_depth = (
+                self.total_queue_depth / self.num_items if self.num_items else 0.0
+            )
+            return (
+                f"{self.name}: {self.num_items} items with {self.num_workers} workers "
+                f"in {wall_seconds:.1f}s ({throughput:.2f} items/s, "
+                f"{self.busy_seconds:.1f} worker-seconds busy), "
+                f"output queue depth max {self.max_queue_depth} mean {mean_queue_depth:.1f}"
+            )
+
+
+class AsyncPipelineStage(PipelineStage):
+    """
+    Like PipelineStage, but func is a coroutine function run on an asyncio event loop in a single
+    thread, with up to num_workers items in flight. func is expected to limit its own
+    concurrency further, eg with an AdaptiveRateLimiter.
+    """
+
+    def start(self):
+        self.start_time = time.time()
+        thread = threading.Thread(
+            target=lambda: asyncio.run(self.run_loop()), daemon=True
+        )
+        thread.start()
+        self.threads.append(thread)
+
+    async def run_loop(self):
+        loop = asyncio.get_running_loop()
+        # one thread per item in flight, plus one to wait on the input queue
+        loop.set_default_executor(ThreadPoolExecutor(self.num_workers + 1))
+        in_flight = asyncio.Semaphore(self.num_workers)
+        tasks = set()
+        while not self.cancelled.is_set():
+            try:
+                item = await asyncio.to_thread(self.input_queue.get, timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self.STOP:
+                break
+            await in_flight.acquire()
+            task = asyncio.create_task(self.process(item, in_flight))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def process(self, item, in_flight: asyncio.Semaphore):
+        try:
+            value, error = item
+            start = time.time()
+            if error is None:
+                try:
+                    value = await self.func(value)
+                except Exception as e:
+                    error = e
+            await asyncio.to_thread(self.put_result, (value, error), start, time.time())
+        finally:
+            in_flight.release()
+
+
+# matches the errors returned or raised by the openai client when we hit a rate limit
+RATE_LIMIT_PATTERN = re.compile(r"\b429\b|rate.?limit", re.IGNORECASE)
+
+
+def is_rate_limit_error(err) -> bool:
+    if isinstance(err, Exception) and type(err).__name__ == "RateLimitError":
+        return True
+    return bool(err) and bool(RATE_LIMIT_PATTERN.search(str(err)))
+
+
+class TokenBucket:
+    """
+    Token bucket that refills at rate_per_minute, up to capacity (one minute's worth by default).
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount: float) -> float:
+        """
+        Consumes amount and returns 0 if it is available, otherwise returns the number of
+        seconds to wait before trying again.
+        """
+        with self.lock:
+            self.refill()
+            # amounts bigger than the bucket would never fit, so let them through when it's full
+            amount = min(amount, self.capacity)
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def adjust(self, amount: float):
+        """
+        Consumes (or gives back, if negative) amount without waiting, eg to correct an estimate.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits LLM requests for asyncio code in two ways:
+    - concurrency: an AIMD window of requests in flight, which grows by one request per window
+      of successful requests up to max_concurrency, and halves on every rate limit error
+    - rate: token buckets on requests per minute and tokens per minute (either can be None).
+      Tokens are reserved with a running estimate of tokens per request and corrected with
+      the actual usage once the request returns. burst_seconds sets how many seconds' worth of
+      requests/tokens can be used at once.
+    After a rate limit error, new requests wait with an exponential backoff. Errors from requests
+    that were already in flight during a backoff don't shrink the window or the backoff again.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        min_concurrency: int = 1,
+        tokens_estimate: float = 1000,
+        max_backoff_seconds: float = 60.0,
+        burst_seconds: float = 60.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.request_bucket = (
+            TokenBucket(requests_per_minute, requests_per_minute * burst_seconds / 60)
+            if requests_per_minute
+            else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute, tokens_per_minute * burst_seconds / 60)
+            if tokens_per_minute
+            else None
+        )
+        self.tokens_estimate = tokens_estimate
+        self.max_backoff_seconds = max_backoff_seconds
+        self.in_flight = 0
+        self.consecutive_rate_limits = 0
+        self.backoff_until = 0.0
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        # asyncio primitives belong to one event loop, and every prompt file runs its own, so
+        # the condition is created per loop while the counters and buckets are shared
+        self.condition = None
+        self.condition_loop = None
+
+    def get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self.condition_loop is not loop:
+            self.condition = asyncio.Condition()
+            self.condition_loop = loop
+        return self.condition
+
+    def reserve(self, tokens: float) -> float:
+        """
+        Reserves one request and tokens from the buckets. Returns 0 on success, otherwise the
+        number of seconds to wait before trying again.
+        """
+        if self.request_bucket is not None:
+            wait = self.request_bucket.try_consume(1)
+            if wait > 0:
+                return wait
+        if self.token_bucket is not None:
+            wait = self.token_bucket.try_consume(tokens)
+            if wait > 0:
+                if self.request_bucket is not None:
+                    self.request_bucket.adjust(-1)
+                return wait
+        return 0.0
+
+    async def acquire(self) -> float:
+        """
+        Waits until a request can be made, and returns the number of tokens reserved for it.
+        """
+        condition = self.get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+        tokens = self.tokens_estimate
+        while True:
+            wait = self.backoff_until - time.monotonic()
+            if wait <= 0:
+                wait = self.reserve(tokens)
+            if wait <= 0:
+                return tokens
+            await asyncio.sleep(wait)
+
+    async def release(
+        self, tokens_reserved: float, tokens_used: float = None, rate_limited: bool = False
+    ):
+        """
+        Records the outcome of a request made after acquire().
+        """
+        self.num_requests += 1
+        if tokens_used is not None:
+            if self.token_bucket is not None:
+                self.token_bucket.adjust(tokens_used - tokens_reserved)
+            self.tokens_estimate = 0.8 * self.tokens_estimate + 0.2 * tokens_used
+        if rate_limited:
+            self.num_rate_limited += 1
+        if rate_limited and time.monotonic() >= self.backoff_until:
+            self.consecutive_rate_limits += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            backoff = min(self.max_backoff_seconds, 2**self.consecutive_rate_limits)
+            # jitter so that waiting requests don't all retry at the same time
+            self.backoff_until = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+        elif not rate_limited:
+            self.consecutive_rate_limits = 0
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1 / self.concurrency
+            )
+        condition = self.get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def stats(self) -> str:
+        return (
+            f"rate limiter: {self.num_requests} requests, {self.num_rate_limited} rate limited, "
+            f"concurrency {self.concurrency:.1f}/{self.max_concurrency}, "
+            f"{self.tokens_estimate:.0f} tokens per request"
+        )
+
+
+def truncate_partial_line(path: str):
+    """
+    Truncates a file to its last complete line, eg after a crash in the middle of a write, so
+    that lines appended to it aren't glued onto the partial one.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - 65536)
+            f.seek(start)
+            newline = f.read(pos - start).rfind(b"\n")
+            if newline != -1:
+                if start + newline + 1 < end:
+                    f.truncate(start + newline + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+
+class JsonlResultSink:
+    """
+    Append-only sink that writes each finished row as one JSON line and flushes it immediately,
+    so that a crash mid-run loses nothing and rows don't need to be held in memory.
+    The file is never truncated, so it also keeps the rows of earlier (eg crashed) runs. Rows
+    are keyed by db_name, question and gold query, and read returns the latest row of each key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.num_rows = 0
+        output_dir = os.path.dirname(path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        truncate_partial_line(path)
+        self.f = open(path, "a")
+
+    def write(self, row: dict):
+        self.f.write(json.dumps(row, default=str) + "\n")
+        self.f.flush()
+        self.num_rows += 1
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def row_key(row: dict) -> str:
+        key = json.dumps([row["db_name"], row["question"], row["query"]])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def keys(self) -> set:
+        """
+        Returns the keys of the rows in the file, including those of earlier runs.
+        """
+        with open(self.path, "r") as f:
+            return {JsonlResultSink.row_key(json.loads(line)) for line in f}
+
+    def read(self, keys: "list[str]" = None) -> pd.DataFrame:
+        """
+        Reads the rows in the file back into a dataframe, keeping the last row written for each
+        key, and only the rows with one of keys if given.
+        """
+        # keep values as written, eg don't turn numeric-looking strings into numbers
+        df = pd.read_json(self.path, lines=True, dtype=False, convert_dates=False)
+        row_keys = pd.Series(
+            [JsonlResultSink.row_key(row) for row in df.to_dict("records")], dtype=object
+        )
+        latest = ~row_keys.duplicated(keep="last")
+        if keys is not None:
+            latest &= row_keys.isin(keys)
+        return df[latest.to_numpy()].reset_index(drop=True)
+
+
+# errors of the database connection rather than of the query, which can pass on a retry
+CONNECTION_ERROR_PATTERN = re.compile(
+    r"\b(OperationalError|InterfaceError)\b|could not connect|server closed the connection"
+    r"|connection (refused|reset|timed out|already closed)",
+    re.IGNORECASE,
+)
+
+
+class EvalCheckpoint:
+    """
+    Append-only JSONL store of generated queries and scored rows for one (prompt file, model)
+    pair, so that an interrupted run can be restarted without paying for finished work again.
+    Rows are keyed by db_name, question and gold query. Generation errors are not checkpointed,
+    so that they're retried on restart, and rows that timed out or lost their database
+    connection are only checkpointed as generated, so that they're executed again.
+    """
+
+    def __init__(self, checkpoint_dir: str, prompt_file: str, model: str):
+        with open(prompt_file, "rb") as f:
+            prompt_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+        model_name = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.path = os.path.join(checkpoint_dir, f"{prompt_hash}_{model_name}.jsonl")
+        self.generated = {}
+        self.scored = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partially written last line from a crash
+                    if entry["kind"] == "generated":
+                        self.generated[entry["key"]] = entry["value"]
+                    else:
+                        self.scored[entry["key"]] = entry["value"]
+        self.lock = threading.Lock()
+        # so that the first entry isn't appended to a partially written line
+        truncate_partial_line(self.path)
+        self.f = open(self.path, "a")
+
+    # keyed like the result sink, so that restored rows can be matched to the rows it has
+    row_key = staticmethod(JsonlResultSink.row_key)
+
+    def get_generated(self, row: dict) -> "dict | None":
+        return self.generated.get(self.row_key(row))
+
+    def get_scored(self, row: dict) -> "dict | None":
+        return self.scored.get(self.row_key(row))
+
+    def write(self, kind: str, row: dict, value: dict):
+        line = json.dumps(
+            {"kind": kind, "key": self.row_key(row), "value": value}, default=str
+        )
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+
+    def save_generated(self, row: dict, result_dict: dict):
+        if "GENERATION ERROR" not in result_dict["err"]:
+            self.write("generated", row, result_dict)
+
+    def save_scored(self, row: dict):
+        if row.get("error_query_gen") or row.get("timeout"):
+            return
+        if row.get("error_db_exec") and CONNECTION_ERROR_PATTERN.search(
+            row.get("error_msg") or ""
+        ):
+            return
+        self.write("scored", row, row)
+
+    def close(self):
+        self.f.close()
+
+
+def generate_query_for_row(
+    row: dict, args, prompt_file: str, generator_cls=None
+) -> dict:
+    """
+    Generates a query for a question row and returns the generator's result dict.
+    generator_cls defaults to OpenAIQueryGenerator, and can be swapped for a stub with the
+    same interface, eg for offline benchmarks.
+    The time spent building the prompt and calling the LLM is saved in the result's
+    phase_seconds, so that it is checkpointed along with the query.
+    """
+    start = time.perf_counter()
+    # get db creds for each row's db_name
+    db_name = row["db_name"]
+    db_creds = db_creds_all[row["db_type"]]
+
+    qg = (generator_cls or OpenAIQueryGenerator)(
+        db_creds=copy.deepcopy(db_creds),
+        db_name=db_name,
+        db_type=args.db_type,
+        model=args.model,
+        prompt_file=prompt_file,
+        timeout=args.timeout_gen,
+        use_public_data=not args.use_private_data,
+        verbose=args.verbose,
+    )
+
+    generate_start = time.perf_counter()
+    result_dict = qg.generate_query(
+        question=row["question"],
+        instructions=row["instructions"],
+        k_shot_prompt=row["k_shot_prompt"],
+        glossary=row["glossary"],
+        table_metadata_string=row["table_metadata_string"],
+        prev_invalid_sql=row["prev_invalid_sql"],
+        prev_error_msg=row["prev_error_msg"],
+        cot_instructions=row["cot_instructions"],
+        columns_to_keep=args.num_columns,
+        shuffle=args.shuffle_metadata,
+    )
+    end = time.perf_counter()
+    # generate_query builds the prompt and then calls the LLM. when the generator reports the
+    # latency of the call, the rest of generate_query was spent building the prompt
+    llm_seconds = min(
+        result_dict.get("latency_seconds") or end - generate_start, end - generate_start
+    )
+    result_dict["phase_seconds"] = {
+        "prompt_build": end - start - llm_seconds,
+        "llm_call": llm_seconds,
+    }
+    return result_dict
+
+
+def generate_or_load(
+    row: dict, args, prompt_file: str, checkpoint: EvalCheckpoint = None
+) -> dict:
+    """
+    Returns the checkpointed generation result for row if there is one, otherwise generates
+    a query and checkpoints the result.
+    """
+    if checkpoint is None:
+        return generate_query_for_row(row, args, prompt_file)
+    result_dict = checkpoint.get_generated(row)
+    if result_dict is None:
+        result_dict = generate_query_for_row(row, args, prompt_file)
+        checkpoint.save_generated(row, result_dict)
+    return result_dict
+
+
+async def generate_query_async(
+    row: dict,
+    args,
+    prompt_file: str,
+    limiter: AdaptiveRateLimiter,
+    checkpoint: EvalCheckpoint = None,
+    generator_cls=None,
+    max_retries: int = 5,
+) -> dict:
+    """
+    Async version of generate_or_load. Each request waits for the limiter, and requests that
+    hit a rate limit are retried up to max_retries times.
+    The generator itself is synchronous, so it runs in the event loop's thread pool.
+    """
+    if checkpoint is not None:
+        result_dict = checkpoint.get_generated(row)
+        if result_dict is not None:
+            return result_dict
+    for attempt in range(max_retries + 1):
+        tokens_reserved = await limiter.acquire()
+        try:
+            result_dict = await asyncio.to_thread(
+                generate_query_for_row, row, args, prompt_file, generator_cls
+            )
+        except Exception as e:
+            await limiter.release(tokens_reserved, rate_limited=is_rate_limit_error(e))
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            continue
+        rate_limited = is_rate_limit_error(result_dict["err"])
+        await limiter.release(
+            tokens_reserved, result_dict.get("tokens_used"), rate_limited
+        )
+        if not rate_limited:
+            break
+    if checkpoint is not None:
+        checkpoint.save_generated(row, result_dict)
+    return result_dict
+
+
+def score_row(
+    row: dict,
+    result_dict: dict,
+    args,
+    gold_cache: GoldResultCache = None,
+    comparison_pool: ComparisonPool = None,
+) -> dict:
+    """
+    Saves the generator's result into row, then executes the generated and gold queries and
+    saves whether they match. Returns row.
+    The time spent in each phase (see PHASES) is saved in the row's <phase>_ms columns.
+    Generated queries whose result is too large (see compare_query_results) are flagged in
+    result_too_large rather than error_db_exec.
+    """
+    timer = PhaseTimer()
+    timer.add(result_dict.get("phase_seconds", {}))
+    query_gen = result_dict["query"]
+    reason = result_dict["reason"]
+    err = result_dict["err"]
+    table_metadata_string = result_dict["table_metadata_string"]
+    # save custom metrics
+    if "latency_seconds" in result_dict:
+        row["latency_seconds"] = result_dict["latency_seconds"]
+    if "tokens_used" in result_dict:
+        row["tokens_used"] = result_dict["tokens_used"]
+    row["generated_query"] = query_gen
+    row["reason"] = reason
+    row["error_msg"] = err
+    row["table_metadata_string"] = table_metadata_string
+    row["result_too_large"] = 0
+    # save failures into relevant columns in the dataframe
+    if "GENERATION ERROR" in err:
+        row["error_query_gen"] = 1
+    elif "EXECUTION ERROR" in err:
+        row["error_db_exec"] = 1
+    elif "TIMEOUT" in err:
+        row["timeout"] = 1
+    else:
+        expected_query = row["query"]
+        db_name = row["db_name"]
+        db_type = row["db_type"]
+        question = row["question"]
+        query_category = row["query_category"]
+        table_metadata_string = row["table_metadata_string"]
+        exact_match = correct = 0
+        db_creds = db_creds_all[db_type]
+        # try executing the queries and compare the results if they succeed
+        try:
+            exact_match, correct = compare_query_results(
+                query_gold=expected_query,
+                query_gen=query_gen,
+                db_name=db_name,
+                db_type=db_type,
+                db_creds=db_creds,
+                timeout=args.timeout_exec,
+                question=question,
+                query_category=query_category,
+                table_metadata_string=table_metadata_string,
+                decimal_points=args.decimal_points,
+                gold_cache=gold_cache,
+                comparison_pool=comparison_pool,
+                timer=timer,
+                result_row_multiple=getattr(args, "result_row_multiple", None),
+                min_result_rows=getattr(args, "min_result_rows", None) or 10000,
+            )
+            row["exact_match"] = int(exact_match)
+            row["correct"] = int(correct)
+            row["error_msg"] = ""
+        except QueryCanceledError as e:
+            row["timeout"] = 1
+            row["error_msg"] = f"QUERY EXECUTION TIMEOUT: {e}"
+        except ResultTooLargeError as e:
+            row["result_too_large"] = 1
+            row["error_msg"] = f"QUERY RESULT TOO LARGE: {e}"
+        except Exception as e:
+            row["error_db_exec"] = 1
+            row["error_msg"] = f"QUERY EXECUTION ERROR: {e}"
+    # phases that didn't run (eg after a generation error) are left empty
+    for phase, seconds in timer.as_dict().items():
+        row[f"{phase}_ms"] = seconds * 1000
+    return row
+
+
 def run_openai_eval(args):
     # get params from args
     questions_file_list = args.questions_file
@@ -274,6 +2083,41 @@ def run_openai_eval(args):
     k_shot = args.k_shot
     db_type = args.db_type
     cot_table_alias = args.cot_table_alias
+    # gold results never change, so they can be reused across runs and prompt files
+    gold_cache_dir = getattr(args, "gold_cache_dir", None)
+    gold_cache = GoldResultCache(gold_cache_dir) if gold_cache_dir else None
+    # LLM generation and SQL execution are sized separately, since they're bound by different things
+    exec_threads = getattr(args, "parallel_threads_exec", None) or args.parallel_threads
+    queue_size = getattr(args, "queue_size", None) or 2 * (
+        args.parallel_threads + exec_threads
+    )
+    # compare results in worker processes instead of on the execution threads
+    comparison_workers = getattr(args, "comparison_workers", None)
+    comparison_pool = (
+        ComparisonPool(
+            comparison_workers, getattr(args, "max_comparison_memory_mb", None)
+        )
+        if comparison_workers
+        else None
+    )
+    # one pooled engine per database, with a connection per execution thread
+    ENGINE_POOL.configure(
+        pool_size=exec_threads,
+        max_overflow=exec_threads,
+        statement_timeout=args.timeout_exec,
+    )
+    # generated queries and scored rows are checkpointed here so interrupted runs can resume
+    checkpoint_dir = getattr(args, "checkpoint_dir", None)
+    # async generation adapts its concurrency to the API's rate limits instead of using a
+    # fixed number of threads
+    async_generation = getattr(args, "async_generation", False)
+    if async_generation:
+        max_concurrency = getattr(args, "max_concurrency", None) or 4 * args.parallel_threads
+        limiter = AdaptiveRateLimiter(
+            max_concurrency,
+            requests_per_minute=getattr(args, "requests_per_minute", None),
+            tokens_per_minute=getattr(args, "tokens_per_minute", None),
+        )
 
     for questions_file, prompt_file, output_file in zip(
         questions_file_list, prompt_file_list, output_file_list
@@ -288,107 +2132,99 @@ def run_openai_eval(args):
             questions_file, db_type, num_questions, k_shot, cot_table_alias
         )
         input_rows = question_query_df.to_dict("records")
-        output_rows = []
-        with ThreadPoolExecutor(args.parallel_threads) as executor:
-            # for each query in the csv, generate a query using the generator asynchronously
-            futures = []
+        input_keys = [JsonlResultSink.row_key(row) for row in input_rows]
+        # rows are streamed to disk as they finish, next to output_file
+        sink = JsonlResultSink(f"{os.path.splitext(output_file)[0]}.jsonl")
+        checkpoint = None
+        total_tried = 0
+        total_correct = 0
+        if checkpoint_dir:
+            checkpoint = EvalCheckpoint(checkpoint_dir, prompt_file, args.model)
+            # the interrupted run streamed its rows to the sink before checkpointing them, so
+            # restored rows are only written again if the sink lost them
+            sink_keys = sink.keys()
+            remaining_rows = []
             for row in input_rows:
-                # get db creds for each row's db_name
-                db_name = row["db_name"]
-                db_creds = db_creds_all[row["db_type"]]
-
-                qg = OpenAIQueryGenerator(
-                    db_creds=copy.deepcopy(db_creds),
-                    db_name=db_name,
-                    db_type=db_type,
-                    model=args.model,
-                    prompt_file=prompt_file,
-                    timeout=args.timeout_gen,
-                    use_public_data=not args.use_private_data,
-                    verbose=args.verbose,
-                )
+                scored_row = checkpoint.get_scored(row)
+                if scored_row is None:
+                    remaining_rows.append(row)
+                    continue
+                if EvalCheckpoint.row_key(row) not in sink_keys:
+                    sink.write(scored_row)
+                total_tried += 1
+                if scored_row.get("correct"):
+                    total_correct += 1
+            print(
+                f"Loaded {total_tried} scored question(s) from checkpoint {checkpoint.path}"
+            )
+            input_rows = remaining_rows
+
+        # generate -> execute/compare, connected by bounded queues
+        if async_generation:
 
-                generated_query_fut = executor.submit(
-                    qg.generate_query,
-                    question=row["question"],
-                    instructions=row["instructions"],
-                    k_shot_prompt=row["k_shot_prompt"],
-                    glossary=row["glossary"],
-                    table_metadata_string=row["table_metadata_string"],
-                    prev_invalid_sql=row["prev_invalid_sql"],
-                    prev_error_msg=row["prev_error_msg"],
-                    cot_instructions=row["cot_instructions"],
-                    columns_to_keep=args.num_columns,
-                    shuffle=args.shuffle_metadata,
+            async def generate(row):
+                result_dict = await generate_query_async(
+                    row, args, prompt_file, limiter, checkpoint
                 )
-                futures.append(generated_query_fut)
+                return row, result_dict
+
+            generate_stage = AsyncPipelineStage(
+                "generate (async)",
+                generate,
+                max_concurrency,
+                queue.Queue(),
+                queue.Queue(maxsize=queue_size),
+            )
+        else:
+            generate_stage = PipelineStage(
+                "generate",
+                lambda row: (row, generate_or_load(row, args, prompt_file, checkpoint)),
+                args.parallel_threads,
+                queue.Queue(),
+                queue.Queue(maxsize=queue_size),
+            )
+        score_stage = PipelineStage(
+            "execute+compare",
+            lambda item: score_row(*item, args, gold_cache, comparison_pool),
+            exec_threads,
+            generate_stage.output_queue,
+            queue.Queue(maxsize=queue_size),
+        )
+        for row in input_rows:
+            generate_stage.input_queue.put((row, None))
+        generate_stage.start()
+        score_stage.start()
 
-            total_tried = 0
-            total_correct = 0
-            for f in (pbar := tqdm(as_completed(futures), total=len(futures))):
+        try:
+            for _ in (pbar := tqdm(range(len(input_rows)), total=len(input_rows))):
+                row, error = score_stage.output_queue.get()
+                if error is not None:
+                    raise error
                 total_tried += 1
-                i = futures.index(f)
-                row = input_rows[i]
-                result_dict = f.result()
-                query_gen = result_dict["query"]
-                reason = result_dict["reason"]
-                err = result_dict["err"]
-                table_metadata_string = result_dict["table_metadata_string"]
-                # save custom metrics
-                if "latency_seconds" in result_dict:
-                    row["latency_seconds"] = result_dict["latency_seconds"]
-                if "tokens_used" in result_dict:
-                    row["tokens_used"] = result_dict["tokens_used"]
-                row["generated_query"] = query_gen
-                row["reason"] = reason
-                row["error_msg"] = err
-                row["table_metadata_string"] = table_metadata_string
-                # save failures into relevant columns in the dataframe
-                if "GENERATION ERROR" in err:
-                    row["error_query_gen"] = 1
-                elif "EXECUTION ERROR" in err:
-                    row["error_db_exec"] = 1
-                elif "TIMEOUT" in err:
-                    row["timeout"] = 1
-                else:
-                    expected_query = row["query"]
-                    db_name = row["db_name"]
-                    db_type = row["db_type"]
-                    question = row["question"]
-                    query_category = row["query_category"]
-                    table_metadata_string = row["table_metadata_string"]
-                    exact_match = correct = 0
-                    db_creds = db_creds_all[db_type]
-                    # try executing the queries and compare the results if they succeed
-                    try:
-                        exact_match, correct = compare_query_results(
-                            query_gold=expected_query,
-                            query_gen=query_gen,
-                            db_name=db_name,
-                            db_type=db_type,
-                            db_creds=db_creds,
-                            timeout=args.timeout_exec,
-                            question=question,
-                            query_category=query_category,
-                            table_metadata_string=table_metadata_string,
-                            decimal_points=args.decimal_points,
-                        )
-                        row["exact_match"] = int(exact_match)
-                        row["correct"] = int(correct)
-                        row["error_msg"] = ""
-                        if correct:
-                            total_correct += 1
-                    except QueryCanceledError as e:
-                        row["timeout"] = 1
-                        row["error_msg"] = f"QUERY EXECUTION TIMEOUT: {e}"
-                    except Exception as e:
-                        row["error_db_exec"] = 1
-                        row["error_msg"] = f"QUERY EXECUTION ERROR: {e}"
-                output_rows.append(row)
+                if row.get("correct"):
+                    total_correct += 1
+                sink.write(row)
+                if checkpoint is not None:
+                    checkpoint.save_scored(row)
                 pbar.set_description(
                     f"Correct so far: {total_correct}/{total_tried} ({100*total_correct/total_tried:.2f}%)"
                 )
-        output_df = pd.DataFrame(output_rows)
+        except BaseException:
+            generate_stage.cancel()
+            score_stage.cancel()
+            raise
+        finally:
+            sink.close()
+            if checkpoint is not None:
+                checkpoint.close()
+        generate_stage.stop()
+        score_stage.stop()
+        print(generate_stage.stats())
+        print(score_stage.stats())
+        if async_generation:
+            print(limiter.stats())
+        print(f"Engine pool: {ENGINE_POOL.stats()}")
+        output_df = sink.read(input_keys)
         output_df = output_df.sort_values(by=["db_name", "query_category", "question"])
         if "prompt" in output_df.columns:
             del output_df["prompt"]
@@ -402,7 +2238,25 @@ def run_openai_eval(args):
             )
             .reset_index()
         )
-        print(agg_stats)
+        # p50/p95/p99 of the time spent in each phase
+        timing_columns = [
+            f"{phase}_ms" for phase in PHASES if f"{phase}_ms" in output_df.columns
+        ]
+        if timing_columns:
+            timing_stats = (
+                output_df.groupby("query_category")[timing_columns]
+                .quantile([0.5, 0.95, 0.99])
+                .unstack()
+            )
+            timing_stats.columns = [
+                f"{column}_p{round(q * 100)}" for column, q in timing_stats.columns
+            ]
+            agg_stats = agg_stats.merge(
+                timing_stats, left_on="query_category", right_index=True
+            )
+        print(agg_stats.to_string())
+        if gold_cache is not None:
+            print(f"Gold result cache: {gold_cache.stats()}")
         # get directory of output_file and create if not exist
         output_dir = os.path.dirname(output_file)
         if not os.path.exists(output_dir):
@@ -426,3 +2280,5 @@ def run_openai_eval(args):
                 prompt=prompt,
                 args=args,
             )
+    if comparison_pool is not None:
+        comparison_pool.shutdown()
@@ -1,52 +1,283 @@
+import copy
+import functools
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import seaborn as sns
-import matplotlib.pyplot as plt
+from journey_aggregates import HyperLogLog, OrderSketch, PartialAggregate
+from journey_sql import SqlSource
+from plot_config import themed
+
+TIMESTAMP_COLUMNS = ['orderdate_timestamp', 'shippingdate_timestamp', 'delivery_date']
+# Format of each timestamp column in the extract, delivery_date is a plain date
+TIMESTAMP_FORMATS = {'orderdate_timestamp': '%Y-%m-%d %H:%M:%S',
+                     'shippingdate_timestamp': '%Y-%m-%d %H:%M:%S',
+                     'delivery_date': '%Y-%m-%d'}
+FLAG_COLUMNS = ['is_return_flag', 'is_short_pick', 'is_zero_pick',
+                'is_on_time', 'is_delivery_failure']
+# Low-cardinality text columns the analyses group by
+CATEGORY_COLUMNS = ['deliverytype', 'warehouseid', 'product_group_name', 'product_type_name']
+# Columns used by the analyses, everything else in the extract is skipped when loading
+ANALYSIS_COLUMNS = (['orderid', 'product_price', 'consignment_deliverycost', 'deliverymode']
+                    + CATEGORY_COLUMNS + FLAG_COLUMNS + TIMESTAMP_COLUMNS)
+
+
+def to_flag(series, true_value):
+    """
+    Convert a flag column to boolean, leaving columns that are already boolean as they are
+    """
+    if series.dtype == bool:
+        return series
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Compare the handful of categories instead of every row
+        is_true = np.append(series.cat.categories.astype(str) == true_value, False)
+        return pd.Series(is_true[series.cat.codes], index=series.index, name=series.name)
+    return series.eq(true_value)
+
+
+def prepare_online_journey(df, timestamp_format=None, categorize=False):
+    """
+    Return df with datetime timestamps, boolean flags and (if categorize) categorical grouping
+    columns. timestamp_format is one format for every timestamp column or a dict with the format
+    of each column. Columns that are already converted are left as they are, and df itself is
+    not modified: unchanged columns are shared with it rather than copied.
+    """
+    df = df.copy(deep=False)
+    for col in TIMESTAMP_COLUMNS:
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            col_format = (timestamp_format.get(col) if isinstance(timestamp_format, dict)
+                          else timestamp_format)
+            df[col] = pd.to_datetime(df[col], format=col_format)
+    for col in FLAG_COLUMNS:
+        if col in df.columns:
+            df[col] = to_flag(df[col], 'Y')
+    # Delivery mode to boolean (1 = True, 0 = False)
+    if 'deliverymode' in df.columns:
+        df['deliverymode'] = to_flag(df['deliverymode'], '1')
+    if categorize:
+        for col in CATEGORY_COLUMNS:
+            if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype('category')
+    return df
+
+
+def load_online_journey(path, columns=ANALYSIS_COLUMNS, timestamp_format=TIMESTAMP_FORMATS):
+    """
+    Load the online_journey extract from a Parquet or CSV file, keeping only columns.
+    Grouping columns are loaded as categoricals, flags as booleans and timestamps are parsed
+    with timestamp_format (see prepare_online_journey), so the frame takes a fraction of the
+    memory of a plain read_csv
+    """
+    if str(path).endswith('.parquet'):
+        import pyarrow.parquet as pq
+        available = set(pq.read_schema(path).names)
+        df = pd.read_parquet(path, columns=[col for col in columns if col in available])
+    else:
+        # Flags only have a couple of values, so read them as categoricals too
+        dtype = {col: 'category' for col in CATEGORY_COLUMNS + FLAG_COLUMNS + ['deliverymode']}
+        df = pd.read_csv(path, usecols=lambda col: col in columns, dtype=dtype)
+    return prepare_online_journey(df, timestamp_format, categorize=True)
+
+
+# Averaged and counted columns of each grouping the reports need, for chunked analyzers
+REPORT_AGGREGATES = {
+    ('deliverytype',): (['is_on_time', 'consignment_deliverycost', 'is_delivery_failure',
+                         'deliverymode'], ['orderid']),
+    ('product_group_name', 'product_type_name'): (['product_price', 'is_return_flag',
+                                                   'deliverymode'], []),
+    ('warehouseid',): (['is_short_pick', 'is_zero_pick', 'is_delivery_failure'], ['orderid']),
+    ('deliverymode',): (['consignment_deliverycost', 'is_on_time', 'is_delivery_failure',
+                         'is_return_flag'], ['orderid']),
+    ('product_group_name',): ([], []),
+    (): (['order_price', 'deliverymode'] + FLAG_COLUMNS, []),
+}
+# Groupings that count distinct orders
+DISTINCT_ORDER_GROUPINGS = [('product_group_name', 'product_type_name'), ()]
+
+
+def memoized(method):
+    """
+    Cache the result of an analysis method until the analyzer's frame changes,
+    returning a deep copy so callers can't modify the cached result, including the frames
+    and series inside a dict result
+    """
+    @functools.wraps(method)
+    def wrapper(self):
+        if method.__name__ not in self._cache:
+            self._cache[method.__name__] = method(self)
+        return copy.deepcopy(self._cache[method.__name__])
+    return wrapper
+
 
 class EcommerceAnalyzer:
     def __init__(self, df):
         """
         Initialize with a pandas DataFrame containing e-commerce data
         """
-        self.df = df
-        # Convert timestamp columns to datetime
-        self.df['orderdate_timestamp'] = pd.to_datetime(self.df['orderdate_timestamp'])
-        self.df['shippingdate_timestamp'] = pd.to_datetime(self.df['shippingdate_timestamp'])
-        self.df['delivery_date'] = pd.to_datetime(self.df['delivery_date'])
-        
-        # Convert flag columns to boolean for easier analysis
-        self._convert_flags_to_boolean()
+        self.partials = None
+        self.sql = None
+        # Convert timestamp columns to datetime and flag columns to boolean for easier analysis
+        self.df = prepare_online_journey(df)
 
-    def _convert_flags_to_boolean(self):
+    @classmethod
+    def from_file(cls, path, columns=ANALYSIS_COLUMNS, timestamp_format=TIMESTAMP_FORMATS):
         """
-        Convert Y/N flags to boolean and 1/0 delivery mode to boolean
+        Initialize from an online_journey Parquet or CSV extract, see load_online_journey
         """
-        flag_columns = ['is_return_flag', 'is_short_pick', 'is_zero_pick', 
-                       'is_on_time', 'is_delivery_failure']
-        
-        for col in flag_columns:
-            if col in self.df.columns:
-                self.df[col] = self.df[col].eq('Y')
-        
-        # Convert delivery mode to boolean (1 = True, 0 = False)
-        if 'deliverymode' in self.df.columns:
-            self.df['deliverymode'] = self.df['deliverymode'].eq('1')
+        return cls(load_online_journey(path, columns, timestamp_format))
+
+    @classmethod
+    def from_chunks(cls, chunks, approximate_distinct=False, timestamp_format=None):
+        """
+        Initialize from an iterator of DataFrame chunks (eg read_csv with chunksize, or the row
+        groups of a Parquet file), keeping only partial aggregates of the report tables in
+        memory. self.df is None, so plot_delivery_performance isn't available.
+        With approximate_distinct, distinct orders are counted with HyperLogLog sketches
+        (about 0.8% error) instead of sets of order ids
+        """
+        analyzer = cls.__new__(cls)
+        analyzer.sql = None
+        sketch_factory = HyperLogLog if approximate_distinct else OrderSketch
+        analyzer.partials = {
+            keys: PartialAggregate(
+                keys, columns, sketch_factory if keys in DISTINCT_ORDER_GROUPINGS else None,
+                count_columns)
+            for keys, (columns, count_columns) in REPORT_AGGREGATES.items()}
+        analyzer.df = None
+        for chunk in chunks:
+            chunk = prepare_online_journey(chunk, timestamp_format)
+            # Order value is the sum of its item prices, missing prices count as 0
+            chunk['order_price'] = chunk['product_price'].fillna(0).where(chunk['orderid'].notna(), 0)
+            for partial in analyzer.partials.values():
+                partial.update(chunk)
+        analyzer.invalidate_cache()
+        return analyzer
+
+    @classmethod
+    def from_connection(cls, con, table='online_journey', dialect=None):
+        """
+        Initialize from the raw online_journey table of a database connection (sqlite3, duckdb
+        or a SQLAlchemy engine). The reports are computed by aggregate queries in the database
+        and only their results are fetched. self.df is None, so plot_delivery_performance
+        isn't available
+        """
+        analyzer = cls.__new__(cls)
+        analyzer.partials = None
+        analyzer.sql = SqlSource(con, table, dialect)
+        analyzer.df = None
+        return analyzer
+
+    @property
+    def df(self):
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """
+        Drop memoized results and grouping codes, call after modifying self.df in place
+        """
+        self._cache = {}
+
+    def _column_codes(self, col):
+        """
+        Sorted integer codes of a column (-1 for missing values) and its unique values,
+        computed once and shared by every analysis that groups or counts by the column
+        """
+        key = ('codes', col)
+        if key not in self._cache:
+            self._cache[key] = pd.factorize(self.df[col], sort=True)
+        return self._cache[key]
+
+    def _group_codes(self, keys):
+        """
+        Group number of each row for the grouping columns keys (-1 if any key is missing),
+        the number of groups and a frame with the keys of each group, in sorted order
+        """
+        cache_key = ('groups', tuple(keys))
+        if cache_key not in self._cache:
+            codes = np.zeros(len(self.df), dtype=np.int64)
+            missing = np.zeros(len(self.df), dtype=bool)
+            uniques = []
+            for col in keys:
+                col_codes, col_uniques = self._column_codes(col)
+                codes = codes * len(col_uniques) + col_codes
+                missing |= col_codes < 0
+                uniques.append(col_uniques)
+            # Only combinations that occur become groups, like groupby(observed=True)
+            group_codes, observed = pd.factorize(codes[~missing], sort=True)
+            row_groups = np.full(len(self.df), -1, dtype=np.int64)
+            row_groups[~missing] = group_codes
+            key_frame = {}
+            for col, col_uniques in reversed(list(zip(keys, uniques))):
+                observed, col_codes = np.divmod(observed, len(col_uniques))
+                key_frame[col] = col_uniques.take(col_codes)
+            key_frame = pd.DataFrame({col: key_frame[col] for col in keys})
+            self._cache[cache_key] = (row_groups, len(key_frame), key_frame)
+        return self._cache[cache_key]
 
+    def _aggregate(self, keys, aggs, names):
+        """
+        Equivalent of self.df.groupby(keys).agg(...).reset_index() with the columns renamed to
+        names, computed with bincount over the cached group codes (or from the partial aggregates
+        or the database, for analyzers without a frame). aggs is a list of (column, function)
+        with function one of 'count', 'mean' or 'nunique'
+        """
+        if self.partials is not None:
+            return self.partials[tuple(keys)].result(aggs, names)
+        if self.sql is not None:
+            return self.sql.aggregate(keys, aggs, names)
+        row_groups, num_groups, key_frame = self._group_codes(keys)
+        in_group = row_groups >= 0
+        all_in_group = in_group.all()
+        groups = row_groups if all_in_group else row_groups[in_group]
+        group_sizes = np.bincount(groups, minlength=num_groups)
+        result = key_frame.copy()
+        for (col, func), name in zip(aggs, names[len(keys):]):
+            if func == 'nunique':
+                value_codes, value_uniques = self._column_codes(col)
+                value_codes = value_codes if all_in_group else value_codes[in_group]
+                has_value = value_codes >= 0
+                pairs = pd.unique(groups[has_value] * len(value_uniques) + value_codes[has_value])
+                result[name] = np.bincount(pairs // len(value_uniques), minlength=num_groups)
+                continue
+            values = self.df[col].to_numpy()
+            values = values if all_in_group else values[in_group]
+            # Skip the masking for columns without missing values, eg boolean flags
+            value_groups = groups
+            counts = group_sizes
+            if values.dtype != bool:
+                has_value = ~pd.isna(values)
+                if not has_value.all():
+                    value_groups = groups[has_value]
+                    values = values[has_value]
+                    counts = np.bincount(value_groups, minlength=num_groups)
+            if func == 'count':
+                result[name] = counts
+            else:
+                sums = np.bincount(value_groups, weights=values.astype(float),
+                                   minlength=num_groups)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result[name] = sums / counts
+        result.columns = names
+        return result
+
+    @memoized
     def delivery_performance_analysis(self):
         """
         Analyze delivery performance metrics
         """
-        delivery_metrics = self.df.groupby('deliverytype').agg({
-            'orderid': 'count',
-            'is_on_time': 'mean',
-            'consignment_deliverycost': 'mean',
-            'is_delivery_failure': 'mean',
-            'deliverymode': 'mean'  # Proportion of express deliveries
-        }).reset_index()
-        
-        delivery_metrics.columns = ['delivery_type', 'total_orders', 'on_time_rate', 
-                                  'avg_delivery_cost', 'failure_rate', 'express_delivery_rate']
+        delivery_metrics = self._aggregate(
+            ['deliverytype'],
+            [('orderid', 'count'),
+             ('is_on_time', 'mean'),
+             ('consignment_deliverycost', 'mean'),
+             ('is_delivery_failure', 'mean'),
+             ('deliverymode', 'mean')],  # Proportion of express deliveries
+            ['delivery_type', 'total_orders', 'on_time_rate',
+             'avg_delivery_cost', 'failure_rate', 'express_delivery_rate'])
         
         # Convert rates to percentages
         rate_columns = ['on_time_rate', 'failure_rate', 'express_delivery_rate']
@@ -54,51 +285,63 @@ class EcommerceAnalyzer:
         
         return delivery_metrics
 
+    @memoized
     def product_category_analysis(self):
         """
         Analyze product category performance
         """
-        category_metrics = self.df.groupby(['product_group_name', 'product_type_name']).agg({
-            'orderid': 'nunique',
-            'product_price': ['count', 'mean'],
-            'is_return_flag': 'mean',
-            'deliverymode': 'mean'
-        }).reset_index()
-        
-        category_metrics.columns = ['product_group', 'product_type', 'unique_orders', 
-                                  'total_items', 'avg_price', 'return_rate', 'express_delivery_rate']
+        category_metrics = self._aggregate(
+            ['product_group_name', 'product_type_name'],
+            [('orderid', 'nunique'),
+             ('product_price', 'count'),
+             ('product_price', 'mean'),
+             ('is_return_flag', 'mean'),
+             ('deliverymode', 'mean')],
+            ['product_group', 'product_type', 'unique_orders',
+             'total_items', 'avg_price', 'return_rate', 'express_delivery_rate'])
         
         # Convert rates to percentages
         category_metrics[['return_rate', 'express_delivery_rate']] *= 100
         return category_metrics
 
+    @memoized
     def warehouse_performance(self):
         """
         Analyze warehouse picking performance
         """
-        warehouse_metrics = self.df.groupby('warehouseid').agg({
-            'orderid': 'count',
-            'is_short_pick': 'mean',
-            'is_zero_pick': 'mean',
-            'is_delivery_failure': 'mean'
-        }).reset_index()
-        
-        warehouse_metrics.columns = ['warehouse_id', 'total_items', 
-                                   'short_pick_rate', 'zero_pick_rate', 'delivery_failure_rate']
+        warehouse_metrics = self._aggregate(
+            ['warehouseid'],
+            [('orderid', 'count'),
+             ('is_short_pick', 'mean'),
+             ('is_zero_pick', 'mean'),
+             ('is_delivery_failure', 'mean')],
+            ['warehouse_id', 'total_items',
+             'short_pick_rate', 'zero_pick_rate', 'delivery_failure_rate'])
         
         # Convert rates to percentages
         rate_columns = ['short_pick_rate', 'zero_pick_rate', 'delivery_failure_rate']
         warehouse_metrics[rate_columns] = warehouse_metrics[rate_columns] * 100
         return warehouse_metrics
 
+    @memoized
     def generate_summary_report(self):
         """
         Generate a comprehensive summary report
         """
+        if self.partials is not None:
+            return self._summary_from_partials()
+        if self.sql is not None:
+            return self._summary_from_sql()
+        order_codes, order_ids = self._column_codes('orderid')
+        has_order = order_codes >= 0
+        # Order value is the sum of its item prices, missing prices count as 0
+        order_values = np.bincount(order_codes[has_order],
+                                   weights=self.df['product_price'].fillna(0).to_numpy()[has_order],
+                                   minlength=len(order_ids))
         summary = {
-            'total_orders': self.df['orderid'].nunique(),
+            'total_orders': len(order_ids),
             'total_items': len(self.df),
-            'avg_order_value': self.df.groupby('orderid')['product_price'].sum().mean(),
+            'avg_order_value': order_values.mean(),
             'return_rate': self.df['is_return_flag'].mean() * 100,
             'on_time_delivery_rate': self.df['is_on_time'].mean() * 100,
             'short_pick_rate': self.df['is_short_pick'].mean() * 100,
@@ -110,30 +353,93 @@ class EcommerceAnalyzer:
         }
         return summary
 
+    def _summary_from_partials(self):
+        totals = self.partials[()].result(
+            [('orderid', 'nunique'), ('orderid', 'size'), ('order_price', 'sum')]
+            + [(col, 'mean') for col in FLAG_COLUMNS + ['deliverymode']]).iloc[0]
+        top_product_groups, top_delivery_types = [
+            self.partials[(col,)].sizes.sort_values(ascending=False, kind='stable')
+            .astype('int64').rename('count').head()
+            for col in ['product_group_name', 'deliverytype']]
+        summary = {
+            'total_orders': totals.iloc[0],
+            'total_items': totals.iloc[1],
+            'avg_order_value': totals.iloc[2] / totals.iloc[0],
+            'return_rate': totals['is_return_flag'] * 100,
+            'on_time_delivery_rate': totals['is_on_time'] * 100,
+            'short_pick_rate': totals['is_short_pick'] * 100,
+            'zero_pick_rate': totals['is_zero_pick'] * 100,
+            'delivery_failure_rate': totals['is_delivery_failure'] * 100,
+            'express_delivery_rate': totals['deliverymode'] * 100,
+            'top_product_groups': top_product_groups,
+            'top_delivery_types': top_delivery_types
+        }
+        return summary
+
+    def _summary_from_sql(self):
+        totals = self.sql.aggregate(
+            [], [('orderid', 'nunique'), ('orderid', 'size')]
+            + [(col, 'mean') for col in FLAG_COLUMNS + ['deliverymode']])
+        avg_order_value = self.sql.query(self.sql.order_value_sql()).iloc[0, 0]
+        top_product_groups, top_delivery_types = [
+            self.sql.query(self.sql.top_values_sql(col)).set_index(col)['count']
+            for col in ['product_group_name', 'deliverytype']]
+        summary = {
+            # Cell by cell, as a row of the int and float columns would be all floats
+            'total_orders': totals.iat[0, 0],
+            'total_items': totals.iat[0, 1],
+            'avg_order_value': avg_order_value,
+            'return_rate': totals['is_return_flag'].iat[0] * 100,
+            'on_time_delivery_rate': totals['is_on_time'].iat[0] * 100,
+            'short_pick_rate': totals['is_short_pick'].iat[0] * 100,
+            'zero_pick_rate': totals['is_zero_pick'].iat[0] * 100,
+            'delivery_failure_rate': totals['is_delivery_failure'].iat[0] * 100,
+            'express_delivery_rate': totals['deliverymode'].iat[0] * 100,
+            'top_product_groups': top_product_groups,
+            'top_delivery_types': top_delivery_types
+        }
+        return summary
+
+    @memoized
     def delivery_mode_analysis(self):
         """
         Analyze performance metrics by delivery mode
         """
-        mode_metrics = self.df.groupby('deliverymode').agg({
-            'orderid': 'count',
-            'consignment_deliverycost': 'mean',
-            'is_on_time': 'mean',
-            'is_delivery_failure': 'mean',
-            'is_return_flag': 'mean'
-        }).reset_index()
-        
-        mode_metrics.columns = ['is_express', 'total_orders', 'avg_delivery_cost',
-                              'on_time_rate', 'failure_rate', 'return_rate']
+        mode_metrics = self._aggregate(
+            ['deliverymode'],
+            [('orderid', 'count'),
+             ('consignment_deliverycost', 'mean'),
+             ('is_on_time', 'mean'),
+             ('is_delivery_failure', 'mean'),
+             ('is_return_flag', 'mean')],
+            ['is_express', 'total_orders', 'avg_delivery_cost',
+             'on_time_rate', 'failure_rate', 'return_rate'])
         
         # Convert rates to percentages
         rate_columns = ['on_time_rate', 'failure_rate', 'return_rate']
         mode_metrics[rate_columns] = mode_metrics[rate_columns] * 100
         return mode_metrics
 
+    def full_report(self):
+        """
+        Compute all report tables together, sharing the grouping codes between them
+        """
+        return {
+            'delivery_performance': self.delivery_performance_analysis(),
+            'product_category': self.product_category_analysis(),
+            'warehouse_performance': self.warehouse_performance(),
+            'delivery_mode': self.delivery_mode_analysis(),
+            'summary': self.generate_summary_report()
+        }
+
+    @themed
     def plot_delivery_performance(self):
         """
         Create visualizations for delivery performance
         """
+        # Plotting libraries are only imported when a plot is requested
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(15, 6))
         
         # Time series of delivery performance
@@ -157,6 +463,9 @@ df = pd.read_csv('your_data.csv')
 # Initialize analyzer
 analyzer = EcommerceAnalyzer(df)
 
+# Or load just the columns the analyses need, with compact dtypes
+analyzer = EcommerceAnalyzer.from_file('online_journey.parquet')
+
 # Get various analyses
 delivery_metrics = analyzer.delivery_performance_analysis()
 product_metrics = analyzer.product_category_analysis()
@@ -164,60 +473,224 @@ warehouse_metrics = analyzer.warehouse_performance()
 mode_metrics = analyzer.delivery_mode_analysis()
 summary_report = analyzer.generate_summary_report()
 
+# Or all of them at once
+report = analyzer.full_report()
+
+# Stream a file that doesn't fit in memory
+analyzer = EcommerceAnalyzer.from_chunks(
+    pd.read_csv('your_data.csv', chunksize=1_000_000, dtype={'deliverymode': str}))
+report = analyzer.full_report()
+
 # Create visualization
+import matplotlib.pyplot as plt
+
 analyzer.plot_delivery_performance()
 plt.show()
 """
 
 
 -----------------------------------------------
+import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
 from datetime import datetime
+from journey_aggregates import HyperLogLog, OrderSketch, PartialAggregate
+from journey_sql import SqlSource
+from plot_config import themed
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+# Ordered, so the analyses by day run from Monday to Sunday
+DAY_OF_WEEK = pd.CategoricalDtype(DAY_NAMES, ordered=True)
+# Columns set by _prepare_data from the order timestamps
+TIME_FEATURES = ['orderdate_timestamp', 'day_of_week', 'hour_of_day', 'week_number', 'week_start']
+
+
+def derive_time_features(timestamps):
+    """
+    The TIME_FEATURES of a series of order timestamps, by integer arithmetic on the seconds
+    since the epoch instead of string and period conversions of every row. ISO week numbers
+    are computed once per week and mapped back
+    """
+    timestamps = pd.to_datetime(timestamps)
+    # Like the .dt accessors, time zone aware timestamps are taken at their local wall time
+    wall_time = timestamps
+    if timestamps.dt.tz is not None:
+        wall_time = timestamps.dt.tz_localize(None)
+    unit = np.datetime_data(wall_time.dtype)[0]
+    missing = wall_time.isna().to_numpy()
+    seconds = wall_time.to_numpy().astype('datetime64[s]').astype(np.int64)
+    days, seconds_of_day = np.divmod(seconds, 86400)
+    # 1970-01-01 was a Thursday
+    weekday = (days + 3) % 7
+    hour = (seconds_of_day // 3600).astype(np.int32)
+    week_start = (days - weekday).astype('datetime64[D]').astype(f'datetime64[{unit}]')
+    if missing.any():
+        hour = np.where(missing, np.nan, hour)
+        week_start[missing] = np.datetime64('NaT')
+    week_codes, weeks = pd.factorize(week_start)
+    week_numbers = np.append(pd.DatetimeIndex(weeks).isocalendar().week.to_numpy(np.uint32),
+                             np.uint32(0))
+    return pd.DataFrame({
+        'orderdate_timestamp': timestamps,
+        'day_of_week': pd.Categorical.from_codes(np.where(missing, -1, weekday), dtype=DAY_OF_WEEK),
+        'hour_of_day': hour,
+        'week_number': pd.arrays.IntegerArray(week_numbers[week_codes], missing),
+        'week_start': week_start,
+    }, index=timestamps.index)
+
+
+def load_time_features(path, timestamps):
+    """
+    derive_time_features of the order timestamps of the extract at path, cached in a Parquet
+    file next to it. The cache is rebuilt when the extract is newer or has a different length
+    """
+    cache_path = f'{path}.time_features.parquet'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        features = pd.read_parquet(cache_path)
+        if len(features) == len(timestamps):
+            return features.set_axis(timestamps.index)
+    features = derive_time_features(timestamps)
+    features.to_parquet(cache_path, index=False)
+    return features
+
+# Grouping keys and averaged columns of each analysis, all of them also count distinct orders
+PATTERN_AGGREGATES = {
+    'daily': (['day_of_week'], ['is_on_time', 'is_delivery_failure', 'deliverymode',
+                                'is_return_flag', 'consignment_deliverycost']),
+    'hourly': (['day_of_week', 'hour_of_day'], ['deliverymode', 'is_on_time']),
+    'weekly': (['week_start'], ['is_on_time', 'is_delivery_failure', 'deliverymode',
+                                'is_return_flag']),
+}
+
 
 class WeeklyPatternAnalyzer:
-    def __init__(self, df):
-        """
-        Initialize with a pandas DataFrame containing e-commerce data
-        """
-        self.df = df.copy()
-        self._prepare_data()
-    
-    def _prepare_data(self):
-        """
-        Prepare data for weekly analysis
-        """
-        # Convert timestamps
-        self.df['orderdate_timestamp'] = pd.to_datetime(self.df['orderdate_timestamp'])
-        
-        # Extract time components
-        self.df['day_of_week'] = self.df['orderdate_timestamp'].dt.day_name()
-        self.df['hour_of_day'] = self.df['orderdate_timestamp'].dt.hour
-        self.df['week_number'] = self.df['orderdate_timestamp'].dt.isocalendar().week
-        self.df['week_start'] = self.df['orderdate_timestamp'].dt.to_period('W').dt.start_time
+    def __init__(self, df, time_features=None):
+        """
+        Initialize with a pandas DataFrame containing e-commerce data, and optionally its
+        precomputed TIME_FEATURES (see load_time_features)
+        """
+        self.sql = None
+        # _prepare_data only replaces whole columns, so a shallow copy leaves df as it is
+        self.df = df.copy(deep=False)
+        self._prepare_data(time_features=time_features)
+        # The metrics are grouped from self.df until the first update needs mergeable aggregates
+        self.aggregates = None
+        self._weekly_metrics = None
+
+    @classmethod
+    def from_chunks(cls, chunks, approximate_distinct=False):
+        """
+        Initialize from an iterator of DataFrame chunks (eg read_csv with chunksize, or the row
+        groups of a Parquet file), keeping only the aggregates in memory. self.df is None.
+        With approximate_distinct, distinct orders are counted with HyperLogLog sketches
+        (about 0.8% error) instead of sets of order ids
+        """
+        analyzer = cls.__new__(cls)
+        analyzer.df = None
+        analyzer.sql = None
+        analyzer.aggregates = analyzer._create_aggregates(
+            HyperLogLog if approximate_distinct else OrderSketch)
+        analyzer._weekly_metrics = None
+        for chunk in chunks:
+            analyzer.update(chunk)
+        return analyzer
+
+    @classmethod
+    def from_file(cls, path, cache_time_features=True):
+        """
+        Initialize from an online_journey Parquet or CSV extract. With cache_time_features, the
+        derived time columns are cached next to the file so later runs skip the derivation
+        """
+        if str(path).endswith('.parquet'):
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_csv(path, dtype={'deliverymode': str})
+        time_features = None
+        if cache_time_features:
+            time_features = load_time_features(path, df['orderdate_timestamp'])
+        return cls(df, time_features)
+
+    @classmethod
+    def from_connection(cls, con, table='online_journey', dialect=None):
+        """
+        Initialize from the raw online_journey table of a database connection (sqlite3, duckdb
+        or a SQLAlchemy engine). Each analysis runs as an aggregate query in the database and
+        only its result is fetched. self.df is None and new orders are loaded into the table
+        rather than passed to update
+        """
+        analyzer = cls.__new__(cls)
+        analyzer.df = None
+        analyzer.sql = SqlSource(con, table, dialect)
+        analyzer.aggregates = None
+        analyzer._weekly_metrics = None
+        return analyzer
+
+    def _create_aggregates(self, sketch_factory=OrderSketch):
+        return {name: PartialAggregate(keys, mean_columns, sketch_factory)
+                for name, (keys, mean_columns) in PATTERN_AGGREGATES.items()}
+
+    def _prepare_data(self, df=None, time_features=None):
+        """
+        Prepare data for weekly analysis, in place on df (self.df by default). time_features
+        are the precomputed TIME_FEATURES of df, derived from its timestamps if not given
+        """
+        if df is None:
+            df = self.df
+        # Convert timestamps and extract time components
+        if time_features is None:
+            time_features = derive_time_features(df['orderdate_timestamp'])
+        for col in TIME_FEATURES:
+            df[col] = time_features[col]
         
         # Convert flags
         flag_columns = ['is_return_flag', 'is_short_pick', 'is_zero_pick', 
                        'is_on_time', 'is_delivery_failure']
         for col in flag_columns:
-            self.df[col] = self.df[col].eq('Y')
+            df[col] = df[col].eq('Y')
         
-        self.df['deliverymode'] = self.df['deliverymode'].eq('1')
+        df['deliverymode'] = df['deliverymode'].eq('1')
+        return df
+
+    def _fold(self, df):
+        for aggregate in self.aggregates.values():
+            aggregate.update(df)
+        self._weekly_metrics = None
+
+    def update(self, new_df):
+        """
+        Fold a new batch of orders (eg a day's load) into the metrics. This takes time
+        proportional to the batch, self.df is not extended with it. The first update also
+        folds self.df into the aggregates
+        """
+        if self.sql is not None:
+            raise ValueError('Load new orders into the database table of a SQL analyzer')
+        if self.aggregates is None:
+            self.aggregates = self._create_aggregates()
+            self._fold(self.df)
+        self._fold(self._prepare_data(new_df.copy(deep=False)))
+
+    def _metrics(self, name):
+        """
+        Distinct orders and mean columns per group of one of PATTERN_AGGREGATES
+        """
+        keys, mean_columns = PATTERN_AGGREGATES[name]
+        if self.sql is not None:
+            metrics = self.sql.aggregate(
+                keys, [('orderid', 'nunique')] + [(col, 'mean') for col in mean_columns])
+            if 'day_of_week' in keys:
+                metrics['day_of_week'] = metrics['day_of_week'].astype(DAY_OF_WEEK)
+                metrics = metrics.sort_values(keys, ignore_index=True)
+            return metrics
+        if self.aggregates is None:
+            aggs = {'orderid': 'nunique', **{col: 'mean' for col in mean_columns}}
+            return self.df.groupby(keys, observed=True).agg(aggs).reset_index()
+        return self.aggregates[name].result()
 
     def daily_pattern_analysis(self):
         """
         Analyze patterns by day of week
         """
-        daily_metrics = self.df.groupby('day_of_week').agg({
-            'orderid': 'nunique',
-            'is_on_time': 'mean',
-            'is_delivery_failure': 'mean',
-            'deliverymode': 'mean',
-            'is_return_flag': 'mean',
-            'consignment_deliverycost': 'mean'
-        }).reset_index()
+        daily_metrics = self._metrics('daily')
         
         # Convert rates to percentages
         rate_columns = ['is_on_time', 'is_delivery_failure', 'deliverymode', 'is_return_flag']
@@ -229,11 +702,7 @@ class WeeklyPatternAnalyzer:
         """
         Analyze patterns by hour of day for each day of week
         """
-        hourly_metrics = self.df.groupby(['day_of_week', 'hour_of_day']).agg({
-            'orderid': 'nunique',
-            'deliverymode': 'mean',
-            'is_on_time': 'mean'
-        }).reset_index()
+        hourly_metrics = self._metrics('hourly')
         
         hourly_metrics[['deliverymode', 'is_on_time']] *= 100
         return hourly_metrics
@@ -242,25 +711,26 @@ class WeeklyPatternAnalyzer:
         """
         Analyze trends by week
         """
-        weekly_metrics = self.df.groupby('week_start').agg({
-            'orderid': 'nunique',
-            'is_on_time': 'mean',
-            'is_delivery_failure': 'mean',
-            'deliverymode': 'mean',
-            'is_return_flag': 'mean'
-        }).reset_index()
-        
-        # Calculate moving averages
-        rate_columns = ['is_on_time', 'is_delivery_failure', 'deliverymode', 'is_return_flag']
-        weekly_metrics[rate_columns] = weekly_metrics[rate_columns] * 100
-        weekly_metrics['orders_ma'] = weekly_metrics['orderid'].rolling(window=4).mean()
+        if self._weekly_metrics is None:
+            weekly_metrics = self._metrics('weekly')
+            
+            # Calculate moving averages, over the weekly totals rather than the orders
+            rate_columns = ['is_on_time', 'is_delivery_failure', 'deliverymode', 'is_return_flag']
+            weekly_metrics[rate_columns] = weekly_metrics[rate_columns] * 100
+            weekly_metrics['orders_ma'] = weekly_metrics['orderid'].rolling(window=4).mean()
+            self._weekly_metrics = weekly_metrics
         
-        return weekly_metrics
+        return self._weekly_metrics.copy()
 
+    @themed
     def plot_daily_patterns(self):
         """
         Create visualization for daily patterns
         """
+        # Plotting libraries are only imported when a plot is requested
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         daily_metrics = self.daily_pattern_analysis()
         
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(15, 12))
@@ -284,10 +754,14 @@ class WeeklyPatternAnalyzer:
         plt.tight_layout()
         return plt
 
+    @themed
     def plot_hourly_patterns(self):
         """
         Create heatmap for hourly patterns
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         hourly_metrics = self.hourly_pattern_analysis()
         pivot_data = hourly_metrics.pivot(
             index='day_of_week', 
@@ -302,10 +776,13 @@ class WeeklyPatternAnalyzer:
         plt.ylabel('Day of Week')
         return plt
 
+    @themed
     def plot_weekly_trends(self):
         """
         Create visualization for weekly trends
         """
+        import matplotlib.pyplot as plt
+
         weekly_metrics = self.weekly_trend_analysis()
         
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(15, 12))
@@ -340,12 +817,25 @@ df = pd.read_csv('your_data.csv')
 # Initialize analyzer
 analyzer = WeeklyPatternAnalyzer(df)
 
+# Or load an extract, caching the derived time columns next to it for the next run
+analyzer = WeeklyPatternAnalyzer.from_file('your_data.csv')
+
 # Get various analyses
 daily_patterns = analyzer.daily_pattern_analysis()
 hourly_patterns = analyzer.hourly_pattern_analysis()
 weekly_trends = analyzer.weekly_trend_analysis()
 
+# Or stream a file that doesn't fit in memory
+analyzer = WeeklyPatternAnalyzer.from_chunks(
+    pd.read_csv('your_data.csv', chunksize=1_000_000, dtype={'deliverymode': str}))
+
+# Fold in the next day's orders without recomputing from scratch
+analyzer.update(pd.read_csv('next_day.csv', dtype={'deliverymode': str}))
+weekly_trends = analyzer.weekly_trend_analysis()
+
 # Create visualizations
+import matplotlib.pyplot as plt
+
 analyzer.plot_daily_patterns()
 analyzer.plot_hourly_patterns()
 analyzer.plot_weekly_trends()
@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+
+
+class OrderSketch:
+    """
+    Set of distinct order ids that can be merged with other sketches
+    """
+    def __init__(self):
+        self.orderids = set()
+
+    def update(self, orderids):
+        self.orderids.update(orderids)
+
+    def merge(self, other):
+        self.orderids |= other.orderids
+
+    def count(self):
+        return len(self.orderids)
+
+
+class HyperLogLog:
+    """
+    Approximate distinct count in a fixed 2**precision bytes, mergeable like OrderSketch.
+    The standard error is about 1.04 / sqrt(2**precision), under 1% for the default
+    """
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, orderids):
+        orderids = np.asarray(orderids)
+        # Hash whole-number floats (eg ids read next to missing values) the same as ints
+        if orderids.dtype.kind == 'f' and np.all(orderids == np.floor(orderids)):
+            orderids = orderids.astype(np.int64)
+        hashes = pd.util.hash_array(orderids)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        # Position of the first set bit of the remaining bits, from the left
+        high = (rest >> np.uint64(32)).astype(np.float64)
+        low = (rest & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        bit_length = np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+        rank = (64 - self.precision - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        empty = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and empty:
+            # Linear counting is more accurate for small counts
+            estimate = m * np.log(m / empty)
+        return int(round(estimate))
+
+
+class PartialAggregate:
+    """
+    Mergeable state of a groupby: for each group, its number of rows, the sum and non-missing
+    count of every column, the non-missing count of every count_column and, if sketch_factory
+    is set, a sketch of its distinct order ids.
+    Batches of rows are folded in with update, so the totals never need the full history.
+    With no keys, all rows are a single group
+    """
+    def __init__(self, keys, columns, sketch_factory=OrderSketch, count_columns=()):
+        self.keys = list(keys)
+        self.columns = list(columns)
+        self.count_columns = list(count_columns)
+        self.sketch_factory = sketch_factory
+        self.sizes = None
+        self.sums = None
+        self.sketches = {}
+
+    def update(self, df):
+        """
+        Fold a batch of rows into the aggregate
+        """
+        by = self.keys or np.zeros(len(df), dtype=np.int8)
+        grouped = df.groupby(by, observed=True)
+        sizes = grouped.size()
+        sums = [pd.DataFrame(index=sizes.index)]
+        if self.columns:
+            sums.append(grouped[self.columns].agg(['sum', 'count']))
+        if self.count_columns:
+            counts = grouped[self.count_columns].count()
+            counts.columns = pd.MultiIndex.from_product([self.count_columns, ['count']])
+            sums.append(counts)
+        sums = pd.concat(sums, axis=1)
+        if self.sizes is None:
+            self.sizes, self.sums = sizes, sums
+        else:
+            self.sizes = self.sizes.add(sizes, fill_value=0)
+            self.sums = self.sums.add(sums, fill_value=0)
+        if self.sketch_factory is None:
+            return
+        # Each order only needs to be added once per group
+        orders = df[self.keys + ['orderid']].dropna().drop_duplicates()
+        if self.keys:
+            groups = orders.groupby(self.keys, observed=True)['orderid']
+        else:
+            groups = [(0, orders['orderid'])]
+        for key, orderids in groups:
+            if key not in self.sketches:
+                self.sketches[key] = self.sketch_factory()
+            self.sketches[key].update(orderids.to_numpy())
+
+    def merge(self, other):
+        """
+        Fold another aggregate of the same groupby into this one
+        """
+        if other.sizes is not None:
+            if self.sizes is None:
+                self.sizes, self.sums = other.sizes, other.sums
+            else:
+                self.sizes = self.sizes.add(other.sizes, fill_value=0)
+                self.sums = self.sums.add(other.sums, fill_value=0)
+        for key, sketch in other.sketches.items():
+            if key not in self.sketches:
+                self.sketches[key] = self.sketch_factory()
+            self.sketches[key].merge(sketch)
+
+    def _sketch_key(self, key):
+        # Iterating a groupby by a list of keys gives tuples, even for a single key
+        if self.keys and not isinstance(key, tuple):
+            return (key,)
+        return key
+
+    def result(self, aggs=None, names=None):
+        """
+        The groupby result, sorted by group: the group keys followed by a column per
+        (column, function) in aggs, where function is 'size', 'count', 'sum', 'mean' or 'nunique'
+        (distinct order ids). By default the distinct order count as orderid and the mean of
+        every column. names renames the columns
+        """
+        if aggs is None:
+            aggs = [('orderid', 'nunique')] + [(col, 'mean') for col in self.columns]
+        sizes = self.sizes.sort_index()
+        sums = self.sums.reindex(sizes.index)
+        values = []
+        for col, func in aggs:
+            if func == 'size':
+                values.append(sizes.astype('int64'))
+            elif func == 'count':
+                values.append(sums[(col, 'count')].astype('int64'))
+            elif func == 'sum':
+                values.append(sums[(col, 'sum')])
+            elif func == 'mean':
+                values.append(sums[(col, 'sum')] / sums[(col, 'count')])
+            else:
+                sketches = [self.sketches.get(self._sketch_key(key)) for key in sizes.index]
+                values.append(pd.Series([sketch.count() if sketch else 0 for sketch in sketches],
+                                        index=sizes.index))
+        result = pd.concat(values, axis=1, keys=range(len(values)))
+        result.columns = [col for col, _ in aggs]
+        result = result.reset_index(drop=not self.keys)
+        if names is not None:
+            result.columns = names
+        return result
@@ -0,0 +1,139 @@
+import pandas as pd
+
+# Per-dialect SQL for the derived columns of the analyzers. Weeks start on Monday, like
+# to_period('W') in pandas
+DIALECTS = {
+    'sqlite': {
+        'float': 'REAL',
+        'text': 'TEXT',
+        'day_of_week': ("CASE strftime('%w', orderdate_timestamp) "
+                        "WHEN '0' THEN 'Sunday' WHEN '1' THEN 'Monday' WHEN '2' THEN 'Tuesday' "
+                        "WHEN '3' THEN 'Wednesday' WHEN '4' THEN 'Thursday' WHEN '5' THEN 'Friday' "
+                        "WHEN '6' THEN 'Saturday' END"),
+        'hour_of_day': "CAST(strftime('%H', orderdate_timestamp) AS INTEGER)",
+        'week_start': "date(orderdate_timestamp, 'weekday 0', '-6 days')",
+    },
+    'duckdb': {
+        'float': 'DOUBLE',
+        'text': 'VARCHAR',
+        'day_of_week': 'dayname(CAST(orderdate_timestamp AS TIMESTAMP))',
+        'hour_of_day': 'hour(CAST(orderdate_timestamp AS TIMESTAMP))',
+        'week_start': "date_trunc('week', CAST(orderdate_timestamp AS TIMESTAMP))",
+    },
+    'postgres': {
+        'float': 'DOUBLE PRECISION',
+        'text': 'TEXT',
+        'day_of_week': "to_char(CAST(orderdate_timestamp AS TIMESTAMP), 'FMDay')",
+        'hour_of_day': 'CAST(extract(hour FROM CAST(orderdate_timestamp AS TIMESTAMP)) AS INTEGER)',
+        'week_start': "date_trunc('week', CAST(orderdate_timestamp AS TIMESTAMP))",
+    },
+}
+# Columns the analyzers convert to booleans, and the raw value that means True
+FLAG_VALUES = {
+    'is_return_flag': 'Y',
+    'is_short_pick': 'Y',
+    'is_zero_pick': 'Y',
+    'is_on_time': 'Y',
+    'is_delivery_failure': 'Y',
+    'deliverymode': '1',
+}
+
+
+def detect_dialect(con):
+    """
+    Guess the dialect of a connection: sqlite3 and duckdb connections, anything else
+    (eg a SQLAlchemy engine) is taken to be postgres
+    """
+    module = type(con).__module__
+    if module.startswith('sqlite3'):
+        return 'sqlite'
+    # duckdb connections are defined in its _duckdb extension module
+    if 'duckdb' in module:
+        return 'duckdb'
+    return 'postgres'
+
+
+class SqlSource:
+    """
+    Raw online_journey rows in a database table. The analyzers compile their metrics to
+    aggregate queries on it, so only the small result tables are transferred
+    """
+    def __init__(self, con, table='online_journey', dialect=None):
+        self.con = con
+        self.table = table
+        self.dialect = dialect or detect_dialect(con)
+        self.sql = DIALECTS[self.dialect]
+
+    def query(self, sql):
+        if self.dialect == 'duckdb':
+            return self.con.execute(sql).df()
+        return pd.read_sql_query(sql, self.con)
+
+    def expression(self, col):
+        """
+        SQL for a column as the analyzers see it: flags as 1/0 (missing flags are 0, like
+        .eq('Y') in pandas) and derived time columns computed from orderdate_timestamp
+        """
+        if col in FLAG_VALUES:
+            return (f"CASE WHEN CAST({col} AS {self.sql['text']}) = '{FLAG_VALUES[col]}' "
+                    "THEN 1 ELSE 0 END")
+        return self.sql.get(col, col)
+
+    def aggregate_sql(self, keys, aggs):
+        """
+        Compile a groupby of keys to SQL. aggs is a list of (column, function) with function
+        one of 'size', 'count', 'sum', 'mean' or 'nunique'. Rows with a missing key are left
+        out and groups are sorted, like groupby
+        """
+        select = [f'{self.expression(key)} AS key_{i}' for i, key in enumerate(keys)]
+        for i, (col, func) in enumerate(aggs):
+            expression = self.expression(col)
+            if func == 'size':
+                select.append(f'COUNT(*) AS agg_{i}')
+            elif func == 'count':
+                select.append(f'COUNT({expression}) AS agg_{i}')
+            elif func == 'sum':
+                select.append(f'SUM({expression}) AS agg_{i}')
+            elif func == 'mean':
+                select.append(f"AVG(CAST({expression} AS {self.sql['float']})) AS agg_{i}")
+            elif func == 'nunique':
+                select.append(f'COUNT(DISTINCT {expression}) AS agg_{i}')
+            else:
+                raise ValueError(f'Invalid aggregation: {func}')
+        sql = f"SELECT {', '.join(select)} FROM {self.table}"
+        if keys:
+            positions = ', '.join(str(i + 1) for i in range(len(keys)))
+            not_null = ' AND '.join(f'{self.expression(key)} IS NOT NULL' for key in keys)
+            sql += f' WHERE {not_null} GROUP BY {positions} ORDER BY {positions}'
+        return sql
+
+    def aggregate(self, keys, aggs, names=None):
+        """
+        Run aggregate_sql and return the result like groupby(keys).agg(...).reset_index(),
+        with the columns renamed to names
+        """
+        result = self.query(self.aggregate_sql(keys, aggs))
+        for i, key in enumerate(keys):
+            if key in FLAG_VALUES:
+                result[f'key_{i}'] = result[f'key_{i}'].astype(bool)
+            elif key == 'week_start':
+                result[f'key_{i}'] = pd.to_datetime(result[f'key_{i}'])
+        result.columns = list(keys) + [col for col, _ in aggs]
+        if names is not None:
+            result.columns = names
+        return result
+
+    def order_value_sql(self):
+        """
+        Mean over orders of the sum of their item prices, missing prices count as 0
+        """
+        return (f"SELECT AVG(CAST(order_value AS {self.sql['float']})) FROM "
+                f"(SELECT SUM(COALESCE(product_price, 0)) AS order_value FROM {self.table} "
+                "WHERE orderid IS NOT NULL GROUP BY orderid) AS orders")
+
+    def top_values_sql(self, col, n=5):
+        """
+        The n most common values of col and their counts, like value_counts().head(n)
+        """
+        return (f"SELECT {col}, COUNT(*) AS count FROM {self.table} WHERE {col} IS NOT NULL "
+                f"GROUP BY {col} ORDER BY 2 DESC, 1 LIMIT {n}")
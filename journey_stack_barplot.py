@@ -1,88 +1,217 @@
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
+import json
 import os
-import gc  # for garbage collection
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from plot_config import themed
 
-def create_stacked_barchart(df, group_col, stack_col, save_path='graphs'):
+
+def chart_filename(group_col, stack_col):
+    return f'{group_col}_vs_{stack_col}_distribution.png'
+
+
+def stamp_filename(chart_path):
+    # Render parameters of a chart are stored next to it
+    return os.path.splitext(chart_path)[0] + '.json'
+
+
+def is_up_to_date(chart_path, data_mtime, params):
     """
-    Create and save stacked bar chart
-    
+    Whether the chart at chart_path was rendered after the data was last modified,
+    with the same render parameters
+    """
+    stamp_path = stamp_filename(chart_path)
+    if not os.path.exists(chart_path) or os.path.getmtime(chart_path) <= data_mtime:
+        return False
+    if not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path) as f:
+        return json.load(f) == params
+
+
+def write_stamp(chart_path, params):
+    with open(stamp_filename(chart_path), 'w') as f:
+        json.dump(params, f)
+
+
+def compute_crosstabs(df, pairs, top_n=None):
+    """
+    Percentage crosstabs of several column pairs, like
+    pd.crosstab(df[group_col], df[stack_col], normalize='index') * 100
+
+    Each column is factorized once, however many pairs it appears in, and only the
+    combinations that occur are counted, so a stack column with thousands of values
+    doesn't need a dense groups x values table
+
     Args:
         df: pandas DataFrame
-        group_col: column to group by (e.g., 'country')
-        stack_col: column to create stacks (e.g., 'department_name')
-        save_path: folder to save graphs
+        pairs: list of (group_col, stack_col)
+        top_n: keep only the top_n most common values of each stack column,
+            adding up the rest as 'Other'
+
+    Returns:
+        dict of (group_col, stack_col) to crosstab
     """
-    # Create directory if it doesn't exist
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-    
-    # Create figure
-    plt.figure(figsize=(15, 8))
-    
-    # Create pivot table and calculate percentages
-    pivot_data = pd.crosstab(
-        index=df[group_col],
-        columns=df[stack_col],
-        normalize='index'
-    ) * 100
-    
-    # Create stacked bar chart
-    ax = pivot_data.plot(kind='bar', stacked=True)
-    
+    factorized = {}
+    for col in dict.fromkeys(col for pair in pairs for col in pair):
+        factorized[col] = pd.factorize(df[col], sort=True)
+    crosstabs = {}
+    for group_col, stack_col in pairs:
+        group_codes, group_values = factorized[group_col]
+        stack_codes, stack_values = factorized[stack_col]
+        present = (group_codes >= 0) & (stack_codes >= 0)
+        # Count the distinct (group, stack) combinations
+        combination_codes, combinations = pd.factorize(
+            group_codes[present] * len(stack_values) + stack_codes[present])
+        counts = np.bincount(combination_codes, minlength=len(combinations))
+        groups, stacks = np.divmod(combinations, len(stack_values))
+
+        # Like crosstab, only keep values that occur together with a value of the other column
+        observed_groups = np.unique(groups)
+        row_of = np.zeros(len(group_values), dtype=np.int64)
+        row_of[observed_groups] = np.arange(len(observed_groups))
+        observed_stacks = np.unique(stacks)
+        column_of = np.zeros(len(stack_values), dtype=np.int64)
+        if top_n is not None and len(observed_stacks) > top_n:
+            stack_totals = np.bincount(stacks, weights=counts, minlength=len(stack_values))
+            top = np.sort(np.argsort(-stack_totals, kind='stable')[:top_n])
+            column_of[:] = top_n
+            column_of[top] = np.arange(top_n)
+            columns = list(stack_values[top]) + ['Other']
+        else:
+            column_of[observed_stacks] = np.arange(len(observed_stacks))
+            columns = stack_values[observed_stacks]
+
+        table = np.zeros((len(observed_groups), len(columns)))
+        np.add.at(table, (row_of[groups], column_of[stacks]), counts)
+        crosstabs[(group_col, stack_col)] = pd.DataFrame(
+            table / table.sum(axis=1, keepdims=True) * 100,
+            index=pd.Index(group_values[observed_groups], name=group_col),
+            columns=pd.Index(columns, name=stack_col))
+    return crosstabs
+
+
+@themed
+def render_stacked_barchart(pivot_data, group_col, stack_col, path, dpi=300):
+    """
+    Render a percentage crosstab as a stacked bar chart and save it to path
+    """
+    # Only imported once there is something to render
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(15, 8))
+    pivot_data.plot(kind='bar', stacked=True, ax=ax)
+
     # Customize the chart
-    plt.title(f'Distribution of {stack_col} by {group_col}')
-    plt.xlabel(group_col)
-    plt.ylabel('Percentage')
-    plt.legend(title=stack_col, bbox_to_anchor=(1.05, 1), loc='upper left')
-    plt.tick_params(axis='x', rotation=45)
-    plt.grid(False)
-    
+    ax.set_title(f'Distribution of {stack_col} by {group_col}')
+    ax.set_xlabel(group_col)
+    ax.set_ylabel('Percentage')
+    ax.legend(title=stack_col, bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax.tick_params(axis='x', rotation=45)
+    ax.grid(False)
+
     # Adjust layout
-    plt.tight_layout()
-    
+    fig.tight_layout()
+
     # Save the figure
-    filename = f'{group_col}_vs_{stack_col}_distribution.png'
-    plt.savefig(os.path.join(save_path, filename), 
-                bbox_inches='tight', 
-                dpi=300)
-    
-    # Clear the figure and pivot data
-    plt.close()
-    del pivot_data
-    gc.collect()
+    fig.savefig(path, bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+    return path
+
+
+def _use_agg():
+    # Render off-screen in the worker processes
+    import matplotlib
+    matplotlib.use('Agg')
 
-# Call function individually for each analysis
-# 1. Country vs Department
-create_stacked_barchart(cp, 'country', 'department_id')
 
-# 2. Country vs Product Name
-create_stacked_barchart(cp, 'country', 'product_name')
+def create_stacked_barcharts(df, pairs, save_path='graphs', data_path=None, workers=None,
+                             dpi=300, top_n=None):
+    """
+    Create and save the stacked bar charts of several column pairs
+
+    Duplicate pairs are only rendered once, the crosstabs are computed together
+    (see compute_crosstabs) and the figures are rendered in a pool of processes
+
+    Args:
+        df: pandas DataFrame
+        pairs: list of (group_col, stack_col), e.g. [('country', 'department_name')]
+        save_path: folder to save graphs
+        data_path: file df was loaded from, charts whose PNG is newer than it and that were
+            rendered with the same dpi and top_n are skipped
+        workers: number of rendering processes (default: one per CPU), 0 renders in this process
+        dpi: resolution of the saved charts
+        top_n: only show the top_n most common stack values of each chart, with the rest as
+            'Other', so charts of high-cardinality columns stay quick to render
+
+    Returns:
+        list of the paths of the charts, including the skipped ones
+    """
+    # Create directory if it doesn't exist
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
 
-# 3. Country vs Product Group
-create_stacked_barchart(cp, 'country', 'product_group_name')
+    pairs = list(dict.fromkeys(tuple(pair) for pair in pairs))
+    paths = {pair: os.path.join(save_path, chart_filename(*pair)) for pair in pairs}
+    params = {'dpi': dpi, 'top_n': top_n}
+    if data_path is not None:
+        data_mtime = os.path.getmtime(data_path)
+        pairs = [pair for pair in pairs if not is_up_to_date(paths[pair], data_mtime, params)]
+    if not pairs:
+        return list(paths.values())
 
-# 4. Country vs Sub Index Name (as customer group)
-create_stacked_barchart(cp, 'country', 'sub_index_name')
+    crosstabs = compute_crosstabs(df, pairs, top_n)
+    if workers == 0 or len(pairs) == 1:
+        for pair in pairs:
+            render_stacked_barchart(crosstabs[pair], *pair, paths[pair], dpi)
+            write_stamp(paths[pair], params)
+    else:
+        # Spawned workers don't inherit the interactive backend of this process
+        with ProcessPoolExecutor(max_workers=workers, initializer=_use_agg,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(render_stacked_barchart, crosstabs[pair], *pair, paths[pair], dpi)
+                       for pair in pairs]
+            for pair, future in zip(pairs, futures):
+                future.result()
+                write_stamp(paths[pair], params)
+    return list(paths.values())
 
-# 5. Country vs Colour Group
-create_stacked_barchart(cp, 'country', 'colour_group_name')
 
-# 6. Country vs Sub Index
-create_stacked_barchart(cp, 'country', 'sub_index_name')
+def create_stacked_barchart(df, group_col, stack_col, save_path='graphs', top_n=None):
+    """
+    Create and save stacked bar chart
 
-# 7. Country vs Index Description
-create_stacked_barchart(cp, 'country', 'index_description')
+    Args:
+        df: pandas DataFrame
+        group_col: column to group by (e.g., 'country')
+        stack_col: column to create stacks (e.g., 'department_name')
+        save_path: folder to save graphs
+        top_n: only show the top_n most common values of stack_col, with the rest as 'Other'
+    """
+    create_stacked_barcharts(df, [(group_col, stack_col)], save_path, workers=0, top_n=top_n)
 
-# 8. Country vs Index Group
-create_stacked_barchart(cp, 'country', 'index_group_name')
 
-# 9. Country vs Section
-create_stacked_barchart(cp, 'country', 'section_name')
+if __name__ == '__main__':
+    import sys
 
-# 10. Country vs Division
-create_stacked_barchart(cp, 'country', 'division_name')
+    # Extract of the country/product table, charts that are newer than it are kept
+    data_path = sys.argv[1] if len(sys.argv) > 1 else 'cp.csv'
+    if data_path.endswith('.parquet'):
+        cp = pd.read_parquet(data_path)
+    else:
+        cp = pd.read_csv(data_path)
 
-# 11. Country vs Garment Group
-create_stacked_barchart(cp, 'country', 'garment_group_name')
+    # Create all the country charts in one batch
+    create_stacked_barcharts(cp, [
+        ('country', 'department_id'),
+        ('country', 'product_name'),
+        ('country', 'product_group_name'),
+        ('country', 'sub_index_name'),  # as customer group
+        ('country', 'colour_group_name'),
+        ('country', 'index_description'),
+        ('country', 'index_group_name'),
+        ('country', 'section_name'),
+        ('country', 'division_name'),
+        ('country', 'garment_group_name'),
+    ], data_path=data_path, top_n=20)
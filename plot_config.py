@@ -1,114 +1,165 @@
-mpl.style.use("ggplot")
-mpl.rcParams["figure.figsize"] = (20, 5)
-mpl.rcParams["axes.facecolor"] = "white"
-mpl.rcParams["axes.grid"] = True
-mpl.rcParams["grid.color"] = "lightgray"
-mpl.rcParams["axes.prop_cycle"] = colors
-mpl.rcParams["axes.linewidth"] = 1
-mpl.rcParams["xtick.color"] = "black"
-mpl.rcParams["ytick.color"] = "black"
-mpl.rcParams["font.size"] = 13
-mpl.rcParams["figure.titlesize"] = 20
-mpl.rcParams["figure.dpi"] = 100
-mpl.rcParams["legend.fontsize"] = 10
-mpl.rcParams['figure.dpi'] = 100
-mpl.rcParams['xtick.labelsize'] = 10
-mpl.rcParams['ytick.labelsize'] = 10
-mpl.rcParams['axes.labelsize'] = 12
-
-
-
-
-1- barplot
-import pandas as pd
-import matplotlib.pyplot as plt
-
-# Assuming your SQL query results are in a DataFrame called 'df'
-# If not, first run your query and store results in df
-
-# Create figure and axis
-fig, ax1 = plt.subplots(figsize=(12, 6))
-
-# Create secondary y-axis
-ax2 = ax1.twinx()
-
-# Plot bar chart for total deliveries on primary y-axis
-bars = ax1.bar(df['deliverytype'], 
-               df['total_deliveries'], 
-               color='skyblue', 
-               alpha=0.7,
-               width=0.5)
-
-# Plot line graphs for percentages on secondary y-axis
-line1 = ax2.plot(range(len(df)), 
-                 df['on_time_percentage'], 
-                 'ro-', 
-                 label='On-time %', 
-                 linewidth=2,
-                 marker='o')
-line2 = ax2.plot(range(len(df)), 
-                 df['failure_rate'], 
-                 'go-', 
-                 label='Failure %', 
-                 linewidth=2,
-                 marker='o')
-
-# Customize primary y-axis (total deliveries)
-ax1.set_xlabel('Delivery Type')
-ax1.set_ylabel('Total Deliveries', color='skyblue', fontsize=10)
-ax1.tick_params(axis='y', labelcolor='skyblue')
-
-# Customize secondary y-axis (percentages)
-ax2.set_ylabel('Percentage (%)', color='red', fontsize=10)
-ax2.tick_params(axis='y', labelcolor='red')
-
-# Set y-axis ranges for percentages (0-100)
-ax2.set_ylim(0, 100)
-
-# Rotate x-axis labels for better readability
-plt.xticks(range(len(df)), df['deliverytype'], rotation=45, ha='right')
-
-# Add title
-plt.title('Delivery Performance by Type', pad=20, fontsize=12)
-
-# Add value labels on bars
-for bar in bars:
-    height = bar.get_height()
-    ax1.text(bar.get_x() + bar.get_width()/2., height,
-             f'{int(height):,}',
-             ha='center', va='bottom',
-             fontsize=9)
-
-# Add value labels for lines
-for i in range(len(df)):
-    ax2.text(i, df['on_time_percentage'].iloc[i], 
-             f"{df['on_time_percentage'].iloc[i]:.1f}%",
-             ha='center', va='bottom', color='red',
-             fontsize=9)
-    ax2.text(i, df['failure_rate'].iloc[i], 
-             f"{df['failure_rate'].iloc[i]:.1f}%",
-             ha='center', va='top', color='green',
-             fontsize=9)
-
-# Combine legends
-lines1, labels1 = ax1.get_legend_handles_labels()
-lines2, labels2 = ax2.get_legend_handles_labels()
-ax2.legend(lines1 + lines2, ['Total Deliveries'] + labels2, 
-          loc='upper right', bbox_to_anchor=(1.15, 1))
-
-# Add grid for percentage axis
-ax2.grid(True, alpha=0.3)
-
-# Adjust layout to prevent label cutoff
-plt.tight_layout()
-
-# Show plot
-plt.show()
-
-# Print summary statistics
-print("\nSummary Statistics:")
-print(f"Total Deliveries: {df['total_deliveries'].sum():,}")
-print(f"Average On-time Rate: {df['on_time_percentage'].mean():.1f}%")
-print(f"Average Failure Rate: {df['failure_rate'].mean():.1f}%")
-print(f"Best Performing Delivery Type: {df.loc[df['on_time_percentage'].idxmax(), 'deliverytype']}")
-print(f"Worst Performing Delivery Type: {df.loc[df['on_time_percentage'].idxmin(), 'deliverytype']}")
+import contextlib
+import functools
+
+# Plotting theme, applied through plot_theme (or themed) so importing this module, and the
+# analyses that use it, doesn't import matplotlib
+STYLE = "ggplot"
+COLORS = ["#E24A33", "#348ABD", "#988ED5", "#777777", "#FBC15E", "#8EBA42", "#FFB5B8"]
+RC_PARAMS = {
+    "figure.figsize": (20, 5),
+    "axes.facecolor": "white",
+    "axes.grid": True,
+    "grid.color": "lightgray",
+    "axes.linewidth": 1,
+    "xtick.color": "black",
+    "ytick.color": "black",
+    "font.size": 13,
+    "figure.titlesize": 20,
+    "figure.dpi": 100,
+    "legend.fontsize": 10,
+    "xtick.labelsize": 10,
+    "ytick.labelsize": 10,
+    "axes.labelsize": 12,
+}
+
+
+def theme_rc(rc=None):
+    """
+    rcParams of the theme, updated with the rcParams in rc
+    """
+    import matplotlib as mpl
+
+    theme = dict(RC_PARAMS)
+    theme["axes.prop_cycle"] = mpl.cycler(color=COLORS)
+    theme.update(rc or {})
+    return theme
+
+
+@contextlib.contextmanager
+def plot_theme(rc=None):
+    """
+    Apply the theme, updated with the rcParams in rc, to the figures created inside the
+    with block
+    """
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
+    with plt.style.context(STYLE), mpl.rc_context(theme_rc(rc)):
+        yield
+
+
+def themed(func):
+    """
+    Decorator that runs a plotting function inside plot_theme
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with plot_theme():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def apply_theme(rc=None):
+    """
+    Apply the theme globally, e.g. at the top of a notebook
+    """
+    import matplotlib as mpl
+
+    mpl.style.use(STYLE)
+    mpl.rcParams.update(theme_rc(rc))
+
+
+@themed
+def plot_delivery_by_type(df):
+    """
+    Bar chart of the deliveries of each delivery type, with its on-time and failure rates as
+    lines on a second axis. df is the result of the delivery performance query, with
+    deliverytype, total_deliveries, on_time_percentage and failure_rate columns
+    """
+    import matplotlib.pyplot as plt
+
+    # Create figure and axis
+    fig, ax1 = plt.subplots(figsize=(12, 6))
+
+    # Create secondary y-axis
+    ax2 = ax1.twinx()
+
+    # Plot bar chart for total deliveries on primary y-axis
+    bars = ax1.bar(df['deliverytype'],
+                   df['total_deliveries'],
+                   color='skyblue',
+                   alpha=0.7,
+                   width=0.5,
+                   label='Total Deliveries')
+
+    # Plot line graphs for percentages on secondary y-axis
+    ax2.plot(range(len(df)),
+             df['on_time_percentage'],
+             'ro-',
+             label='On-time %',
+             linewidth=2)
+    ax2.plot(range(len(df)),
+             df['failure_rate'],
+             'go-',
+             label='Failure %',
+             linewidth=2)
+
+    # Customize primary y-axis (total deliveries)
+    ax1.set_xlabel('Delivery Type')
+    ax1.set_ylabel('Total Deliveries', color='skyblue', fontsize=10)
+    ax1.tick_params(axis='y', labelcolor='skyblue')
+
+    # Customize secondary y-axis (percentages)
+    ax2.set_ylabel('Percentage (%)', color='red', fontsize=10)
+    ax2.tick_params(axis='y', labelcolor='red')
+
+    # Set y-axis ranges for percentages (0-100)
+    ax2.set_ylim(0, 100)
+
+    # Rotate x-axis labels for better readability
+    plt.xticks(range(len(df)), df['deliverytype'], rotation=45, ha='right')
+
+    # Add title
+    plt.title('Delivery Performance by Type', pad=20, fontsize=12)
+
+    # Add value labels on bars
+    for bar in bars:
+        height = bar.get_height()
+        ax1.text(bar.get_x() + bar.get_width()/2., height,
+                 f'{int(height):,}',
+                 ha='center', va='bottom',
+                 fontsize=9)
+
+    # Add value labels for lines
+    for i in range(len(df)):
+        ax2.text(i, df['on_time_percentage'].iloc[i],
+                 f"{df['on_time_percentage'].iloc[i]:.1f}%",
+                 ha='center', va='bottom', color='red',
+                 fontsize=9)
+        ax2.text(i, df['failure_rate'].iloc[i],
+                 f"{df['failure_rate'].iloc[i]:.1f}%",
+                 ha='center', va='top', color='green',
+                 fontsize=9)
+
+    # Combine legends
+    lines1, labels1 = ax1.get_legend_handles_labels()
+    lines2, labels2 = ax2.get_legend_handles_labels()
+    ax2.legend(lines1 + lines2, labels1 + labels2,
+               loc='upper right', bbox_to_anchor=(1.15, 1))
+
+    # Add grid for percentage axis
+    ax2.grid(True, alpha=0.3)
+
+    # Adjust layout to prevent label cutoff
+    plt.tight_layout()
+
+    # Show plot
+    plt.show()
+
+    # Print summary statistics
+    print("\nSummary Statistics:")
+    print(f"Total Deliveries: {df['total_deliveries'].sum():,}")
+    print(f"Average On-time Rate: {df['on_time_percentage'].mean():.1f}%")
+    print(f"Average Failure Rate: {df['failure_rate'].mean():.1f}%")
+    print(f"Best Performing Delivery Type: {df.loc[df['on_time_percentage'].idxmax(), 'deliverytype']}")
+    print(f"Worst Performing Delivery Type: {df.loc[df['on_time_percentage'].idxmin(), 'deliverytype']}")
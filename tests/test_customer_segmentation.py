@@ -0,0 +1,78 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+SEGMENTATION = Path(__file__).resolve().parent.parent / 'customer_segmentation.py'
+
+
+@pytest.fixture(scope='module')
+def segmentation():
+    # customer_segmentation.py starts with the SQL queries, the Python script is the last part
+    source = SEGMENTATION.read_text().split('\n------------\n')[-1]
+    namespace = {'__name__': 'customer_segmentation'}
+    exec(compile(source, str(SEGMENTATION), 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def articles(segmentation):
+    rng = np.random.default_rng(0)
+    columns = segmentation['HIERARCHY_COLUMNS']
+    # Values are drawn per level, so some children appear under more than one parent
+    df = pd.DataFrame({col: [f'{col[:3]}{value}' for value in rng.integers(0, 3, 400)]
+                       for col in columns})
+    df.loc[::37, columns[3]] = None
+    return df
+
+
+def test_hierarchy_profile_matches_groupby(segmentation, articles):
+    columns = segmentation['HIERARCHY_COLUMNS']
+    profile = segmentation['HierarchyProfile'](articles)
+
+    assert_series_equal(profile.cardinalities, articles[columns].nunique(),
+                        check_names=False)
+    for fan_out in profile.fan_outs.itertuples():
+        children = articles.groupby(fan_out.parent)[fan_out.child].nunique()
+        assert fan_out.mean_children == pytest.approx(children.mean())
+        assert fan_out.max_children == children.max()
+        parents = articles.groupby(fan_out.child)[fan_out.parent].nunique()
+        assert fan_out.children_with_many_parents == (parents > 1).sum()
+
+    expected = (articles.groupby(columns).size().rename('count').reset_index()
+                .sort_values('count', ascending=False, kind='stable', ignore_index=True))
+    assert_frame_equal(profile.combinations, expected)
+
+
+@pytest.mark.parametrize('reload', [False, True])
+def test_hierarchy_index_paths_and_rollups(segmentation, articles, tmp_path, reload):
+    columns = segmentation['HIERARCHY_COLUMNS']
+    index = segmentation['HierarchyIndex'].build(articles)
+    if reload:
+        index.save(tmp_path / 'hierarchy.npz')
+        index = segmentation['HierarchyIndex'].load(tmp_path / 'hierarchy.npz')
+
+    complete = articles.dropna(subset=columns)
+    row = complete.iloc[0]
+    path = [row[col] for col in columns[:3]]
+    node = index.node(path)
+    assert index.path(node) == path
+    assert all(type(name) is str for name in index.path(node))
+    assert index.subtree_count(node) == (complete[columns[:3]] == path).all(axis=1).sum()
+    assert [index.name(child) for child in index.children_of(node)] == sorted(
+        complete.loc[(complete[columns[:3]] == path).all(axis=1), columns[3]].unique())
+    with pytest.raises(KeyError):
+        index.node(path[:2] + ['missing'])
+
+    prices = pd.Series(np.arange(len(articles), dtype=float), index=articles.index)
+    prices.iloc[::11] = np.nan
+    for level in [0, 2, len(columns) - 1]:
+        keys = columns[:level + 1]
+        rollup = index.rollup(index.leaf_totals(prices), columns[level])
+        expected = (prices[complete.index].fillna(0).groupby([complete[col] for col in keys])
+                    .sum().rename('total').reset_index())
+        assert_frame_equal(rollup, expected)
+        counts = index.rollup(index.leaf_counts, level)
+        assert counts['total'].tolist() == complete.groupby(keys).size().tolist()
@@ -0,0 +1,359 @@
+import os
+import re
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import final
+
+
+def test_compare_df_large_integer_ids():
+    # ids above 2**53 aren't exact as floats
+    df_gold = pd.DataFrame({"a": [2**53, 5]})
+    df_gen = pd.DataFrame({"a": [2**53 + 1, 5]})
+    assert not final.compare_df(df_gold, df_gen, "group_by", "question")
+    assert final.compare_df(df_gold, df_gold.copy(), "group_by", "question")
+
+
+def test_compare_df_integer_and_float_columns():
+    df_gold = pd.DataFrame({"a": pd.array([1, None], dtype="Int64")})
+    df_gen = pd.DataFrame({"a": [1.0, np.nan]})
+    assert final.compare_df(df_gold, df_gen, "group_by", "question")
+
+
+def test_compare_df_out_of_ns_bounds_dates():
+    dates = pd.Series(np.array(["9999-12-31", "2020-01-01"], dtype="datetime64[s]"))
+    df_gold = pd.DataFrame({"a": dates})
+    df_gen = pd.DataFrame({"a": dates.astype("datetime64[us]")})
+    assert final.compare_df(df_gold, df_gen, "group_by", "question")
+    assert final.subset_df(df_gold, df_gen.assign(b=[1, 2]), "group_by", "question")
+
+
+def test_hash_compare_df_duplicate_rows():
+    # duplicates are compared as sets, like compare_df, without leaving the hash path
+    df_gold = pd.DataFrame({"a": [1, 1, 2, 3], "b": ["x", "x", None, "z"]})
+    df_gen = pd.DataFrame({"a": [3, 2, 1, 2], "b": ["z", None, "x", None]})
+    assert final.hash_compare_df(df_gold, df_gen) is True
+    assert final.hash_compare_df(df_gold, df_gen.iloc[:2]) is False
+    assert final.compare_df(df_gold, df_gen, "group_by", "question")
+
+
+def test_subset_df_all_null_columns_across_types():
+    df_sub = pd.DataFrame({"a": pd.Series([np.nan, np.nan], dtype="str")})
+    df_super = pd.DataFrame({"b": [1, 2], "c": [np.nan, np.nan]})
+    assert final.subset_df(df_sub, df_super, "group_by", "question")
+
+
+def fake_query_db(executed):
+    # stands in for query_postgres_db: one row with a column per selected expression
+    def query_db(query, *args, **kwargs):
+        executed.append(query)
+        select_list = re.search(r"SELECT (.*) FROM", query).group(1)
+        return pd.DataFrame({col.strip(): [1] for col in select_list.split(",")})
+
+    return query_db
+
+
+@pytest.mark.parametrize(
+    "query_gold, num_executed",
+    [
+        # all subsets are projected from one query with every option
+        ("SELECT {a, b, c} FROM t", 1),
+        # the fixed column shifts the options, so each subset is executed on its own
+        ("SELECT c, {a, b} FROM t", 3),
+        ("SELECT {a, b}, c FROM t", 3),
+    ],
+)
+def test_compare_query_results_gold_executions(monkeypatch, query_gold, num_executed):
+    executed = []
+    monkeypatch.setattr(final, "query_postgres_db", fake_query_db(executed))
+    # the generated result matches none of the gold subsets exactly, so they are all compared
+    exact_match, _ = final.compare_query_results(
+        query_gold, "SELECT z FROM t", "db", "postgres", {}, "question", "group_by"
+    )
+    assert not exact_match
+    assert len(executed) == num_executed + 1
+
+
+def test_gold_result_cache_invalidates_on_schema_change(monkeypatch, tmp_path):
+    executed = []
+    monkeypatch.setattr(final, "query_postgres_db", fake_query_db(executed))
+    fingerprints = {"db": "v1"}
+    cache = final.GoldResultCache(
+        str(tmp_path), lambda db_name, db_type, db_creds: fingerprints[db_name]
+    )
+    df = cache.query("SELECT a, b FROM t", "db", "postgres", {})
+    # same query up to whitespace, case and a trailing semicolon
+    assert_frame_equal(cache.query("select a,  b\nfrom T;", "db", "postgres", {}), df)
+    assert len(executed) == 1
+    assert cache.stats()["hits"] == 1
+
+    fingerprints["db"] = "v2"
+    cache.invalidate("db", "postgres")
+    assert os.listdir(tmp_path / "postgres" / "db") == []
+    cache.query("SELECT a, b FROM t", "db", "postgres", {})
+    assert len(executed) == 2
+    assert os.listdir(tmp_path / "postgres" / "db") == ["v2"]
+
+
+def test_pipeline_stage_passes_errors_through():
+    first_queue, second_queue, output_queue = (final.queue.Queue() for _ in range(3))
+    seen = []
+
+    def record(value):
+        seen.append(value)
+        return value + 1
+
+    stages = [
+        final.PipelineStage("invert", lambda value: 1 / value, 2, first_queue, second_queue),
+        final.PipelineStage("record", record, 2, second_queue, output_queue),
+    ]
+    for stage in stages:
+        stage.start()
+    for value in [1, 0, 4]:
+        first_queue.put((value, None))
+    results = [output_queue.get(timeout=5) for _ in range(3)]
+    for stage in stages:
+        stage.stop()
+
+    assert sorted(value for value, error in results if error is None) == [1.25, 2.0]
+    errors = [(value, error) for value, error in results if error is not None]
+    assert len(errors) == 1
+    # the failed item keeps its input value and isn't passed to the next stage's func
+    assert errors[0][0] == 0
+    assert isinstance(errors[0][1], ZeroDivisionError)
+    assert sorted(seen) == [0.25, 1.0]
+
+
+def eval_row(question, **values):
+    return {"db_name": "db", "question": question, "query": "SELECT 1", **values}
+
+
+def test_jsonl_result_sink_appends_across_runs(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    sink = final.JsonlResultSink(path)
+    sink.write(eval_row("q1", correct=0))
+    sink.write(eval_row("q2", correct=1))
+    sink.close()
+    # a crash in the middle of writing a row
+    with open(path, "a") as f:
+        f.write('{"db_name": "db", "quest')
+
+    sink = final.JsonlResultSink(path)
+    sink.write(eval_row("q1", correct=1))
+    sink.write(eval_row("q3", correct=0))
+    sink.close()
+
+    row_keys = {q: final.JsonlResultSink.row_key(eval_row(q)) for q in ["q1", "q2", "q3"]}
+    assert sink.keys() == set(row_keys.values())
+    df = sink.read([row_keys["q1"], row_keys["q3"]])
+    assert df["question"].tolist() == ["q1", "q3"]
+    assert df["correct"].tolist() == [1, 0]
+
+
+def test_eval_checkpoint_resume(tmp_path):
+    prompt_file = tmp_path / "prompt.md"
+    prompt_file.write_text("{user_question}")
+    checkpoint = final.EvalCheckpoint(str(tmp_path / "checkpoints"), str(prompt_file), "gpt-4")
+    generated = {"query": "SELECT 1", "err": "", "latency_seconds": 1.0}
+    for question in ["ok", "wrong", "timeout", "connection"]:
+        checkpoint.save_generated(eval_row(question), generated)
+    checkpoint.save_generated(eval_row("gen_error"), {"err": "QUERY GENERATION ERROR: x"})
+    checkpoint.save_scored(eval_row("ok", correct=1))
+    checkpoint.save_scored(
+        eval_row("wrong", correct=0, error_db_exec=1,
+                 error_msg='QUERY EXECUTION ERROR: column "x" does not exist')
+    )
+    checkpoint.save_scored(eval_row("timeout", correct=0, timeout=1))
+    checkpoint.save_scored(
+        eval_row("connection", correct=0, error_db_exec=1,
+                 error_msg="QUERY EXECUTION ERROR: (psycopg2.OperationalError) server closed "
+                 "the connection unexpectedly")
+    )
+    checkpoint.close()
+    # a crash in the middle of writing an entry
+    with open(checkpoint.path, "a") as f:
+        f.write('{"kind": "scored", "key": "')
+
+    checkpoint = final.EvalCheckpoint(str(tmp_path / "checkpoints"), str(prompt_file), "gpt-4")
+    assert checkpoint.get_scored(eval_row("ok"))["correct"] == 1
+    assert checkpoint.get_scored(eval_row("wrong"))["error_db_exec"] == 1
+    # transient failures are executed again from their generated query
+    for question in ["timeout", "connection"]:
+        assert checkpoint.get_scored(eval_row(question)) is None
+        assert checkpoint.get_generated(eval_row(question)) == generated
+    assert checkpoint.get_generated(eval_row("gen_error")) is None
+    checkpoint.save_scored(eval_row("timeout", correct=1))
+    checkpoint.close()
+
+    with open(checkpoint.path) as f:
+        lines = f.readlines()
+    assert all(line.endswith("}\n") for line in lines)
+    checkpoint = final.EvalCheckpoint(str(tmp_path / "checkpoints"), str(prompt_file), "gpt-4")
+    assert checkpoint.get_scored(eval_row("timeout"))["correct"] == 1
+    checkpoint.close()
+
+
+def test_rate_limiter_shared_across_event_loops():
+    # run_openai_eval shares one limiter between prompt files, each run on its own loop
+    limiter = final.AdaptiveRateLimiter(max_concurrency=2, min_concurrency=1)
+
+    async def request(rate_limited):
+        tokens = await limiter.acquire()
+        await final.asyncio.sleep(0.01)
+        await limiter.release(tokens, tokens_used=10, rate_limited=rate_limited)
+
+    async def run_file():
+        # more requests than the window, so some of them wait on the limiter
+        await final.asyncio.gather(*(request(rate_limited=i == 0) for i in range(4)))
+
+    limiter.max_backoff_seconds = 0.01
+    for _ in range(2):
+        final.asyncio.run(run_file())
+    assert limiter.num_requests == 8
+    assert limiter.in_flight == 0
+
+
+def test_engine_pool_reuses_engines_and_connections(monkeypatch, tmp_path):
+    created = []
+    create_engine = final.create_engine
+
+    def create_sqlite_engine(db_url, connect_args, **kwargs):
+        created.append((db_url, connect_args))
+        return create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}", **kwargs)
+
+    monkeypatch.setattr(final, "create_engine", create_sqlite_engine)
+    pool = final.EnginePool(pool_size=2, max_overflow=0)
+    db_creds = {"user": "u", "password": "p", "host": "localhost", "port": 5432}
+    for _ in range(3):
+        with pool.get_engine("postgres", "db", db_creds).connect() as conn:
+            conn.execute(final.text("SELECT 1"))
+    stats = pool.stats()
+    assert len(created) == 1
+    assert (stats["num_engines"], stats["num_connects"], stats["num_checkouts"]) == (1, 1, 3)
+
+    # new settings apply to engines created after the change
+    pool.configure(pool_size=2, max_overflow=0, statement_timeout=1.5)
+    assert pool.stats()["num_engines"] == 0
+    pool.get_engine("postgres", "db", db_creds)
+    assert created[-1] == (
+        "postgresql://u:p@localhost:5432/db",
+        {"options": "-c statement_timeout=1500"},
+    )
+    with pytest.raises(ValueError):
+        pool.get_engine("sqlite", "db", db_creds)
+    pool.dispose()
+
+
+def reference_normalize_table(df, sql=None):
+    # normalize_table before rows were encoded as integer codes, kept to check that the
+    # results are identical
+    df = df.drop_duplicates()
+    sorted_df = df.reindex(sorted(df.columns), axis=1)
+    has_order_by, order_by_columns, ascending = (
+        final.parse_order_by(sql) if sql else (False, (), ())
+    )
+    if has_order_by:
+        existing_columns = [col for col in order_by_columns if col in sorted_df.columns]
+        existing_ascending = [
+            asc for col, asc in zip(order_by_columns, ascending) if col in sorted_df.columns
+        ]
+        if existing_columns:
+            sorted_df = sorted_df.sort_values(by=existing_columns, ascending=existing_ascending)
+            other_columns = [col for col in sorted_df.columns if col not in existing_columns]
+            sorted_df = sorted_df[other_columns + existing_columns]
+    else:
+        sorted_df = sorted_df.sort_values(by=list(sorted_df.columns))
+    sorted_df = final.deduplicate_columns(sorted_df)
+    return sorted_df.reset_index(drop=True)
+
+
+def test_normalize_table_repeated_order_by_column():
+    df = pd.DataFrame({"a": [3, 1, 2, 1], "b": ["x", "y", "z", "y"]})
+    sql = "SELECT t.a, t.b FROM t ORDER BY t.a, a"
+    assert_frame_equal(
+        final.normalize_table(df, "order_by", "question", sql),
+        reference_normalize_table(df, sql),
+    )
+    df_gen = df.assign(b=["x", "y", "z", "w"])
+    assert not final.compare_df(df, df_gen, "order_by", "question", sql, sql, use_hash=False)
+
+
+def test_normalize_table_keeps_none_and_nan_apart():
+    df = pd.DataFrame({"a": pd.Series([None, np.nan, None, "x"], dtype=object)})
+    for sql in (None, "SELECT a FROM t ORDER BY a DESC"):
+        assert_frame_equal(
+            final.normalize_table(df, "group_by", "question", sql),
+            reference_normalize_table(df, sql),
+        )
+    df = df.assign(b=1)
+    assert_frame_equal(
+        final.normalize_table(df, "group_by", "question"), reference_normalize_table(df)
+    )
+
+
+def test_comparison_pool_fallback_and_worker_memory_cap():
+    import resource
+    from concurrent.futures.process import BrokenProcessPool
+
+    pool = final.ComparisonPool(max_workers=1, max_worker_memory_mb=4096)
+    results_gen = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+    shared_gen = pool.share(results_gen)
+    try:
+        results_gold = results_gen[["b", "a"]].iloc[:2]
+        expected = final.compare_results(results_gold, results_gen, "", "question")
+        assert pool.compare(results_gold, shared_gen, results_gen, "", "question") == expected
+        # mixed object columns can't be converted to Arrow, so they're compared in process
+        results_gold = pd.DataFrame({"a": [Decimal("1"), 2.0], "b": ["x", "y"]})
+        assert pool.share(results_gold) is None
+        assert pool.compare(
+            results_gold, shared_gen, results_gen, "", "question"
+        ) == final.compare_results(results_gold, results_gen, "", "question")
+
+        limit = 4096 * 1024 * 1024
+        assert pool.executor.submit(resource.getrlimit, resource.RLIMIT_AS).result() == (
+            limit,
+            limit,
+        )
+        # a worker that dies fails the comparisons in flight, and the pool is replaced
+        for process in list(pool.executor._processes.values()):
+            process.kill()
+        results_gold = results_gen[["b", "a"]].iloc[:2]
+        with pytest.raises(BrokenProcessPool):
+            pool.compare(results_gold, shared_gen, results_gen, "", "question")
+        assert pool.compare(results_gold, shared_gen, results_gen, "", "question") == expected
+    finally:
+        pool.release(shared_gen)
+        pool.shutdown()
+
+
+def test_phase_timer_excludes_nested_phases(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(final.time, "perf_counter", lambda: now[0])
+    timer = final.PhaseTimer()
+    with timer.phase("compare"):
+        now[0] += 1
+        with timer.phase("normalize"):
+            now[0] += 2
+            with timer.phase("hash"):
+                now[0] += 4
+        # times of a worker's timer count as nested too
+        timer.add({"normalize": 8.0})
+        now[0] += 16 + 8
+    with timer.phase("normalize"):
+        now[0] += 32
+    assert timer.as_dict() == {"compare": 17.0, "normalize": 42.0, "hash": 4.0}
+
+
+def test_read_sql_chunked_infers_dtypes_over_all_chunks():
+    engine = final.create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE t (x REAL)")
+        conn.exec_driver_sql(
+            "INSERT INTO t VALUES " + ", ".join(["(NULL)"] * 5 + ["(1.5)"] * 5)
+        )
+    df = final.read_sql_chunked("SELECT x FROM t", engine, chunk_size=5)
+    assert df["x"].dtype == "float64"
@@ -0,0 +1,157 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+JOURNEY = Path(__file__).resolve().parent.parent / 'journey.py'
+
+
+def run_script(index, name):
+    # journey.py holds two scripts separated by a dashed line
+    source = JOURNEY.read_text().split('\n-----------------------------------------------\n')[index]
+    namespace = {'__name__': name}
+    exec(compile(source, str(JOURNEY), 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture(scope='module')
+def journey():
+    return run_script(0, 'journey')
+
+
+@pytest.fixture(scope='module')
+def weekly():
+    return run_script(1, 'weekly_patterns')
+
+
+def write_extract(path):
+    # delivery_date is a plain date in the extract, the other timestamps have a time
+    pd.DataFrame({
+        'orderid': [1, 1, 2],
+        'product_price': [10.0, 5.0, 20.0],
+        'deliverytype': ['home', 'home', 'pickup'],
+        'warehouseid': ['W1', 'W1', 'W2'],
+        'deliverymode': [1, 1, 0],
+        'is_on_time': ['Y', 'Y', 'N'],
+        'orderdate_timestamp': ['2024-01-01 08:15:00', '2024-01-01 08:15:00',
+                                '2024-01-02 13:00:00'],
+        'delivery_date': ['2024-01-03', '2024-01-03', '2024-01-05'],
+        'unused': ['a', 'b', 'c'],
+    }).to_csv(path, index=False)
+
+
+def test_load_online_journey_date_only_delivery_date(journey, tmp_path):
+    path = tmp_path / 'online_journey.csv'
+    write_extract(path)
+    df = journey['load_online_journey'](path)
+
+    assert 'unused' not in df.columns
+    assert df['delivery_date'].tolist() == list(pd.to_datetime(
+        ['2024-01-03', '2024-01-03', '2024-01-05']))
+    assert df['orderdate_timestamp'].iloc[2] == pd.Timestamp('2024-01-02 13:00')
+    assert isinstance(df['deliverytype'].dtype, pd.CategoricalDtype)
+    assert isinstance(df['warehouseid'].dtype, pd.CategoricalDtype)
+    assert df['is_on_time'].tolist() == [True, True, False]
+    assert df['deliverymode'].tolist() == [True, True, False]
+
+
+def online_journey(num_rows=300, seed=0):
+    rng = np.random.default_rng(seed)
+    flags = {col: rng.choice(['Y', 'N'], num_rows) for col in
+             ['is_return_flag', 'is_short_pick', 'is_zero_pick', 'is_on_time',
+              'is_delivery_failure']}
+    df = pd.DataFrame({
+        'orderid': rng.integers(0, num_rows // 3, num_rows),
+        'product_price': rng.uniform(1, 100, num_rows).round(2),
+        'consignment_deliverycost': rng.uniform(0, 10, num_rows).round(2),
+        'deliverymode': rng.choice(['0', '1'], num_rows),
+        'deliverytype': rng.choice(['home', 'pickup', 'locker'], num_rows),
+        'warehouseid': rng.choice(['W1', 'W2', 'W3', 'W4'], num_rows),
+        'product_group_name': rng.choice(['toys', 'books', 'garden'], num_rows),
+        'product_type_name': rng.choice(['small', 'large'], num_rows),
+        **flags,
+        'orderdate_timestamp': pd.Timestamp('2024-01-01')
+        + pd.to_timedelta(rng.integers(0, 60 * 24 * 30, num_rows), unit='min'),
+    })
+    df.loc[::17, 'product_price'] = np.nan
+    df.loc[::23, 'consignment_deliverycost'] = np.nan
+    return df
+
+
+def test_memoized_reports_are_copies_until_the_frame_changes(journey):
+    df = online_journey()
+    analyzer = journey['EcommerceAnalyzer'](df)
+    report = analyzer.full_report()
+    expected = journey['EcommerceAnalyzer'](df).full_report()
+    # changing a returned result, or the frames and series in it, doesn't change the cache
+    report['delivery_performance']['total_orders'] = -1
+    report['summary']['top_product_groups'].iloc[:] = -1
+    assert_frame_equal(analyzer.delivery_performance_analysis(),
+                       expected['delivery_performance'])
+    assert_series_equal(analyzer.generate_summary_report()['top_product_groups'],
+                        expected['summary']['top_product_groups'])
+
+    # in place changes are only picked up after invalidate_cache
+    analyzer.df.loc[analyzer.df['deliverytype'] == 'home', 'is_on_time'] = False
+    assert_frame_equal(analyzer.delivery_performance_analysis(),
+                       expected['delivery_performance'])
+    analyzer.invalidate_cache()
+    on_time_rate = analyzer.delivery_performance_analysis().set_index('delivery_type')[
+        'on_time_rate']
+    assert on_time_rate['home'] == 0
+    assert on_time_rate['pickup'] == expected['delivery_performance'].set_index(
+        'delivery_type')['on_time_rate']['pickup']
+
+    # setting a new frame invalidates the cache
+    analyzer.df = journey['prepare_online_journey'](df.iloc[:100])
+    assert_frame_equal(analyzer.warehouse_performance(),
+                       journey['EcommerceAnalyzer'](df.iloc[:100]).warehouse_performance())
+
+
+@pytest.mark.parametrize('chunk_size', [7, 64, 1000])
+def test_chunked_report_matches_in_memory(journey, chunk_size):
+    df = online_journey()
+    expected = journey['EcommerceAnalyzer'](df).full_report()
+    chunks = (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size))
+    report = journey['EcommerceAnalyzer'].from_chunks(chunks).full_report()
+
+    for name in ['delivery_performance', 'product_category', 'warehouse_performance',
+                 'delivery_mode']:
+        assert_frame_equal(report[name], expected[name])
+    summary, expected_summary = report['summary'], expected['summary']
+    for key, value in expected_summary.items():
+        if isinstance(value, pd.Series):
+            assert_series_equal(summary[key], value)
+        else:
+            assert summary[key] == pytest.approx(value)
+
+
+def test_chunked_report_approximate_distinct_orders(journey):
+    df = online_journey()
+    chunks = (df.iloc[start:start + 50] for start in range(0, len(df), 50))
+    analyzer = journey['EcommerceAnalyzer'].from_chunks(chunks, approximate_distinct=True)
+    assert analyzer.generate_summary_report()['total_orders'] == pytest.approx(
+        df['orderid'].nunique(), rel=0.05)
+
+
+# to_period drops the time zone, keeping the local wall time, which is what week_start matches
+@pytest.mark.filterwarnings('ignore:Converting to PeriodArray')
+@pytest.mark.parametrize('tz', [None, 'UTC', 'Europe/Amsterdam', 'America/New_York'])
+def test_derive_time_features_matches_dt_accessors(weekly, tz):
+    timestamps = pd.Series(pd.date_range('2024-03-20', '2024-11-10', freq='37min', tz=tz),
+                           name='orderdate_timestamp')
+    timestamps.iloc[::101] = pd.NaT
+    features = weekly['derive_time_features'](timestamps)
+
+    assert_series_equal(features['orderdate_timestamp'], timestamps)
+    assert_series_equal(features['day_of_week'].astype(object),
+                        timestamps.dt.day_name().astype(object), check_names=False)
+    assert_series_equal(features['hour_of_day'], timestamps.dt.hour,
+                        check_dtype=False, check_names=False)
+    assert_series_equal(features['week_number'], timestamps.dt.isocalendar()['week'],
+                        check_names=False)
+    week_start = timestamps.dt.to_period('W').dt.start_time
+    assert_series_equal(features['week_start'].astype('datetime64[ns]'),
+                        week_start.astype('datetime64[ns]'), check_names=False)
@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from journey_sql import SqlSource, detect_dialect
+
+duckdb = pytest.importorskip('duckdb')
+
+
+@pytest.fixture
+def orders():
+    return pd.DataFrame({
+        'orderid': [1, 1, 2, 3, 4, 5],
+        'orderdate_timestamp': pd.to_datetime([
+            '2024-01-01 08:15', '2024-01-01 08:15', '2024-01-02 13:00', '2024-01-07 23:59',
+            '2024-01-08 00:01', None]),
+        'is_on_time': ['Y', 'Y', 'N', None, 'Y', 'N'],
+        'deliverymode': ['1', '1', '0', '1', '0', '1'],
+        'consignment_deliverycost': [4.5, 4.5, None, 3.0, 2.0, 1.0],
+    })
+
+
+def test_detect_dialect_duckdb():
+    assert detect_dialect(duckdb.connect()) == 'duckdb'
+
+
+def test_duckdb_aggregate_matches_pandas(orders):
+    con = duckdb.connect()
+    con.register('online_journey', orders)
+    source = SqlSource(con)
+    assert source.dialect == 'duckdb'
+
+    aggs = [('orderid', 'nunique'), ('is_on_time', 'mean'), ('deliverymode', 'mean'),
+            ('consignment_deliverycost', 'mean')]
+    timestamps = orders['orderdate_timestamp']
+    expected_orders = orders.assign(
+        day_of_week=timestamps.dt.day_name(),
+        hour_of_day=timestamps.dt.hour,
+        week_start=timestamps.dt.to_period('W').dt.start_time,
+        is_on_time=orders['is_on_time'].eq('Y'),
+        deliverymode=orders['deliverymode'].eq('1'))
+    for keys in [['day_of_week'], ['day_of_week', 'hour_of_day'], ['week_start']]:
+        expected = expected_orders.groupby(keys).agg(dict(aggs)).reset_index()
+        assert_frame_equal(source.aggregate(keys, aggs), expected, check_dtype=False)
@@ -0,0 +1,84 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import journey_stack_barplot
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    # Record the charts instead of drawing them
+    rendered = []
+
+    def render_stacked_barchart(pivot_data, group_col, stack_col, path, dpi=300):
+        rendered.append((group_col, stack_col, dpi))
+        with open(path, 'wb') as f:
+            f.write(b'png')
+        return path
+
+    monkeypatch.setattr(journey_stack_barplot, 'render_stacked_barchart', render_stacked_barchart)
+    return rendered
+
+
+def test_charts_are_rendered_again_when_data_or_parameters_change(rendered, tmp_path):
+    df = pd.DataFrame({'country': ['NL', 'NL', 'DE'], 'product_name': ['a', 'b', 'a'],
+                       'colour_group_name': ['red', 'red', 'blue']})
+    data_path = tmp_path / 'cp.csv'
+    df.to_csv(data_path, index=False)
+    an_hour_ago = time.time() - 3600
+    os.utime(data_path, (an_hour_ago, an_hour_ago))
+    pairs = [('country', 'product_name'), ('country', 'colour_group_name'),
+             ('country', 'product_name')]
+
+    def create(**kwargs):
+        rendered.clear()
+        return journey_stack_barplot.create_stacked_barcharts(
+            df, pairs, save_path=str(tmp_path / 'graphs'), data_path=str(data_path), workers=0,
+            **kwargs)
+
+    paths = create()
+    assert len(paths) == 2 and all(os.path.exists(path) for path in paths)
+    assert len(rendered) == 2
+    create()
+    assert rendered == []
+    create(dpi=100)
+    assert sorted(rendered) == [('country', 'colour_group_name', 100),
+                                ('country', 'product_name', 100)]
+    create(dpi=100)
+    assert rendered == []
+    create(dpi=100, top_n=1)
+    assert len(rendered) == 2
+
+    os.utime(data_path)
+    os.utime(paths[0], (an_hour_ago, an_hour_ago))
+    os.utime(paths[1], (an_hour_ago, an_hour_ago))
+    create(dpi=100, top_n=1)
+    assert len(rendered) == 2
+
+
+@pytest.mark.parametrize('top_n', [None, 2, 3, 10])
+def test_compute_crosstabs_matches_pd_crosstab(top_n):
+    rng = np.random.default_rng(0)
+    products = rng.choice(list('abcdefg'), 500, p=[.4, .2, .1, .1, .1, .05, .05])
+    df = pd.DataFrame({'country': rng.choice(['NL', 'DE', 'FR'], 500), 'product_name': products})
+    df.loc[::13, 'product_name'] = None
+    pairs = [('country', 'product_name'), ('product_name', 'country')]
+    crosstabs = journey_stack_barplot.compute_crosstabs(df, pairs, top_n)
+
+    for group_col, stack_col in pairs:
+        stack = df[stack_col]
+        # Most common values among the rows that have both, ties in sorted order
+        counts = stack[df[group_col].notna()].value_counts()
+        if top_n is not None and len(counts) > top_n:
+            # Values outside the top_n are added up as Other, after the top_n in sorted order
+            top = sorted(sorted(counts.index, key=lambda value: (-counts[value], value))[:top_n])
+            stack = stack.where(stack.isin(top) | stack.isna(), 'Other')
+        expected = pd.crosstab(df[group_col], stack, normalize='index') * 100
+        if 'Other' in expected.columns:
+            expected = expected[top + ['Other']]
+        assert_frame_equal(crosstabs[(group_col, stack_col)], expected)
+        assert np.allclose(crosstabs[(group_col, stack_col)].sum(axis=1), 100)